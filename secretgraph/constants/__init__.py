@@ -19,6 +19,13 @@ class MetadataOperations(enum.Enum):
     replace = "replace"
 
 
+class ChangeOperation(enum.Enum):
+    create = "create"
+    update = "update"
+    metadata = "metadata"
+    delete = "delete"
+
+
 class TransferResult(enum.Enum):
     SUCCESS = "success"
     NOTFOUND = "notfound"
@@ -2,30 +2,68 @@
 import json
 from datetime import timedelta as td, datetime as dt
 from functools import lru_cache
+from uuid import uuid4
 
 from django.db.models import Q, Subquery
 from django.utils import timezone
 from graphql_relay import from_global_id
 
-from ..models import Action, Cluster, Content
+from ..models import Action, Cluster, Content, HashIndexField
+from ..utils.misc import hash_index, hash_index_filter
+from .policy import ActionPolicy
 
 
 def _only_owned_helper(
     klass, linput, request, fields=("id",), check_field=None, scope="manage",
     authset=None
 ):
-    from ..utils.auth import retrieve_allowed_objects
+    """
+    Filters linput by the objects allowed for scope,
+    the authorization result is cached per request and scope
+    """
+    from ..utils.auth import initializeCachedResult
     if not check_field:
         check_field = "flexid"
     if check_field == "flexid" and not hasattr(klass, "flexid"):
         check_field = "id"
     if not hasattr(klass, "flexid"):
-        fields = set(fields).difference({"flexid"})
-    return retrieve_allowed_objects(
-        request, scope,
-        klass.objects.filter(**{f"{check_field}__in": linput or []}),
-        authset=authset
-    )["objects"].values_list(*fields, flat=True)
+        fields = [f for f in fields if f != "flexid"] or ["id"]
+    linput = list(linput or [])
+    if not linput:
+        return []
+    if check_field in ("contentHash", "keyHash"):
+        filters = hash_index_filter(check_field, linput)
+    else:
+        filters = {f"{check_field}__in": linput}
+    return initializeCachedResult(
+        request, authset=authset, scope=scope
+    )[klass.__name__]["objects"].filter(
+        **filters
+    ).values_list(*fields, flat=len(fields) == 1)
+
+
+def _log_stored_update(klass, old, updatevalues):
+    """ logs the update of a storedUpdate, flexid changes replace it """
+    from ...constants import ChangeOperation
+    from ..utils.changes import log_changes
+
+    if klass is Content:
+        cluster_id, content_id = old.cluster_id, old.id
+    else:
+        cluster_id, content_id = old.id, None
+    flexid = updatevalues.get("flexid", old.flexid)
+    if flexid != old.flexid:
+        log_changes(
+            [(cluster_id, content_id, old.flexid, None)],
+            ChangeOperation.delete,
+        )
+        operation = ChangeOperation.create
+    else:
+        operation = ChangeOperation.update
+    log_changes(
+        [(cluster_id, content_id, flexid, updatevalues["updateId"])],
+        operation,
+    )
 
 
 @lru_cache()
@@ -46,7 +84,7 @@ class ActionHandler():
     @classmethod
     def handle_action(cls, sender, action_dict, **kwargs):
         return getattr(
-            cls, "do_%s" % action_dict["action"], "default"
+            cls, "do_%s" % action_dict["action"], cls.default
         )(action_dict, sender=sender, **kwargs)
 
     @classmethod
@@ -63,20 +101,21 @@ class ActionHandler():
         return None
 
     @staticmethod
-    def do_view(action_dict, scope, sender, accesslevel, action, **kwargs):
+    def do_view(
+        action_dict, scope, sender, accesslevel, action, policy=None,
+        **kwargs
+    ):
         if accesslevel > 1 or scope != "view":
             return None
         if issubclass(sender, Content):
-            excl_filters = Q()
-            for i in action_dict["excludeTags"]:
-                excl_filters |= Q(tags__tag__startswith=i)
-
-            incl_filters = Q()
-            for i in action_dict["includeTags"]:
-                incl_filters |= Q(tags__tag__startswith=i)
-
+            if not policy:
+                policy = ActionPolicy.compile(action_dict)
             return {
-                "filters": ~excl_filters & incl_filters,
+                "filters": policy.view_filters,
+                "unrestricted": not (
+                    action_dict.get("includeTags")
+                    or action_dict.get("excludeTags")
+                ),
                 "accesslevel": 1
             }
         return None
@@ -227,15 +266,14 @@ class ActionHandler():
             references = dict(map(lambda x: (x["target"], x), references))
         for _flexid, _id in _only_owned_helper(
             Content, references.keys(), request,
-            fields=("flexid",),
+            fields=("flexid", "id"),
             authset=authset
         ):
+            ref = references[str(_flexid)]
             result["form"]["injectReferences"].append({
                 "target": _id,
-                "group": references[_flexid].get("group", ""),
-                "deleteRecursive": references[_flexid].get(
-                    "deleteRecursive", True
-                )
+                "group": ref.get("group", ""),
+                "deleteRecursive": ref.get("deleteRecursive", True)
             })
         if action_dict.get("requiredKeys"):
             result["form"]["requiredKeys"] = list(_only_owned_helper(
@@ -266,6 +304,9 @@ class ActionHandler():
             )
         return {
             "filters": ~excl_filters,
+            "unrestricted": not any(
+                action_dict["exclude"][x] for x in ("Cluster", type_name)
+            ),
             "accesslevel": 2,
             "form": {
                 "requiredKeys": [],
@@ -331,11 +372,33 @@ class ActionHandler():
                         id__in=action_dict["delete"][type_name]
                     ).update(markForDestruction=mintime)
             for _id, updatevalues in action_dict["update"][type_name].items():
+                # action_dict is shared, don't modify it
+                updatevalues = dict(updatevalues)
                 updatevalues.pop("id", None)
                 updatevalues.pop("cluster", None)
                 updatevalues.pop("references", None)
                 updatevalues.pop("referencedBy", None)
+                if "flexid" in updatevalues and not updatevalues["flexid"]:
+                    # autogenerate new flexid
+                    updatevalues["flexid"] = uuid4()
+                # update bypasses pre_save of the index fields
+                for field in klass._meta.concrete_fields:
+                    if (
+                        isinstance(field, HashIndexField)
+                        and field.source in updatevalues
+                    ):
+                        updatevalues[field.attname] = hash_index(
+                            updatevalues[field.source]
+                        )
+                if klass is Action:
+                    klass.objects.filter(id=_id).update(**updatevalues)
+                    continue
+                old = klass.objects.filter(id=_id).first()
+                if not old:
+                    continue
+                updatevalues["updateId"] = uuid4()
                 klass.objects.filter(id=_id).update(**updatevalues)
+                _log_stored_update(klass, old, updatevalues)
         return None
 
     @staticmethod
@@ -416,5 +479,5 @@ class ActionHandler():
                 if _id in _del_sets[type_name]:
                     continue
                 result["update"][type_name][_id] = \
-                    update_mapper[type_name][_flexid]
+                    update_mapper[type_name][str(_flexid)]
         return result
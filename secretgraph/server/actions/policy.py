@@ -0,0 +1,110 @@
+__all__ = ["ActionPolicy", "get_action_policy", "freeze"]
+
+import base64
+import json
+import re
+import threading
+from collections import OrderedDict
+from types import MappingProxyType
+from typing import NamedTuple, Optional, Pattern
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.db.models import Q
+
+_policy_cache = OrderedDict()
+_policy_cache_lock = threading.Lock()
+
+
+def freeze(obj):
+    """ recursively converts dicts and lists into read-only types """
+    if isinstance(obj, dict):
+        return MappingProxyType({k: freeze(v) for k, v in obj.items()})
+    elif isinstance(obj, (list, tuple)):
+        return tuple(map(freeze, obj))
+    return obj
+
+
+def _compile_tag_matcher(allowed):
+    if allowed is None:
+        return None
+    return re.compile(
+        "^(?:%s)(?:(?<==)|$)" % "|".join(map(re.escape, allowed))
+    )
+
+
+def _compile_view_filters(action_dict):
+    if action_dict.get("action") != "view":
+        return None
+    excl_filters = Q()
+    for i in action_dict.get("excludeTags") or []:
+        excl_filters |= Q(tags__tag__startswith=i)
+
+    incl_filters = Q()
+    for i in action_dict.get("includeTags") or []:
+        incl_filters |= Q(tags__tag__startswith=i)
+    return ~excl_filters & incl_filters
+
+
+class ActionPolicy(NamedTuple):
+    """ Decrypted and precompiled action, shared between requests """
+    action: str
+    # read-only action payload
+    action_dict: MappingProxyType
+    # read-only form, empty for actions without form (e.g. manage)
+    form: MappingProxyType
+    # compiled from allowedTags of form, None if all tags are allowed
+    tag_matcher: Optional[Pattern]
+    # filters of view actions
+    view_filters: Optional[Q]
+
+    @classmethod
+    def compile(cls, action_dict):
+        form = action_dict.get("form") or {}
+        return cls(
+            action=action_dict["action"],
+            action_dict=freeze(action_dict),
+            form=freeze(form),
+            tag_matcher=_compile_tag_matcher(form.get("allowedTags")),
+            view_filters=_compile_view_filters(action_dict),
+        )
+
+    def filter_tags(self, tags):
+        """ injected tags and the tags allowed by form """
+        injected = self.form.get("injectedTags") or ()
+        if tags is None:
+            return list(injected)
+        if self.tag_matcher:
+            tags = filter(self.tag_matcher.match, tags)
+        return [*injected, *tags]
+
+    def filter_references(self, references):
+        injected = self.form.get("injectReferences") or ()
+        # references are modified later
+        return [*map(dict, injected), *(references or [])]
+
+
+def get_action_policy(action, action_key):
+    """
+    Returns the ActionPolicy of action, decrypts only on cache misses
+    action_key must be already verified via action.keyHash
+    """
+    cache_key = (action.id, action.nonce, action.keyHash)
+    with _policy_cache_lock:
+        policy = _policy_cache.get(cache_key)
+        if policy is not None:
+            _policy_cache.move_to_end(cache_key)
+            return policy
+    action_dict = json.loads(
+        AESGCM(action_key).decrypt(
+            base64.b64decode(action.nonce), bytes(action.value), None
+        )
+    )
+    policy = ActionPolicy.compile(action_dict)
+    with _policy_cache_lock:
+        _policy_cache[cache_key] = policy
+        while len(_policy_cache) > getattr(
+            settings, "SECRETGRAPH_ACTION_POLICY_CACHE_SIZE", 1024
+        ):
+            _policy_cache.popitem(last=False)
+    return policy
@@ -10,11 +10,16 @@ from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from django.db.models import Q
 from django.utils import timezone
 
-from ...utils.auth import retrieve_allowed_objects
-from ...utils.misc import hash_object, refresh_fields
+from ...utils.auth import initializeCachedResult
+from ...utils.misc import hash_index, hash_object, refresh_fields
 from ...actions.handler import ActionHandler
 from ...models import Action, Content, Cluster, ContentAction
 
+# fields written by action updates
+_action_fields = [
+    "cluster", "keyHash", "keyHashIndex", "nonce", "value", "start", "stop"
+]
+
 
 def create_actions_fn(
     obj, actionlist, request, default_key=None, authset=None
@@ -44,7 +49,23 @@ def create_actions_fn(
     else:
         raise ValueError("Invalid type")
 
-    result = retrieve_allowed_objects(request, "manage", cluster.actions.all())
+    # authorization result is shared with the ActionHandler.clean_* methods
+    result = initializeCachedResult(
+        request, authset=authset, scope="manage"
+    )["Action"]["objects"].filter(cluster_id=cluster.pk)
+    # resolve all modified actions in one query
+    update_ids = {
+        str(x["idOrHash"]) for x in actionlist
+        if x.get("idOrHash") and x["value"] != "delete"
+    }
+    update_actions = {}
+    if update_ids:
+        for actionObj in result.filter(
+            Q(id__in=[x for x in update_ids if str(x).isdigit()]) |
+            Q(keyHash__in=update_ids)
+        ):
+            update_actions[str(actionObj.id)] = actionObj
+            update_actions[actionObj.keyHash] = actionObj
 
     for action in actionlist:
         if action["value"] == "delete":
@@ -80,13 +101,7 @@ def create_actions_fn(
         # add content_action
         group = action_value.pop("contentActionGroup", "") or ""
         if action.get("idOrHash"):
-            actionObj = (
-                result["objects"]
-                .filter(
-                    Q(id=action["idOrHash"]) | Q(keyHash=action["idOrHash"])
-                )
-                .first()
-            )
+            actionObj = update_actions.get(str(action["idOrHash"]))
             if not actionObj:
                 continue
         elif content:
@@ -101,6 +116,7 @@ def create_actions_fn(
         actionObj.start = action.get("start", timezone.now())
         actionObj.stop = action.get("start", None)
         actionObj.keyHash = action_key_hash
+        actionObj.keyHashIndex = hash_index(action_key_hash)
         actionObj.nonce = base64.b64encode(nonce).decode("ascii")
         actionObj.cluster = cluster
         actionObj.action_type = action_value["action"]
@@ -128,7 +144,7 @@ def create_actions_fn(
         with context:
             if not create and delete_q:
                 # delete old actions of obj, if allowed to
-                actions = result["objects"].filter(delete_q)
+                actions = result.filter(delete_q)
                 if content:
                     # recursive deletion
                     ContentAction.objects.filter(
@@ -158,10 +174,13 @@ def create_actions_fn(
                                 lambda x: x.contentAction,
                                 modify_actions.values(),
                             )
-                        ]
+                        ],
+                        ["group"],
                     )
                 Action.objects.bulk_create(add_actions)
-                Action.objects.bulk_update(modify_actions.values())
+                Action.objects.bulk_update(
+                    modify_actions.values(), _action_fields
+                )
 
     setattr(save_fn, "actions", [*add_actions, *modify_actions.values()])
     setattr(save_fn, "action_types", action_types)
@@ -5,20 +5,24 @@ from contextlib import nullcontext
 from uuid import UUID, uuid4
 
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.base import ContentFile, File
 from rdflib import RDF, BNode, Graph
 
-from ....constants import CLUSTER
-from ...utils.misc import get_secrets, hash_object
+from ....constants import CLUSTER, ChangeOperation
+from ...utils.changes import log_cluster_changes
+from ...utils.delete import enqueue_file_deletions
+from ...utils.misc import get_secrets, hash_object, swap_update_id
 from ...models import Cluster
 from ._actions import create_actions_fn
 from ._contents import create_key_fn
 
-len_default_hash = len(hash_object(b""))
+# fields written by cluster updates
+_cluster_fields = ["user", "public", "publicInfo"]
 
 
-def _update_or_create_cluster(request, cluster, objdata, authset):
+def _update_or_create_cluster(
+    request, cluster, objdata, authset, updateId=None
+):
     created = not cluster.id
     if objdata.get("publicInfo"):
         if isinstance(objdata["publicInfo"], bytes):
@@ -54,17 +58,33 @@ def _update_or_create_cluster(request, cluster, objdata, authset):
             def cluster_save_fn():
                 cluster.updateId = uuid4()
                 cluster.publicInfo.save("", objdata["publicInfo"])
+                return True
 
         else:
 
             def cluster_save_fn():
+                oldfile = cluster.publicInfo.name
                 cluster.updateId = uuid4()
-                cluster.publicInfo.delete(False)
-                cluster.publicInfo.save("", objdata["publicInfo"])
+                cluster.publicInfo.save("", objdata["publicInfo"], save=False)
+                if updateId is None:
+                    cluster.save()
+                elif not swap_update_id(cluster, updateId, _cluster_fields):
+                    # not referenced by anyone
+                    cluster.publicInfo.storage.delete(cluster.publicInfo.name)
+                    return False
+                enqueue_file_deletions([oldfile])
+                return True
 
     elif cluster.id is not None:
         public_secret_hashes = {}
-        cluster_save_fn = cluster.save
+
+        def cluster_save_fn():
+            cluster.updateId = uuid4()
+            if updateId is None:
+                cluster.save()
+                return True
+            return swap_update_id(cluster, updateId, _cluster_fields)
+
     else:
         raise ValueError("no publicInfo")
 
@@ -86,14 +106,22 @@ def _update_or_create_cluster(request, cluster, objdata, authset):
             raise ValueError('"manage" action cannot be public')
 
         def save_fn():
-            cluster_save_fn()
+            # with updateId: proceed only if the compare-and-swap succeeded
+            if not cluster_save_fn():
+                return None
             action_save_fn()
+            log_cluster_changes(
+                [cluster],
+                ChangeOperation.create if created else ChangeOperation.update,
+            )
             return cluster
 
     elif cluster.id is not None and not public_secret_hashes:
         # is not newly created and has also no new public_secret_hashes
         def save_fn():
-            cluster_save_fn()
+            if not cluster_save_fn():
+                return None
+            log_cluster_changes([cluster], ChangeOperation.update)
             return cluster
 
     else:
@@ -155,20 +183,19 @@ def update_cluster_fn(
         cluster.user = user
 
     cluster_fn = _update_or_create_cluster(
-        request, cluster, objdata, authset=authset
+        request, cluster, objdata, authset=authset, updateId=updateId
     )
 
     def save_fn(context=nullcontext):
         if callable(context):
             context = context()
         with context:
-            try:
-                Cluster.objects.get(id=cluster.id, updateId=updateId)
-            except ObjectDoesNotExist:
+            result = cluster_fn()
+            if not result:
                 return {
                     "cluster": Cluster.objects.filter(id=cluster.id).first(),
                     "writeok": False,
                 }
-            return {"cluster": cluster_fn(), "writeok": True}
+            return {"cluster": result, "writeok": True}
 
     return save_fn
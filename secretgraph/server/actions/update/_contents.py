@@ -1,4 +1,9 @@
-__all__ = ["create_content_fn", "update_content_fn", "create_key_fn"]
+__all__ = [
+    "create_content_fn",
+    "update_content_fn",
+    "create_key_fn",
+    "bulk_create_contents_fn",
+]
 
 
 import base64
@@ -10,21 +15,45 @@ from uuid import UUID, uuid4
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.serialization import load_der_public_key
-from django.core.exceptions import ObjectDoesNotExist
 from django.core.files.base import ContentFile, File
-from django.db.models import OuterRef, Q, Subquery
+from django.conf import settings
+from django.db.models import OuterRef, Subquery
 from graphql_relay import from_global_id, to_global_id
 
+from ....constants import ChangeOperation
 from ...utils.auth import id_to_result, initializeCachedResult
+from ...utils.changes import log_changes, log_content_changes
+from ...utils.delete import enqueue_file_deletions
 from ...utils.encryption import default_padding, encrypt_into_file
-from ...utils.misc import calculate_hashes, hash_object, refresh_fields
+from ...utils.misc import (
+    calculate_hashes,
+    default_hash_length,
+    refresh_fields,
+    swap_update_id,
+)
+from ...utils.quota import account_usage, check_quota, content_size
 from ...models import Cluster, Content, ContentReference, ContentTag
 from ._actions import create_actions_fn
-from ._metadata import transform_references, transform_tags
+from ._metadata import (
+    resolve_bulk_targets,
+    sync_references,
+    sync_tags,
+    transform_references,
+    transform_tags,
+)
 
 logger = logging.getLogger(__name__)
 
-len_default_hash = len(hash_object(b""))
+# fields written by content updates
+_content_fields = [
+    "cluster",
+    "flexid",
+    "nonce",
+    "contentHash",
+    "contentHashIndex",
+    "file",
+    "size",
+]
 
 
 def _transform_key_into_dataobj(key_obj, content=None):
@@ -89,7 +118,7 @@ def _transform_key_into_dataobj(key_obj, content=None):
 
 
 def _update_or_create_content_or_key(
-    request, content, objdata, authset, is_key, required_keys
+    request, content, objdata, authset, is_key, required_keys, updateId=None
 ):
     if isinstance(objdata.get("cluster"), str):
         objdata["cluster"] = (
@@ -103,6 +132,8 @@ def _update_or_create_content_or_key(
             .filter(markForDestruction=None)
             .first()
         )
+    # for moving the usage to the new cluster
+    old_cluster_id = content.cluster_id
     if objdata.get("cluster"):
         content.cluster = objdata["cluster"]
     if not getattr(content, "cluster", None):
@@ -145,19 +176,60 @@ def _update_or_create_content_or_key(
             objdata["value"] = ContentFile(objdata["value"])
         elif isinstance(objdata["value"], str):
             objdata["value"] = ContentFile(base64.b64decode(objdata["value"]))
-        else:
+        elif not isinstance(objdata["value"], File):
             objdata["value"] = File(objdata["value"])
+        # else: keep uploads (temporary_file_path), the storage moves them
+        new_size = objdata["value"].size
+        # fail early, enforced again while saving
+        if create or old_cluster_id != content.cluster.id:
+            check_quota(content.cluster, new_size)
+        else:
+            check_quota(content.cluster, new_size - content_size(content))
 
         def save_fn_value():
-            content.file.delete(False)
+            oldfile = content.file.name
+            old_size = 0 if create else content_size(content)
+            # reserve quota before writing the file, runs in a transaction
+            if not create:
+                account_usage(old_cluster_id, -old_size, -1)
+            account_usage(content.cluster.id, new_size, 1, enforce=True)
             content.updateId = uuid4()
-            content.file.save("", objdata["value"])
+            try:
+                content.file.save("", objdata["value"], save=False)
+            finally:
+                # removes staged files which were not moved
+                objdata["value"].close()
+            content.size = new_size
+            if updateId is None:
+                content.save()
+            elif not swap_update_id(content, updateId, _content_fields):
+                # not referenced by anyone
+                content.file.storage.delete(content.file.name)
+                account_usage(content.cluster.id, -new_size, -1)
+                account_usage(old_cluster_id, old_size, 1)
+                return False
+            if oldfile:
+                enqueue_file_deletions([oldfile])
+            return True
 
     else:
 
         def save_fn_value():
+            moved = not create and old_cluster_id != content.cluster.id
+            if moved:
+                size = content_size(content)
+                account_usage(old_cluster_id, -size, -1)
+                account_usage(content.cluster.id, size, 1, enforce=True)
             content.updateId = uuid4()
-            content.save()
+            if updateId is None:
+                content.save()
+                return True
+            if not swap_update_id(content, updateId, _content_fields):
+                if moved:
+                    account_usage(content.cluster.id, -size, -1)
+                    account_usage(old_cluster_id, size, 1)
+                return False
+            return True
 
     tags_dict = None
     content_type = None
@@ -196,7 +268,7 @@ def _update_or_create_content_or_key(
     chash = objdata.get("contentHash")
     if chash is not None:
         # either blank or in length of default hash output
-        if len(chash) not in (0, len_default_hash):
+        if len(chash) not in (0, default_hash_length()):
             raise ValueError("Invalid hashing algorithm used for contentHash")
         if chash == "":
             content.contentHash = None
@@ -302,36 +374,64 @@ def _update_or_create_content_or_key(
             pass
 
     def save_fn():
-        save_fn_value()
+        if not content.flexid:
+            content.flexid = uuid4()
+        # with updateId: proceed only if the compare-and-swap succeeded
+        if not save_fn_value():
+            return {
+                "content": Content.objects.filter(id=content.id).first(),
+                "contentKey": None,
+                "writeok": False,
+            }
         if final_tags is not None:
+            # flexid is generated before saving, id tag is written together
+            # with the other tags
+            id_tag = ContentTag(
+                content=content,
+                tag="id=%s" % to_global_id("Content", content.flexid),
+            )
             if create:
                 ContentTag.objects.bulk_create(
-                    refresh_fields(final_tags, "content")
+                    refresh_fields(chain(final_tags, [id_tag]), "content")
                 )
             else:
-                # simply ignore id=, can only be changed in regenerateFlexid
-                content.tags.exclude(Q(tag__startswith="id=")).delete()
-                ContentTag.objects.bulk_create(final_tags)
-
-        # create id tag after object was created or update it
-        content.tags.update_or_create(
-            defaults={
-                "tag": "id=%s" % to_global_id("Content", content.flexid)
-            },
-            tag__startswith="id=",
-        )
+                sync_tags(content, chain(final_tags, [id_tag]))
         if final_references is not None:
-            if not create:
-                if is_key:
-                    refs = content.references.exclude(group="public_key")
-                else:
-                    refs = content.references.all()
-                refs.delete()
-            # must refresh in case a new target is injected and saved before
-            ContentReference.objects.bulk_create(
-                refresh_fields(final_references, "source", "target")
-            )
+            if create:
+                # must refresh in case a new target is injected and saved
+                # before
+                ContentReference.objects.bulk_create(
+                    refresh_fields(final_references, "source", "target")
+                )
+            else:
+                sync_references(
+                    content,
+                    final_references,
+                    exclude_groups={"public_key"} if is_key else (),
+                )
         actions_save_fn()
+        if create:
+            log_content_changes([content], ChangeOperation.create)
+        else:
+            if old_cluster_id != content.cluster_id:
+                # tombstone in the feed of the old cluster
+                log_changes(
+                    [
+                        (
+                            old_cluster_id,
+                            content.id,
+                            content.flexid,
+                            content.updateId,
+                        )
+                    ],
+                    ChangeOperation.delete,
+                )
+            log_content_changes(
+                [content],
+                ChangeOperation.update
+                if objdata.get("value")
+                else ChangeOperation.metadata,
+            )
         return {
             "content": content,
             "contentKey": (
@@ -342,6 +442,12 @@ def _update_or_create_content_or_key(
         }
 
     setattr(save_fn, "content", content)
+    # rows for bulk_create_contents_fn
+    setattr(save_fn, "value", objdata.get("value"))
+    setattr(save_fn, "tags", final_tags)
+    setattr(save_fn, "references", final_references)
+    setattr(save_fn, "actions_save_fn", actions_save_fn)
+    setattr(save_fn, "inner_key", inner_key)
     return save_fn
 
 
@@ -483,21 +589,164 @@ def update_content_fn(
         }
     newdata["actions"] = objdata.get("actions")
     func = _update_or_create_content_or_key(
-        request, content, newdata, authset, is_key, required_keys or []
+        request,
+        content,
+        newdata,
+        authset,
+        is_key,
+        required_keys or [],
+        updateId=updateId,
     )
 
     def save_fn(context=nullcontext):
         if callable(context):
             context = context()
         with context:
+            return {"writeok": True, **func()}
+
+    return save_fn
+
+
+def bulk_create_contents_fn(
+    request, cluster, objdatas, authset=None, required_keys=None
+):
+    """
+    Validates contents for one (already authorized) cluster, save_fn writes
+    the valid ones with one bulk_create per table
+    Invalid contents are skipped and reported with an error
+    """
+    limit = getattr(settings, "SECRETGRAPH_BULK_LIMIT", 500)
+    if len(objdatas) > limit:
+        raise ValueError("Too many contents (>%d)" % limit)
+    results = []
+    prepared = []
+    content_hashes = set()
+    # the targets of all contents are resolved together
+    references_list = resolve_bulk_targets(
+        map(lambda x: x.get("references"), objdatas),
+        initializeCachedResult(request, authset=authset)["Content"][
+            "objects"
+        ],
+    )
+    for objdata, references in zip(objdatas, references_list):
+        value_obj = objdata.get("value")
+        try:
+            if not value_obj:
+                raise ValueError("Requires value")
+            if isinstance(references, ValueError):
+                raise references
+            if objdata.get("contentHash"):
+                if objdata["contentHash"] in content_hashes:
+                    raise ValueError("Duplicate contentHash")
+                content_hashes.add(objdata["contentHash"])
+            _save_fn = _update_or_create_content_or_key(
+                request,
+                Content(),
+                {
+                    "cluster": cluster,
+                    "references": references,
+                    "contentHash": objdata.get("contentHash"),
+                    "actions": objdata.get("actions"),
+                    **value_obj,
+                },
+                authset,
+                False,
+                required_keys or [],
+            )
+        except ValueError as exc:
+            results.append({"content": None, "error": str(exc)})
+        else:
+            results.append(_save_fn)
+            prepared.append(_save_fn)
+    # fail early, enforced again while saving
+    check_quota(cluster, sum(map(lambda x: x.value.size, prepared)))
+
+    def save_fn(context=nullcontext):
+        if callable(context):
+            context = context()
+        with context:
+            # reserve quota before writing the files
+            account_usage(
+                cluster.id,
+                sum(map(lambda x: x.value.size, prepared)),
+                len(prepared),
+                enforce=True,
+            )
+            contents = []
             try:
-                Content.objects.get(id=content.id, updateId=updateId)
-            except ObjectDoesNotExist:
-                return {
-                    "content": Content.objects.filter(id=content.id).first(),
-                    "contentKey": None,
-                    "writeok": False,
-                }
-            return {**func(), "writeok": True}
+                for _save_fn in prepared:
+                    content = _save_fn.content
+                    content.flexid = uuid4()
+                    content.updateId = uuid4()
+                    content.file.save("", _save_fn.value, save=False)
+                    content.size = _save_fn.value.size
+                    contents.append(content)
+                Content.objects.bulk_create(contents)
+            except Exception:
+                # nothing references the files
+                for content in contents:
+                    content.file.storage.delete(content.file.name)
+                raise
+            finally:
+                # removes staged files which were not moved
+                for _save_fn in prepared:
+                    _save_fn.value.close()
+            if contents and contents[0].id is None:
+                # backend cannot return ids of bulk inserts
+                ids = dict(
+                    Content.objects.filter(
+                        flexid__in=map(lambda x: x.flexid, contents)
+                    ).values_list("flexid", "id")
+                )
+                for content in contents:
+                    content.id = ids[content.flexid]
+            ContentTag.objects.bulk_create(
+                refresh_fields(
+                    chain.from_iterable(
+                        chain(
+                            _save_fn.tags,
+                            [
+                                ContentTag(
+                                    content=_save_fn.content,
+                                    tag="id=%s"
+                                    % to_global_id(
+                                        "Content", _save_fn.content.flexid
+                                    ),
+                                )
+                            ],
+                        )
+                        for _save_fn in prepared
+                    ),
+                    "content",
+                )
+            )
+            ContentReference.objects.bulk_create(
+                refresh_fields(
+                    chain.from_iterable(
+                        map(lambda x: x.references, prepared)
+                    ),
+                    "source",
+                    "target",
+                )
+            )
+            for _save_fn in prepared:
+                _save_fn.actions_save_fn()
+            log_content_changes(contents, ChangeOperation.create)
+            return {
+                "results": [
+                    result
+                    if isinstance(result, dict)
+                    else {
+                        "content": result.content,
+                        "contentKey": (
+                            base64.b64encode(result.inner_key).decode("ascii")
+                            if result.inner_key
+                            else None
+                        ),
+                    }
+                    for result in results
+                ],
+                "writeok": True,
+            }
 
     return save_fn
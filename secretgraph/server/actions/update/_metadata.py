@@ -1,29 +1,40 @@
 
 __all__ = [
     "transform_tags", "extract_key_hashes", "transform_references",
-    "update_metadata_fn"
+    "sync_tags", "sync_references", "update_metadata_fn",
+    "bulk_update_metadata_fn"
 ]
 
 import logging
-from uuid import uuid4
+from uuid import UUID, uuid4
 import re
 from contextlib import nullcontext
 
-from django.db.models import OuterRef, Q, Subquery
+from django.db.models import Q
+from django.utils import timezone
 from graphql_relay import from_global_id
 
-from ....constants import MetadataOperations
+from ....constants import ChangeOperation, MetadataOperations
 from ...utils.auth import initializeCachedResult
-from ...utils.misc import hash_object
+from ...utils.changes import log_changes, log_content_changes
+from ...utils.delete import _batched
+from ...utils.misc import default_hash_length
 from ...models import Content, ContentReference, ContentTag
 
 logger = logging.getLogger(__name__)
 
-len_default_hash = len(hash_object(b""))
 
 denied_remove_filter = re.compile(
     "^(?:id|state|type)=?"
 )
+# tags which are checked against keys and references
+denied_bulk_filter = re.compile(
+    "^(?:id|type|key_hash|key)(?:=|$)"
+)
+# tags which must not be removed by prefixes in bulk
+denied_bulk_remove_filter = re.compile(
+    "^(?:id|type|key_hash|key|state)(?:=|$)"
+)
 
 
 def extract_key_hashes(tags):
@@ -34,7 +45,7 @@ def extract_key_hashes(tags):
             tag = tag.tag
         splitted_tag = tag.split("=", 1)
         if splitted_tag[0] == "key_hash":
-            if len_default_hash == len(splitted_tag[1]):
+            if default_hash_length() == len(splitted_tag[1]):
                 key_hashes.add(splitted_tag[1])
         elif splitted_tag[0] == "type":
             content_type = splitted_tag[1]
@@ -83,7 +94,7 @@ def transform_tags(tags, oldtags=None, operation=MetadataOperations.append):
             if len(splitted_tag) == 1:
                 raise ValueError("key_hash should be tag not flag")
             new_had_keyhash = True
-            if len_default_hash == len(splitted_tag[1]):
+            if default_hash_length() == len(splitted_tag[1]):
                 key_hashes.add(splitted_tag[1])
         if len(tag) > 8000:
             raise ValueError("Tag too big")
@@ -113,7 +124,7 @@ def transform_tags(tags, oldtags=None, operation=MetadataOperations.append):
             elif splitted_tag[0] == "key_hash":
                 if operation == MetadataOperations.replace and new_had_keyhash:
                     continue
-                if len_default_hash == len(splitted_tag[1]):
+                if default_hash_length() == len(splitted_tag[1]):
                     key_hashes.add(splitted_tag[1])
 
             if len(splitted_tag) == 2:
@@ -136,6 +147,138 @@ def transform_tags(tags, oldtags=None, operation=MetadataOperations.append):
     return newtags, key_hashes
 
 
+def _normalize_reference(ref, ids, flexids, key_hashes):
+    """
+    Normalizes the target of ref and collects it in ids, flexids or
+    key_hashes
+    """
+    if isinstance(ref, ContentReference):
+        ids.add(ref.target_id)
+    elif not isinstance(ref["target"], Content):
+        type_name = "Content"
+        try:
+            type_name, ref["target"] = from_global_id(ref["target"])
+        except Exception:
+            pass
+        if type_name != "Content":
+            raise ValueError("No Content Id")
+        if isinstance(ref["target"], int):
+            ids.add(ref["target"])
+        else:
+            try:
+                ref["target"] = str(UUID(ref["target"]))
+                flexids.add(ref["target"])
+            except ValueError:
+                key_hashes.add(ref["target"])
+    return ref
+
+
+def _fetch_targets(ids, flexids, key_hashes, allowed_targets):
+    """
+    Fetches the targets in at most two queries
+    Returns (targets by id or flexid, PublicKey targets by key hash)
+    """
+    allowed_targets = allowed_targets.filter(markForDestruction=None)
+    targets = {}
+    if ids or flexids:
+        for targetob in allowed_targets.filter(
+            Q(id__in=ids) | Q(flexid__in=flexids)
+        ):
+            targets[targetob.id] = targetob
+            targets[str(targetob.flexid)] = targetob
+    targets_by_hash = {}
+    if key_hashes:
+        for tagob in (
+            ContentTag.objects.filter(
+                tag__in=map(lambda x: f"key_hash={x}", key_hashes),
+                content__in=allowed_targets.filter(
+                    tags__tag="type=PublicKey"
+                ),
+            )
+            .select_related("content")
+            .order_by("content_id")
+        ):
+            targets_by_hash.setdefault(
+                tagob.tag.split("=", 1)[1], tagob.content
+            )
+    return targets, targets_by_hash
+
+
+def _lookup_target(target, targets, targets_by_hash):
+    if isinstance(target, Content):
+        return target
+    if isinstance(target, int):
+        return targets.get(target)
+    return targets.get(target) or targets_by_hash.get(target)
+
+
+def _resolve_targets(references, allowed_targets):
+    """
+    Resolves all reference targets in at most two queries
+    Returns (references with normalized targets, targets by id or flexid,
+             PublicKey targets by key hash)
+    """
+    ids = set()
+    flexids = set()
+    key_hashes = set()
+    normalized = [
+        _normalize_reference(ref, ids, flexids, key_hashes)
+        for ref in references or []
+    ]
+    return (
+        normalized,
+        *_fetch_targets(ids, flexids, key_hashes, allowed_targets),
+    )
+
+
+def resolve_bulk_targets(references_list, allowed_targets):
+    """
+    Resolves the reference targets of many contents together in at most
+    two queries
+    Returns list with the references with Content targets (unresolvable
+    targets are removed like in transform_references) or the ValueError
+    of the invalid references
+    """
+    ids = set()
+    flexids = set()
+    key_hashes = set()
+    normalized = []
+    for references in references_list:
+        if references is None:
+            normalized.append(None)
+            continue
+        try:
+            normalized.append(
+                [
+                    _normalize_reference(ref, ids, flexids, key_hashes)
+                    for ref in references
+                ]
+            )
+        except ValueError as exc:
+            normalized.append(exc)
+    targets, targets_by_hash = _fetch_targets(
+        ids, flexids, key_hashes, allowed_targets
+    )
+    results = []
+    for references in normalized:
+        if not isinstance(references, list):
+            results.append(references)
+            continue
+        resolved = []
+        for ref in references:
+            if isinstance(ref, ContentReference):
+                targetob = targets.get(ref.target_id)
+                if targetob:
+                    ref.target = targetob
+                    resolved.append(ref)
+                continue
+            targetob = _lookup_target(ref["target"], targets, targets_by_hash)
+            if targetob:
+                resolved.append({**ref, "target": targetob})
+        results.append(resolved)
+    return results
+
+
 def transform_references(
     content, references, key_hashes_tags, allowed_targets,
     no_final_refs=False
@@ -145,45 +288,18 @@ def transform_references(
     sig_target_hashes = set()
     encrypt_target_hashes = set()
     deduplicate = set()
-    for ref in references or []:
+    references, targets, targets_by_hash = _resolve_targets(
+        references, allowed_targets
+    )
+    for ref in references:
         if isinstance(ref, ContentReference):
             refob = ref
-            if not allowed_targets.filter(
-                id=refob.target_id, markForDestruction=None
-            ).exists():
+            targetob = targets.get(refob.target_id)
+            if not targetob:
                 continue
+            refob.target = targetob
         else:
-            if isinstance(ref["target"], Content):
-                targetob = ref["target"]
-            else:
-                type_name = "Content"
-                try:
-                    type_name, ref["target"] = from_global_id(ref["target"])
-                except Exception:
-                    pass
-                if type_name != "Content":
-                    raise ValueError("No Content Id")
-                if isinstance(ref["target"], int):
-                    q = Q(id=ref["target"])
-                else:
-                    _refs = Subquery(
-                        ContentTag.objects.filter(
-                            # for correct chaining
-                            tag="type=PublicKey",
-                            content_id=OuterRef("pk"),
-                            content__tags__tag=f"key_hash={ref['target']}"
-                        ).values("pk")
-                    )
-                    # the direct way doesn't work
-                    # subquery is necessary for chaining operations correctly
-                    q = (
-                        Q(tags__tag=f"id={ref['target']}") |
-                        Q(tags__in=_refs)
-                    )
-
-                targetob = allowed_targets.filter(
-                    q, markForDestruction=None
-                ).first()
+            targetob = _lookup_target(ref["target"], targets, targets_by_hash)
             if not targetob:
                 continue
             refob = ContentReference(
@@ -193,9 +309,9 @@ def transform_references(
                 extra=ref.get("extra") or ""
             )
         # first extra tag in same group  with same target wins
-        if (refob.group, refob.target.id) in deduplicate:
+        if (refob.group, targetob.id) in deduplicate:
             continue
-        deduplicate.add((refob.group, refob.target.id))
+        deduplicate.add((refob.group, targetob.id))
         if len(refob.extra) > 8000:
             raise ValueError("Extra tag too big")
         if refob.group == "signature":
@@ -212,6 +328,60 @@ def transform_references(
     return final_references, encrypt_target_hashes, sig_target_hashes
 
 
+def sync_tags(content, tags):
+    """
+    Writes only the difference between the current and the new tags
+    id= tags are kept, they can only be changed in regenerateFlexid
+    """
+    new_tags = set(
+        map(lambda x: x.tag if isinstance(x, ContentTag) else x, tags)
+    )
+    old_tags = dict(content.tags.values_list("tag", "id"))
+    remove_ids = [
+        _id for tag, _id in old_tags.items()
+        if tag not in new_tags and not tag.startswith("id=")
+    ]
+    if remove_ids:
+        ContentTag.objects.filter(id__in=remove_ids).delete()
+    ContentTag.objects.bulk_create(
+        (
+            ContentTag(content=content, tag=tag)
+            for tag in new_tags.difference(old_tags.keys())
+        ),
+        ignore_conflicts=True
+    )
+
+
+def sync_references(content, references, exclude_groups=()):
+    """
+    Writes only the difference between the current and the new references
+    references in exclude_groups are not touched
+    """
+    old_refs = {
+        (group, target_id): (_id, extra, deleteRecursive)
+        for _id, group, target_id, extra, deleteRecursive in
+        content.references.exclude(group__in=exclude_groups).values_list(
+            "id", "group", "target_id", "extra", "deleteRecursive"
+        )
+    }
+    keep_ids = set()
+    new_refs = []
+    for ref in references:
+        old = old_refs.get((ref.group, ref.target.id))
+        if old and old[1:] == (ref.extra, ref.deleteRecursive):
+            keep_ids.add(old[0])
+            continue
+        # must refresh in case a new target is injected and saved before
+        ref.pk = None
+        ref.source = content
+        ref.target = ref.target
+        new_refs.append(ref)
+    remove_ids = [x[0] for x in old_refs.values() if x[0] not in keep_ids]
+    if remove_ids:
+        ContentReference.objects.filter(id__in=remove_ids).delete()
+    ContentReference.objects.bulk_create(new_refs, ignore_conflicts=True)
+
+
 def update_metadata_fn(
     request, content, *,
     tags=None, references=None, operation=MetadataOperations.append,
@@ -219,8 +389,6 @@ def update_metadata_fn(
 ):
     operation = operation or MetadataOperations.append
     final_tags = None
-    remove_tags_q = ~Q(tag__startswith="id=")
-    remove_refs_q = Q()
     if tags:
         oldtags = content.tags.values_list("tag", flat=True)
         tags_dict, key_hashes_tags = transform_tags(
@@ -247,33 +415,14 @@ def update_metadata_fn(
                     "%s is an invalid state for content", content_state
                 )
 
-        if operation in {
-            MetadataOperations.append, MetadataOperations.replace
-        }:
-            final_tags = []
-            for prefix, val in tags_dict.items():
-                if not val:
-                    remove_tags_q |= Q(tag__startswith=prefix)
-                    final_tags.append(ContentTag(
-                        content=content,
-                        tag=prefix
-                    ))
-                else:
-                    for subval in val:
-                        composed = "%s=%s" % (prefix, subval)
-                        remove_tags_q |= Q(tag__startswith=composed)
-                        final_tags.append(ContentTag(
-                            content=content,
-                            tag=composed
-                        ))
-        else:
-            for prefix, val in tags_dict.items():
-                if not val:
-                    remove_tags_q &= ~Q(tag__startswith=prefix)
-                else:
-                    for subval in val:
-                        composed = "%s=%s" % (prefix, subval)
-                        remove_tags_q &= ~Q(tag__startswith=composed)
+        # contains all tags after the operation
+        final_tags = []
+        for prefix, val in tags_dict.items():
+            if not val:
+                final_tags.append(prefix)
+            else:
+                for subval in val:
+                    final_tags.append("%s=%s" % (prefix, subval))
     else:
         kl = content.tags.filter(
             Q(tag__startswith="key_hash=") |
@@ -285,31 +434,22 @@ def update_metadata_fn(
         _refs = content.references.all()
     elif operation in {MetadataOperations.remove, MetadataOperations.replace}:
         _refs = []
-        if MetadataOperations.replace:
-            _refs = references
+        if operation == MetadataOperations.replace:
+            _refs = list(references)
         remrefs = set(map(
             lambda x: (x["group"], x["target"]),
             references
         ))
-        for ref in content.references.all():
-            if (ref.group, None) in remrefs:
-                remove_refs_q |= Q(
-                    id=ref.id
-                )
-                continue
-            elif (ref.group, ref.target_id) in remrefs:
-                remove_refs_q |= Q(
-                    id=ref.id
-                )
-                continue
-            elif (ref.group, ref.target.contentHash) in remrefs:
-                remove_refs_q |= Q(
-                    id=ref.id
-                )
+        for ref in content.references.select_related("target"):
+            if (
+                (ref.group, None) in remrefs or
+                (ref.group, ref.target_id) in remrefs or
+                (ref.group, ref.target.contentHash) in remrefs
+            ):
                 continue
             _refs.append(ref)
-    elif MetadataOperations.append:
-        # prefer old extra values, no problem with crashing as ignore_conflict
+    else:
+        # prefer old extra values, first reference wins
         _refs = [
             *content.references.all(),
             *references
@@ -343,26 +483,136 @@ def update_metadata_fn(
             content.updateId = uuid4()
             content.save(update_fields=["updateId"])
             if final_tags is not None:
-                if operation in {
-                    MetadataOperations.remove, MetadataOperations.replace
-                }:
-                    content.tags.filter(remove_tags_q).delete()
-                if operation in {
-                    MetadataOperations.append, MetadataOperations.replace
-                }:
-                    ContentTag.objects.bulk_create(
-                        final_tags, ignore_conflicts=True
-                    )
+                sync_tags(content, final_tags)
             if final_references is not None:
-                if operation in {
-                    MetadataOperations.remove, MetadataOperations.replace
-                }:
-                    content.references.filter(remove_refs_q).delete()
-                if operation in {
-                    MetadataOperations.append, MetadataOperations.replace
-                }:
-                    ContentReference.objects.bulk_create(
-                        final_references, ignore_conflicts=True
-                    )
+                sync_references(content, final_references)
+            log_content_changes([content], ChangeOperation.metadata)
             return content
     return save_fn
+
+
+def bulk_update_metadata_fn(
+    query, *, tags, operation=MetadataOperations.append, batch_size=1000
+):
+    """
+    Changes the tags of all contents in query with batched statements
+    instead of per content saves, only tags without checks against keys
+    and references can be changed
+    save_fn returns the amount of changed contents
+    """
+    operation = operation or MetadataOperations.append
+    tags = list(tags or [])
+    if not tags:
+        raise ValueError("No tags specified")
+    new_state = None
+    for tag in tags:
+        splitted_tag = tag.split("=", 1)
+        if not tag:
+            raise ValueError("Empty tag")
+        if denied_bulk_filter.match(tag):
+            raise ValueError(
+                "%s cannot be changed in bulk" % splitted_tag[0]
+            )
+        if len(tag) > 8000:
+            raise ValueError("Tag too big")
+        # remove matches prefixes, e.g. "s" would remove state tags
+        if operation == MetadataOperations.remove and "state".startswith(
+            splitted_tag[0]
+        ):
+            raise ValueError("state cannot be removed")
+        if splitted_tag[0] == "state":
+            if new_state is not None:
+                raise ValueError("state=<foo> is a unique tag")
+            elif len(splitted_tag) == 1:
+                raise ValueError("state should be tag not flag")
+            new_state = splitted_tag[1]
+    if new_state is not None:
+        if new_state not in {"draft", "public", "internal"}:
+            raise ValueError("%s is an invalid state" % new_state)
+        # skip contents for which the state is invalid
+        if new_state != "internal":
+            query = query.exclude(tags__tag="type=Config")
+        if new_state == "draft":
+            query = query.exclude(
+                tags__tag__in=["type=PublicKey", "type=PrivateKey"]
+            )
+
+    if operation == MetadataOperations.remove:
+        remove_filter = Q()
+        for tag in tags:
+            remove_filter |= Q(tag__startswith=tag)
+        # the prefixes could match them
+        remove_filter &= ~Q(tag__regex=denied_bulk_remove_filter.pattern)
+    else:
+        if operation == MetadataOperations.replace:
+            replaced = set(map(lambda x: x.split("=", 1)[0], tags))
+        else:
+            replaced = set()
+        if new_state is not None:
+            replaced.add("state")
+        remove_filter = None
+        if replaced:
+            remove_filter = Q()
+            for prefix in replaced:
+                remove_filter |= Q(tag=prefix) | Q(
+                    tag__startswith="%s=" % prefix
+                )
+
+    # tags which can be changed by the operation
+    changeable_filter = Q(tag__in=tags)
+    if remove_filter is not None:
+        changeable_filter |= remove_filter
+
+    def _changeable_tags(batch):
+        result = {}
+        for content_id, tag in ContentTag.objects.filter(
+            changeable_filter, content_id__in=batch
+        ).values_list("content_id", "tag"):
+            result.setdefault(content_id, set()).add(tag)
+        return result
+
+    def save_fn(context=nullcontext):
+        if callable(context):
+            context = context()
+        with context:
+            rows = list(
+                query.values_list("id", "cluster_id", "flexid").distinct()
+            )
+            # one updateId for all changed contents
+            updateId = uuid4()
+            now = timezone.now()
+            count = 0
+            for rows_batch in _batched(rows, batch_size):
+                batch = [x[0] for x in rows_batch]
+                before = _changeable_tags(batch)
+                if remove_filter is not None:
+                    ContentTag.objects.filter(
+                        remove_filter, content_id__in=batch
+                    ).delete()
+                if operation != MetadataOperations.remove:
+                    ContentTag.objects.bulk_create(
+                        [
+                            ContentTag(content_id=content_id, tag=tag)
+                            for content_id in batch
+                            for tag in tags
+                        ],
+                        ignore_conflicts=True
+                    )
+                after = _changeable_tags(batch)
+                # contents with tags already in the requested form
+                rows_batch = [
+                    x for x in rows_batch
+                    if before.get(x[0]) != after.get(x[0])
+                ]
+                if not rows_batch:
+                    continue
+                Content.objects.filter(
+                    id__in=[x[0] for x in rows_batch]
+                ).update(updateId=updateId, updated=now)
+                log_changes(
+                    map(lambda x: (x[1], x[0], x[2], updateId), rows_batch),
+                    ChangeOperation.metadata
+                )
+                count += len(rows_batch)
+            return count
+    return save_fn
@@ -3,6 +3,8 @@ __all__ = ["transfer_value"]
 import base64
 import json
 import logging
+import os
+import tempfile
 from uuid import uuid4
 from email.parser import BytesParser
 
@@ -10,12 +12,17 @@ import requests
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.conf import settings
+from django.core.files.base import File
 from django.db import transaction
 from django.db.models import Q
 from django.test import Client
 
-from ....constants import TransferResult
+from ....constants import ChangeOperation, TransferResult
+from ...utils.changes import log_content_changes
 from ...utils.conf import get_requests_params
+from ...utils.delete import enqueue_file_deletions
+from ...utils.quota import account_usage, content_size
 from ...models import Content, ContentTag
 
 from ._verification import retrieve_signatures, verify_signatures
@@ -48,6 +55,149 @@ def _generate_transfer_info(content, hashes_remote, signatures):
             )
 
 
+# checkpoint partial downloads every 4 MB
+_checkpoint_size = 4 * 1024 * 1024
+_chunk_size = 512
+
+
+def _get_partial_path(content):
+    try:
+        return "%s.partial" % content.file.storage.path(content.file.name)
+    except NotImplementedError:
+        return os.path.join(
+            settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir(),
+            "secretgraph-transfer-%s.partial" % content.id,
+        )
+
+
+def _load_partial_state(partial_path, url):
+    """
+    returns state of a resumable partial download or None
+    the partial file is truncated to the last checkpointed offset
+    """
+    try:
+        with open("%s.json" % partial_path, "r") as f:
+            state = json.load(f)
+        if state.get("url") != url or not state.get("validator"):
+            raise ValueError("partial download is not resumable")
+        with open(partial_path, "r+b") as f:
+            f.truncate(state["offset"])
+    except FileNotFoundError:
+        return None
+    except Exception as exc:
+        logger.warning("Discard partial download", exc_info=exc)
+        _clear_partial_state(partial_path)
+        return None
+    return state
+
+
+def _store_partial_state(partial_path, state):
+    tmp_path = "%s.json.tmp" % partial_path
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, "%s.json" % partial_path)
+
+
+def _clear_partial_state(partial_path):
+    for path in (partial_path, "%s.json" % partial_path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+
+class _PartialFile(File):
+    """
+    Finished partial download, filesystem storages move it via
+    temporary_file_path instead of copying
+    """
+
+    def temporary_file_path(self):
+        return self.file.name
+
+    def close(self):
+        try:
+            return self.file.close()
+        except FileNotFoundError:
+            # moved by storage
+            pass
+
+
+def _finish_partial(content, partial_path):
+    """
+    Stores the download under a new name (copy-on-write), the old file is
+    deleted after commit, so a rollback keeps the old file and nonce
+    """
+    oldfile = content.file.name
+    with _PartialFile(open(partial_path, "rb")) as f:
+        content.file.save("", f, save=False)
+    enqueue_file_deletions([oldfile])
+    _clear_partial_state(partial_path)
+
+
+def _get_validator(response, inline_domain):
+    """ validator for If-Range, the ETag or else Last-Modified """
+    return _get_header(response, "ETag", inline_domain) or _get_header(
+        response, "Last-Modified", inline_domain
+    )
+
+
+def _get_header(response, name, inline_domain):
+    if inline_domain:
+        return response.get(name, None)
+    return response.headers.get(name, None)
+
+
+def _iter_response(response, inline_domain):
+    if not inline_domain:
+        yield from response.iter_content(_chunk_size)
+    elif response.streaming:
+        yield from response.streaming_content
+    else:
+        yield response.content
+
+
+def _request(
+    url, headers, params, inline_domain, session, offset=0, validator=None
+):
+    headers = headers.copy()
+    if offset and validator:
+        headers["Range"] = "bytes=%d-" % offset
+        headers["If-Range"] = validator
+    if inline_domain:
+        return Client().get(
+            url,
+            SERVER_NAME=inline_domain,
+            **{
+                "HTTP_%s" % key.upper().replace("-", "_"): val
+                for key, val in headers.items()
+            }
+        )
+    return session.get(url, headers=headers, stream=True, **params)
+
+
+def _is_resumed(response, offset, inline_domain):
+    """
+    checks if response continues the partial download at offset
+    None means: no valid response at all
+    """
+    if response.status_code == 200:
+        return False
+    if response.status_code != 206 or not offset:
+        return None
+    content_range = _get_header(response, "Content-Range", inline_domain)
+    try:
+        unit, _range = content_range.split(" ", 1)
+        start = int(_range.split("-", 1)[0])
+    except Exception:
+        return None
+    if unit != "bytes" or start != offset:
+        return None
+    return True
+
+
 def transfer_value(
     content,
     key=None,
@@ -83,6 +233,8 @@ def transfer_value(
         except Exception as exc:
             logger.error("Error while decoding url, headers", exc_info=exc)
             return TransferResult.ERROR
+    if isinstance(url, bytes):
+        url = url.decode("utf8")
 
     if headers:
         if isinstance(headers, str):
@@ -100,24 +252,52 @@ def transfer_value(
     hashes_remote = []
     signatures = None
     blocked_contents = Content.objects.filter(q).select_for_update()
-    with transaction.atomic():
-        # 1. lock content, 2. check if content was deleted before updating
-        if not blocked_contents:
-            return TransferResult.ERROR
-        if inline_domain:
-            response = Client().get(url, SERVER_NAME=inline_domain, **_headers)
+    if inline_domain:
+        s = None
+    elif session:
+        s = session
+    else:
+        s = requests.Session()
+    partial_path = _get_partial_path(content)
+    try:
+        with transaction.atomic():
+            # 1. lock content, 2. check if content was deleted before updating
+            if not blocked_contents:
+                return TransferResult.ERROR
+            state = _load_partial_state(partial_path, url)
+            offset = state["offset"] if state else 0
+            response = _request(
+                url,
+                _headers,
+                params,
+                inline_domain,
+                s,
+                offset=offset,
+                validator=state and state["validator"],
+            )
+            resumed = _is_resumed(response, offset, inline_domain)
+            if resumed is None and offset and response.status_code != 404:
+                # invalid range response, restart download
+                offset = 0
+                response = _request(
+                    url, _headers, params, inline_domain, s
+                )
+                resumed = _is_resumed(response, offset, inline_domain)
             if response.status_code == 404:
+                _clear_partial_state(partial_path)
                 return TransferResult.NOTFOUND
-            elif response.status_code != 200:
+            elif resumed is None:
                 return TransferResult.ERROR
             # should be only one nonce
-            checknonce = response.get("X-NONCE", "")
-
+            checknonce = _get_header(response, "X-NONCE", inline_domain) or ""
             if checknonce != "":
                 if len(checknonce) != 20:
                     logger.warning("Invalid nonce (not 13 bytes)")
                     return TransferResult.ERROR
-                content.nonce = checknonce
+            if resumed and checknonce != state["nonce"]:
+                logger.warning("Nonce changed while resuming download")
+                _clear_partial_state(partial_path)
+                return TransferResult.ERROR
             if transfer and verifiers:
                 hashes_remote = [
                     *map(
@@ -125,82 +305,87 @@ def transfer_value(
                             getattr(hashes, x.strip().upper()),
                             default_backend(),
                         ),
-                        set(response.get("X-HASH-ALGORITHMS").split(",")[5]),
+                        set(
+                            _get_header(
+                                response, "X-HASH-ALGORITHMS", inline_domain
+                            ).split(",")[:5]
+                        ),
                     )
                 ]
-            with content.file.open("wb") as f:
-                for chunk in response.streaming_content:
-                    f.write(chunk)
-                    for i in hashes_remote:
-                        i.update(chunk)
+            if not resumed:
+                offset = 0
+            state = {
+                "url": url,
+                "validator": _get_validator(response, inline_domain),
+                "nonce": checknonce,
+                "offset": offset,
+            }
+            with open(partial_path, "r+b" if resumed else "wb") as f:
+                # hash states cannot be serialized, so feed them the already
+                # downloaded part from the local partial file
+                if resumed and hashes_remote:
+                    chunk = f.read(_checkpoint_size)
+                    while chunk:
+                        for i in hashes_remote:
+                            i.update(chunk)
+                        chunk = f.read(_checkpoint_size)
+                f.seek(offset)
+                unsynced = 0
+
+                def checkpoint():
+                    f.flush()
+                    os.fsync(f.fileno())
+                    state["offset"] += unsynced
+                    _store_partial_state(partial_path, state)
+
+                try:
+                    for chunk in _iter_response(response, inline_domain):
+                        f.write(chunk)
+                        for i in hashes_remote:
+                            i.update(chunk)
+                        unsynced += len(chunk)
+                        if state["validator"] and unsynced >= _checkpoint_size:
+                            checkpoint()
+                            unsynced = 0
+                except Exception:
+                    # keep the received bytes for resuming
+                    if state["validator"] and unsynced:
+                        checkpoint()
+                    raise
+            # raises QuotaExceeded before the file is replaced
+            size = os.path.getsize(partial_path)
+            account_usage(
+                content.cluster_id, size - content_size(content), enforce=True
+            )
+            _finish_partial(content, partial_path)
+            content.size = size
+            if checknonce != "":
+                content.nonce = checknonce
             if transfer:
                 signatures = retrieve_signatures(
                     url,
-                    headers,
-                    session=session,
+                    headers or {},
+                    session=s,
                     params=params,
                     inline_domain=inline_domain,
                     keepalive=keepalive,
                 )
-        else:
-            if session:
-                s = session
-            else:
-                s = requests.Session()
-            try:
-                response = s.get(url, headers=_headers, **params)
-                if response.status_code == 404:
-                    return TransferResult.NOTFOUND
-                elif response.status_code != 200:
-                    return TransferResult.ERROR
-                # should be only one nonce
-                checknonce = response.get("X-NONCE", "")
-                if checknonce != "":
-                    if len(checknonce) != 20:
-                        logger.warning("Invalid nonce (not 13 bytes)")
-                        return TransferResult.ERROR
-                    content.nonce = checknonce
-                if transfer and verifiers:
-                    hashes_remote = [
-                        *map(
-                            lambda x: hashes.Hash(
-                                getattr(hashes, x.strip().upper()),
-                                default_backend(),
-                            ),
-                            set(
-                                response.get("X-HASH-ALGORITHMS").split(",")[5]
-                            ),
-                        )
-                    ]
-                with content.file.open("wb") as f:
-                    for chunk in response.iter_content(512):
-                        f.write(chunk)
-                        for i in hashes_remote:
-                            i.update(chunk)
-
-                if transfer:
-                    signatures = retrieve_signatures(
-                        url,
-                        headers,
-                        session=s,
-                        params=params,
-                        inline_domain=inline_domain,
-                        keepalive=keepalive,
-                    )
-            except Exception as exc:
-                logger.error("Error while transferring content", exc_info=exc)
-                return TransferResult.ERROR
-            finally:
-                if not session:
-                    s.close()
-        if transfer:
-            content.references.filter(group="transfer").delete()
-            content.tags.bulk_create(
-                _generate_transfer_info(content, hashes_remote, signatures),
-                ignore_conflict=True,
-            )
+                content.references.filter(group="transfer").delete()
+                content.tags.bulk_create(
+                    _generate_transfer_info(
+                        content, hashes_remote, signatures
+                    ),
+                    ignore_conflicts=True,
+                )
             content.updateId = uuid4()
-            content.save(update_fields=["updateId"])
+            content.save(update_fields=["nonce", "file", "size", "updateId"])
+            log_content_changes([content], ChangeOperation.update)
+    except Exception as exc:
+        logger.error("Error while transferring content", exc_info=exc)
+        return TransferResult.ERROR
+    finally:
+        if s and not session:
+            s.close()
     if transfer and verifiers:
         if not verify_signatures(hashes_remote, signatures, verifiers):
             return TransferResult.FAILED_VERIFICATION
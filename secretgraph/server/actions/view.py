@@ -5,7 +5,7 @@ from django.db.models import Q, QuerySet, Subquery
 from django.utils import timezone
 
 from ..utils.auth import fetch_by_id
-from ..models import Content, ContentAction
+from ..models import Content, ContentAction, ContentQuerySet
 
 logger = logging.getLogger(__name__)
 
@@ -51,7 +51,7 @@ def fetch_clusters(
     return query
 
 
-class ContentFetchQueryset(QuerySet):
+class ContentFetchQueryset(ContentQuerySet):
     """
     Tracks usage of contents and mark accordingly Content for removal
     """
@@ -148,19 +148,16 @@ class ContentFetchQueryset(QuerySet):
         return self.fetch_action_trigger(super().latest(), False)
 
 
-def fetch_contents(
+def filter_contents(
     query,
-    actions,
     id=None,
     includeTags=None,
     excludeTags=None,
     contentHashes=None,
-    noFetch=False,
     minUpdated=None,
     maxUpdated=None,
 ) -> QuerySet:
-    assert actions is not None, "actions is None"
-    assert not isinstance(actions, str), "actions is str"
+    """ filters of fetch_contents without triggering fetch actions """
     if id:
         query = fetch_by_id(query, id, check_content_hash=True)
     if includeTags or excludeTags or contentHashes:
@@ -184,6 +181,31 @@ def fetch_contents(
 
     if minUpdated or maxUpdated:
         query = query.filter(updated__range=(minUpdated, maxUpdated))
+    return query
+
+
+def fetch_contents(
+    query,
+    actions,
+    id=None,
+    includeTags=None,
+    excludeTags=None,
+    contentHashes=None,
+    noFetch=False,
+    minUpdated=None,
+    maxUpdated=None,
+) -> QuerySet:
+    assert actions is not None, "actions is None"
+    assert not isinstance(actions, str), "actions is str"
+    query = filter_contents(
+        query,
+        id=id,
+        includeTags=includeTags,
+        excludeTags=excludeTags,
+        contentHashes=contentHashes,
+        minUpdated=minUpdated,
+        maxUpdated=maxUpdated,
+    )
     return ContentFetchQueryset(
         query.query, actions=actions, only_direct_fetch_action_trigger=noFetch
     )
@@ -1,14 +1,9 @@
 __all__ = ["SecretgraphServerConfig"]
 
 from django.apps import AppConfig
-from django.db.models.signals import (
-    post_delete, pre_delete, post_save, post_migrate
-)
+from django.db.models.signals import post_migrate, pre_delete
 
-from .signals import (
-    deleteContentCb, deleteEncryptedFileCb, generateFlexid, regenerateKeyHash,
-    fillEmptyFlexidsCb
-)
+from .signals import deleteClusterCb, deleteContentCb, fillEmptyFlexidsCb
 
 
 class SecretgraphServerConfig(AppConfig):
@@ -17,27 +12,14 @@ class SecretgraphServerConfig(AppConfig):
     verbose_name = 'Secretgraph backend'
 
     def ready(self):
-        from .models import Content, Cluster
-        pre_delete.connect(
-            deleteContentCb, sender=Content
-        )
-
-        post_delete.connect(
-            deleteEncryptedFileCb, sender=Content,
-        )
-
-        post_save.connect(
-            generateFlexid, sender=Cluster
-        )
-
-        post_save.connect(
-            generateFlexid, sender=Content
-        )
+        from .models import Cluster, Content
 
         post_migrate.connect(
             fillEmptyFlexidsCb, sender=self
         )
-
-        post_migrate.connect(
-            regenerateKeyHash, sender=self
+        pre_delete.connect(
+            deleteContentCb, sender=Content
+        )
+        pre_delete.connect(
+            deleteClusterCb, sender=Cluster
         )
@@ -1,6 +1,4 @@
-import re
 import os
-from itertools import chain
 from django import forms
 from django.utils.translation import gettext_lazy as _
 
@@ -58,25 +56,12 @@ class PushForm(forms.Form):
 
     def clean(self):
         ret = super().clean()
-        form = self.result["forms"][self.instance.actions.get(group="push").id]
-        if ret.get("tags") is not None:
-            allowed = form.get("allowedTags", None)
-            if allowed is not None:
-                matcher = re.compile(
-                    "^(?:%s)(?:(?<==)|$)" % "|".join(map(re.escape, allowed))
-                )
-                ret["tags"] = filter(
-                    lambda x: matcher.fullmatch(x), ret["tags"]
-                )
-            ret["tags"] = chain(form.get("injectedTags", []), ret["tags"])
-        else:
-            ret["tags"] = form.get("injectedTags") or []
-        if ret.get("references") is not None:
-            ret["references"] = chain(
-                form.get("injectReferences", []), ret["references"]
-            )
-        else:
-            ret["references"] = form.get("injectReferences") or []
+        policy = self.result["policies"][
+            self.instance.actions.get(group="push").id
+        ]
+        form = policy.form
+        ret["tags"] = policy.filter_tags(ret.get("tags"))
+        ret["references"] = policy.filter_references(ret.get("references"))
         required_keys = list(
             Content.objects.injected_keys(
                 group=self.instance.group
@@ -93,8 +78,13 @@ class PushForm(forms.Form):
             "key": self.cleaned_data.get("key"),
         }
         action_key = None
-        if form.pop("updateable", False):
-            freeze = form.pop("freeze", False)
+        if form.get("updateable", False):
+            freeze = form.get("freeze", False)
+            # policy is shared, create a modified copy
+            form = {
+                k: v for k, v in form.items()
+                if k not in {"updateable", "freeze"}
+            }
             action_key = os.urandom(32)
             content["actions"] = [
                 {
@@ -0,0 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+
+from ...models import Content
+from ...utils.quota import storage_size
+
+
+class Command(BaseCommand):
+    help = "Store the file size of contents without size"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, workers, batch_size, **options):
+        storage = Content._meta.get_field("file").storage
+        last_id = 0
+        processed = 0
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            while True:
+                batch = list(
+                    Content.objects.filter(id__gt=last_id, size__isnull=True)
+                    .order_by("id")
+                    .only("id", "file")[:batch_size]
+                )
+                if not batch:
+                    break
+                last_id = batch[-1].id
+                sizes = executor.map(
+                    lambda x: storage_size(storage, x.file.name), batch
+                )
+                for content, size in zip(batch, sizes):
+                    content.size = size
+                Content.objects.bulk_update(batch, ["size"])
+                processed += len(batch)
+                self.stdout.write("Stored size of %d contents" % processed)
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from ...models import Content
+
+
+class Command(BaseCommand):
+    help = "Reclaim space of deleted files in packfile segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-dead-ratio",
+            type=float,
+            default=0.5,
+            help="Minimal ratio of dead bytes for rewriting a segment",
+        )
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=3600,
+            help="Minimal age of seals and tombstones in seconds",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, min_dead_ratio, min_age, batch_size, **options):
+        storage = Content._meta.get_field("file").storage
+        if not hasattr(storage, "compact"):
+            raise CommandError("Storage is no PackfileStorage")
+        compacted, deleted = storage.compact(
+            min_dead_ratio=min_dead_ratio,
+            min_age=min_age,
+            batch_size=batch_size,
+        )
+        self.stdout.write(
+            "Compacted %d segments, deleted %d empty segments"
+            % (compacted, deleted)
+        )
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from ...utils.changes import prune_changes
+
+
+class Command(BaseCommand):
+    help = "Delete old entries of the change feed"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=int,
+            default=30,
+            help="Keep changes of the last days",
+        )
+
+    def handle(self, days, **options):
+        deleted = prune_changes(timedelta(days=days))
+        self.stdout.write("Deleted %d changes" % deleted)
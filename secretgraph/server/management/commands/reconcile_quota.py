@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ...utils.quota import reconcile_usage
+
+
+class Command(BaseCommand):
+    help = "Recompute usage counters of clusters and users"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, workers, batch_size, **options):
+        updated = reconcile_usage(workers=workers, batch_size=batch_size)
+        self.stdout.write("Updated usage of %d clusters" % updated)
@@ -0,0 +1,56 @@
+import os
+
+from django.core.management.base import BaseCommand
+
+from ...utils.rehash import count_stale_keys, rehash_keys
+
+
+class Command(BaseCommand):
+    help = (
+        "Recalculate key hashes after changing SECRETGRAPH_HASH_ALGORITHMS. "
+        "Can run while the server is online and can be resumed"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--checkpoint",
+            help="File for storing the last processed id, used for resuming",
+        )
+        parser.add_argument(
+            "--start-after", type=int, default=None, help="Content id"
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Check also keys with hashes of the current length",
+        )
+
+    def handle(self, checkpoint, start_after, batch_size, force, **options):
+        if start_after is None:
+            start_after = 0
+            if checkpoint and os.path.exists(checkpoint):
+                with open(checkpoint, "r") as f:
+                    start_after = int(f.read().strip() or 0)
+        total = count_stale_keys(start_after, force=force)
+        self.stdout.write(
+            "%d keys to check, starting after id %d" % (total, start_after)
+        )
+        done = 0
+        updated = 0
+        for last_id, processed, changed in rehash_keys(
+            start_after, batch_size=batch_size, force=force
+        ):
+            done += processed
+            updated += changed
+            if checkpoint:
+                with open("%s.tmp" % checkpoint, "w") as f:
+                    f.write(str(last_id))
+                os.replace("%s.tmp" % checkpoint, checkpoint)
+            self.stdout.write(
+                "%d/%d keys checked, %d updated, last id %d"
+                % (done, total, updated, last_id)
+            )
+        if checkpoint and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        self.stdout.write("Finished: %d keys updated" % updated)
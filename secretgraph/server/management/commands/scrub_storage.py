@@ -0,0 +1,140 @@
+import os
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from ...models import Cluster, Content, PendingFileDeletion, UploadSession
+from ...utils.delete import _batched, process_file_deletions
+from ...utils.upload import get_upload_expiry, upload_session_path
+
+
+def _list_files(storage, path):
+    try:
+        dirs, files = storage.listdir(path)
+    except FileNotFoundError:
+        return [], []
+    return (
+        [posixpath.join(path, d) for d in dirs],
+        [posixpath.join(path, f) for f in files],
+    )
+
+
+def _base_name(name):
+    for suffix in (".partial.json", ".partial"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete queued storage files and storage files "
+        "without Content or Cluster"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--min-age",
+            type=int,
+            default=3600,
+            help="Minimal age of unreferenced files in seconds",
+        )
+        parser.add_argument("--dry-run", action="store_true")
+        parser.add_argument("--workers", type=int, default=4)
+        parser.add_argument("--batch-size", type=int, default=500)
+
+    def handle(self, min_age, dry_run, workers, batch_size, **options):
+        storage = Content._meta.get_field("file").storage
+        if dry_run:
+            queued = PendingFileDeletion.objects.count()
+        else:
+            queued = process_file_deletions(batch_size=batch_size)
+        self.stdout.write("Processed %d queued deletions" % queued)
+        expired = UploadSession.objects.filter(
+            updated__lt=timezone.now() - get_upload_expiry()
+        )
+        if dry_run:
+            expired = expired.count()
+        else:
+            for session in expired:
+                try:
+                    os.remove(upload_session_path(session))
+                except FileNotFoundError:
+                    pass
+            expired = expired.delete()[0]
+        self.stdout.write("Removed %d expired upload sessions" % expired)
+
+        roots = {
+            getattr(settings, "SECRETGRAPH_FILE_DIR", "content_files"),
+            getattr(settings, "SECRETGRAPH_FILE_DIR", "cluster_files"),
+        }
+        # stale uploads of crashed requests
+        roots.add(getattr(settings, "SECRETGRAPH_UPLOAD_DIR", "uploads"))
+        if hasattr(storage, "blob_dir"):
+            # shared files of DedupStorage
+            roots.add(storage.blob_dir)
+        threshold = timezone.now() - timedelta(seconds=min_age)
+        candidates = []
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            pending = [executor.submit(_list_files, storage, r) for r in roots]
+            while pending:
+                dirs, files = pending.pop().result()
+                candidates.extend(files)
+                pending.extend(
+                    executor.submit(_list_files, storage, d) for d in dirs
+                )
+
+        def is_old(name):
+            try:
+                return storage.get_modified_time(name) < threshold
+            except (NotImplementedError, FileNotFoundError):
+                return False
+
+        orphans = []
+        for batch in _batched(sorted(set(candidates)), batch_size):
+            # partial transfers belong to the file they are completing
+            names = dict(map(lambda x: (x, _base_name(x)), batch))
+            bases = set(names.values())
+            known = set(
+                Content.objects.filter(file__in=bases).values_list(
+                    "file", flat=True
+                )
+            )
+            known.update(
+                Cluster.objects.filter(publicInfo__in=bases).values_list(
+                    "publicInfo", flat=True
+                )
+            )
+            # staged files of resumable uploads
+            resumable = {
+                posixpath.basename(base)[: -len(".resumable")]: base
+                for base in bases
+                if base.endswith(".resumable")
+            }
+            known.update(
+                resumable[flexid]
+                for flexid in UploadSession.objects.filter(
+                    flexid__in=resumable.keys()
+                ).values_list("flexid", flat=True)
+            )
+            orphans.extend(
+                name for name, base in names.items() if base not in known
+            )
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+            orphans = [
+                name
+                for name, old in zip(orphans, executor.map(is_old, orphans))
+                if old
+            ]
+        if not dry_run:
+            with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+                list(executor.map(storage.delete, orphans))
+        for name in orphans:
+            self.stdout.write(
+                "%s %s" % ("Would delete" if dry_run else "Deleted", name)
+            )
+        self.stdout.write("%d unreferenced files" % len(orphans))
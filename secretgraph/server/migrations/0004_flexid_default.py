@@ -0,0 +1,24 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:01
+
+from django.db import migrations, models
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0003_pendingfiledeletion'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='cluster',
+            name='flexid',
+            field=models.UUIDField(blank=True, default=uuid.uuid4, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='content',
+            name='flexid',
+            field=models.UUIDField(blank=True, default=uuid.uuid4, null=True, unique=True),
+        ),
+    ]
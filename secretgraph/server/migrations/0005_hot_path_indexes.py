@@ -0,0 +1,41 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0004_flexid_default'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['cluster', 'keyHash', 'start', 'stop'], name='action_cluster_keyhash'),
+        ),
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(condition=models.Q(('stop__isnull', True)), fields=['cluster', 'keyHash', 'start'], name='action_cluster_keyhash_open'),
+        ),
+        migrations.AddIndex(
+            model_name='cluster',
+            index=models.Index(condition=models.Q(('markForDestruction__isnull', False)), fields=['markForDestruction'], name='cluster_destruction'),
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['cluster', 'markForDestruction', 'updated'], name='content_cluster_destr_upd'),
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(condition=models.Q(('markForDestruction__isnull', False)), fields=['markForDestruction'], name='content_destruction'),
+        ),
+        migrations.AddIndex(
+            model_name='contentreference',
+            index=models.Index(fields=['target', 'group'], name='contentreference_target_grp'),
+        ),
+        migrations.AddIndex(
+            model_name='contentreference',
+            index=models.Index(fields=['source', 'group'], name='contentreference_source_grp'),
+        ),
+    ]
@@ -0,0 +1,60 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:12
+
+from django.db import migrations, models
+from django.db.models.functions import Substr
+import secretgraph.server.models
+
+# frozen copy of secretgraph.server.utils.misc.HASH_INDEX_LENGTH,
+# migrations must not change with the application code
+HASH_INDEX_LENGTH = 16
+
+
+def fill_hash_index(apps, schema_editor):
+    # same as hash_index: hashes are stored in base64 form, the index is
+    # their prefix
+    Action = apps.get_model("secretgraph", "Action")
+    Content = apps.get_model("secretgraph", "Content")
+    db = schema_editor.connection.alias
+    Action.objects.using(db).update(
+        keyHashIndex=Substr("keyHash", 1, HASH_INDEX_LENGTH)
+    )
+    Content.objects.using(db).filter(contentHash__isnull=False).update(
+        contentHashIndex=Substr("contentHash", 1, HASH_INDEX_LENGTH)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0005_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='action',
+            name='action_cluster_keyhash',
+        ),
+        migrations.RemoveIndex(
+            model_name='action',
+            name='action_cluster_keyhash_open',
+        ),
+        migrations.AddField(
+            model_name='action',
+            name='keyHashIndex',
+            field=secretgraph.server.models.HashIndexField(blank=True, db_column='key_hash_index', null=True, source='keyHash'),
+        ),
+        migrations.AddField(
+            model_name='content',
+            name='contentHashIndex',
+            field=secretgraph.server.models.HashIndexField(blank=True, db_column='content_hash_index', db_index=True, null=True, source='contentHash'),
+        ),
+        migrations.RunPython(fill_hash_index, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(fields=['cluster', 'keyHashIndex', 'start', 'stop'], name='action_cluster_keyhash'),
+        ),
+        migrations.AddIndex(
+            model_name='action',
+            index=models.Index(condition=models.Q(('stop__isnull', True)), fields=['cluster', 'keyHashIndex', 'start'], name='action_cluster_keyhash_open'),
+        ),
+    ]
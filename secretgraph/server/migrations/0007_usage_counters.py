@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0006_hash_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='cluster',
+            name='contentCount',
+            field=models.BigIntegerField(db_column='content_count', default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='cluster',
+            name='usedBytes',
+            field=models.BigIntegerField(db_column='used_bytes', default=0, editable=False),
+        ),
+    ]
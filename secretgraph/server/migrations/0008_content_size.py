@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0007_usage_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='content',
+            name='size',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
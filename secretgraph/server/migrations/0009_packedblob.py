@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0008_content_size'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PackedBlob',
+            fields=[
+                ('id', models.BigAutoField(editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('segment', models.CharField(max_length=255)),
+                ('offset', models.BigIntegerField()),
+                ('length', models.PositiveIntegerField()),
+                ('deleted', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='packedblob',
+            index=models.Index(fields=['segment', 'offset'], name='packedblob_segment'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0009_packedblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SharedBlob',
+            fields=[
+                ('id', models.BigAutoField(editable=False, primary_key=True, serialize=False)),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('refcount', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+    ]
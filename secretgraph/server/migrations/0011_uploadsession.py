@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+import secretgraph.server.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0010_sharedblob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.BigAutoField(editable=False, primary_key=True, serialize=False)),
+                ('flexid', models.CharField(default=secretgraph.server.models._file_token, editable=False, max_length=64, unique=True)),
+                ('length', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('cluster', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploadSessions', to='secretgraph.cluster')),
+                ('content', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='uploadSessions', to='secretgraph.content')),
+            ],
+        ),
+    ]
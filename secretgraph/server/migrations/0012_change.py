@@ -0,0 +1,29 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0011_uploadsession'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Change',
+            fields=[
+                ('id', models.BigAutoField(editable=False, primary_key=True, serialize=False)),
+                ('clusterId', models.BigIntegerField(db_column='cluster_id')),
+                ('contentId', models.BigIntegerField(blank=True, db_column='content_id', null=True)),
+                ('flexid', models.UUIDField()),
+                ('updateId', models.UUIDField(blank=True, db_column='update_id', null=True)),
+                ('operation', models.CharField(max_length=10)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['clusterId', 'id'], name='change_cluster'),
+        ),
+    ]
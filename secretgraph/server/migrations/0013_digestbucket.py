@@ -0,0 +1,37 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:41
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0012_change'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DigestBucket',
+            fields=[
+                ('id', models.BigAutoField(editable=False, primary_key=True, serialize=False)),
+                ('bucket', models.CharField(max_length=2)),
+                ('version', models.BigIntegerField(default=0)),
+                ('hashedVersion', models.BigIntegerField(blank=True, db_column='hashed_version', null=True)),
+                ('digest', models.CharField(blank=True, default='', max_length=64)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='content',
+            index=models.Index(fields=['cluster', 'flexid'], name='content_cluster_flexid'),
+        ),
+        migrations.AddField(
+            model_name='digestbucket',
+            name='cluster',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='digestBuckets', to='secretgraph.cluster'),
+        ),
+        migrations.AddConstraint(
+            model_name='digestbucket',
+            constraint=models.UniqueConstraint(fields=('cluster', 'bucket'), name='unique_digest_bucket'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 3.2.25 on 2026-10-19 04:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph', '0013_digestbucket'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeSequence',
+            fields=[
+                ('id', models.BigAutoField(editable=False, primary_key=True, serialize=False)),
+                ('last', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.RemoveIndex(
+            model_name='change',
+            name='change_cluster',
+        ),
+        migrations.AddField(
+            model_name='change',
+            name='sequence',
+            field=models.BigIntegerField(blank=True, editable=False, null=True, unique=True),
+        ),
+        migrations.AddIndex(
+            model_name='change',
+            index=models.Index(fields=['clusterId', 'sequence'], name='change_cluster'),
+        ),
+    ]
@@ -11,7 +11,7 @@ from cryptography.hazmat.primitives.serialization import load_der_public_key
 from django.conf import settings
 from django.core.files.base import File
 from django.core.files.storage import default_storage
-from django.db import models
+from django.db import IntegrityError, models, router, transaction
 from django.db.models.functions import Concat, Substr
 from django.urls import reverse
 from django.utils import timezone
@@ -21,29 +21,24 @@ from .messages import (
     injection_group_help,
     reference_group_help,
 )
+from .storage import fanout_path
+from .utils.misc import HASH_INDEX_LENGTH, hash_index
 
 logger = logging.getLogger(__name__)
 
 
+def _file_token() -> str:
+    return secrets.token_urlsafe(
+        getattr(settings, "SECRETGRAPH_FILETOKEN_LENGTH", 32)
+    )
+
+
 def get_publicInfo_file_path(instance, filename) -> str:
     ret = getattr(settings, "SECRETGRAPH_FILE_DIR", "cluster_files")
-    # try 100 times to find free filename
-    # but should not take more than 1 try
-    for _i in range(0, 100):
-        ret_path = default_storage.generate_filename(
-            posixpath.join(
-                ret,
-                "%s.info"
-                % secrets.token_urlsafe(
-                    getattr(settings, "SECRETGRAPH_FILETOKEN_LENGTH", 100)
-                ),
-            )
-        )
-        if not default_storage.exists(ret_path):
-            break
-    else:
-        raise FileExistsError("Unlikely event: no free filename")
-    return ret_path
+    # no existence check, collisions are handled by storage.save
+    return default_storage.generate_filename(
+        fanout_path(ret, "%s.info" % _file_token())
+    )
 
 
 def get_content_file_path(instance, filename) -> str:
@@ -51,34 +46,157 @@ def get_content_file_path(instance, filename) -> str:
     cluster_id = instance.cluster_id or instance.cluster.id
     if not cluster_id:
         raise Exception("no cluster id found")
+    return default_storage.generate_filename(
+        fanout_path(
+            posixpath.join(ret, str(cluster_id)), "%s.store" % _file_token()
+        )
+    )
 
-    # try 100 times to find free filename
-    # but should not take more than 1 try
-    for _i in range(0, 100):
-        ret_path = default_storage.generate_filename(
-            posixpath.join(
-                ret,
-                str(cluster_id),
-                "%s.store"
-                % secrets.token_urlsafe(
-                    getattr(settings, "SECRETGRAPH_FILETOKEN_LENGTH", 100)
-                ),
+
+class HashIndexField(models.CharField):
+    """
+    Truncated copy of a hash field for compact indexes, derived on save
+    """
+
+    def __init__(self, source, *args, **kwargs):
+        self.source = source
+        kwargs["max_length"] = HASH_INDEX_LENGTH
+        kwargs.setdefault("blank", True)
+        kwargs.setdefault("null", True)
+        kwargs["editable"] = False
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs["source"] = self.source
+        del kwargs["max_length"]
+        del kwargs["editable"]
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = hash_index(getattr(model_instance, self.source))
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+# attempts to insert objects with flexids generated before insert
+FLEXID_ATTEMPTS = 3
+
+
+def _regenerate_flexids(model, objs, using):
+    """
+    Assigns new flexids to objs with flexids already in use
+    Returns if a flexid was replaced
+    """
+    used = set(
+        model._default_manager.using(using)
+        .filter(flexid__in=map(lambda x: x.flexid, objs))
+        .values_list("flexid", flat=True)
+    )
+    for obj in objs:
+        if obj.flexid in used:
+            obj.flexid = uuid4()
+    return bool(used)
+
+
+class FlexidQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        """ Regenerates colliding flexids and retries """
+        if kwargs.get("ignore_conflicts"):
+            return super().bulk_create(objs, *args, **kwargs)
+        objs = list(objs)
+        for i in range(FLEXID_ATTEMPTS):
+            try:
+                with transaction.atomic(using=self.db):
+                    return super().bulk_create(objs, *args, **kwargs)
+            except IntegrityError:
+                if i + 1 >= FLEXID_ATTEMPTS or not _regenerate_flexids(
+                    self.model, objs, self.db
+                ):
+                    raise
+
+
+class ClusterQuerySet(FlexidQuerySet):
+    def delete(self):
+        """
+        Deletes contents first, so contents referencing them in other
+        clusters are handled
+        """
+        from ..constants import ChangeOperation
+        from .utils.changes import log_changes
+        from .utils.delete import enqueue_file_deletions, set_based_deletion
+
+        clusters = list(self.values_list("id", "flexid"))
+        if not clusters:
+            return 0, {}
+        cluster_ids = [x[0] for x in clusters]
+        with transaction.atomic(using=self.db):
+            enqueue_file_deletions(
+                Cluster.objects.using(self.db)
+                .filter(id__in=cluster_ids)
+                .values_list("publicInfo", flat=True),
+                using=self.db,
             )
-        )
-        if not default_storage.exists(ret_path):
-            break
-    else:
-        raise FileExistsError("Unlikely event: no free filename")
-    return ret_path
+            total, per_model = Content.objects.using(self.db).filter(
+                cluster_id__in=cluster_ids
+            ).delete()
+            with set_based_deletion():
+                _total, _per_model = models.QuerySet.delete(
+                    Cluster.objects.using(self.db).filter(id__in=cluster_ids)
+                )
+            log_changes(
+                map(lambda x: (x[0], None, x[1], None), clusters),
+                ChangeOperation.delete,
+                using=self.db,
+            )
+        for key, val in _per_model.items():
+            per_model[key] = per_model.get(key, 0) + val
+        return total + _total, per_model
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class ContentQuerySet(FlexidQuerySet):
+    def delete(self):
+        """
+        Set-based deletion of contents and contents depending on them
+        """
+        from .utils.delete import delete_contents
+
+        content_ids = list(self.values_list("id", flat=True))
+        if not content_ids:
+            return 0, {}
+        return delete_contents(content_ids, using=self.db)
+
+    delete.alters_data = True
+    delete.queryset_only = True
 
 
 class FlexidModel(models.Model):
     id: int = models.BigAutoField(primary_key=True, editable=False)
-    flexid: UUID = models.UUIDField(blank=True, null=True, unique=True)
+    flexid: UUID = models.UUIDField(
+        default=uuid4, blank=True, null=True, unique=True
+    )
 
     class Meta:
         abstract = True
 
+    def save(self, *args, **kwargs):
+        """ Regenerates a colliding flexid of new objects and retries """
+        if not self._state.adding:
+            return super().save(*args, **kwargs)
+        using = kwargs.get("using") or router.db_for_write(type(self))
+        for i in range(FLEXID_ATTEMPTS):
+            try:
+                with transaction.atomic(using=using):
+                    return super().save(*args, **kwargs)
+            except IntegrityError:
+                if i + 1 >= FLEXID_ATTEMPTS or not _regenerate_flexids(
+                    type(self), [self], using
+                ):
+                    raise
+
 
 class Cluster(FlexidModel):
     # not a field but an attribute for restricting view
@@ -104,6 +222,15 @@ class Cluster(FlexidModel):
     markForDestruction: dt = models.DateTimeField(
         null=True, blank=True, db_column="mark_for_destruction"
     )
+    # usage counters, updated with every content change
+    usedBytes: int = models.BigIntegerField(
+        default=0, editable=False, db_column="used_bytes"
+    )
+    contentCount: int = models.BigIntegerField(
+        default=0, editable=False, db_column="content_count"
+    )
+
+    objects = ClusterQuerySet.as_manager()
 
     if getattr(settings, "AUTH_USER_MODEL", None) or getattr(
         settings, "SECRETGRAPH_BIND_TO_USER", False
@@ -116,13 +243,28 @@ class Cluster(FlexidModel):
             related_name="clusters",
         )
 
+    class Meta:
+        indexes = [
+            # cleanup of expired clusters
+            models.Index(
+                fields=["markForDestruction"],
+                condition=models.Q(markForDestruction__isnull=False),
+                name="cluster_destruction",
+            ),
+        ]
+
     @property
     def link(self):
         # path to raw view
         return reverse("secretgraph:clusters", kwargs={"id": self.flexid})
 
+    def delete(self, using=None, keep_parents=False):
+        return Cluster.objects.using(using or self._state.db).filter(
+            id=self.id
+        ).delete()
+
 
-class ContentManager(models.Manager):
+class ContentManager(models.Manager.from_queryset(ContentQuerySet)):
     def injected_keys(self, queryset=None, group=""):
         if queryset is None:
             queryset = self.get_queryset()
@@ -154,11 +296,16 @@ class Content(FlexidModel):
     nonce: str = models.CharField(max_length=255)
     # can decrypt = correct key
     file: File = models.FileField(upload_to=get_content_file_path)
+    # size of the encrypted file, null if unknown (not backfilled)
+    size: int = models.BigIntegerField(null=True, blank=True)
     # unique hash for content, e.g. generated from some tags
     # null if multiple contents are allowed
     contentHash: str = models.CharField(
         max_length=255, blank=True, null=True, db_column="content_hash"
     )
+    contentHashIndex: str = HashIndexField(
+        "contentHash", db_column="content_hash_index", db_index=True
+    )
     cluster: Cluster = models.ForeignKey(
         Cluster, on_delete=models.CASCADE, related_name="contents"
     )
@@ -172,12 +319,28 @@ class Content(FlexidModel):
                 fields=["contentHash", "cluster_id"], name="unique_content"
             )
         ]
+        indexes = [
+            models.Index(
+                fields=["cluster", "markForDestruction", "updated"],
+                name="content_cluster_destr_upd",
+            ),
+            # cleanup of expired contents, runs on every authorization
+            models.Index(
+                fields=["markForDestruction"],
+                condition=models.Q(markForDestruction__isnull=False),
+                name="content_destruction",
+            ),
+            # flexid prefix buckets of digests
+            models.Index(
+                fields=["cluster", "flexid"], name="content_cluster_flexid"
+            ),
+        ]
 
     def load_pubkey(self):
         """ Works only for public keys (special Content) """
         try:
             return load_der_public_key(
-                self.value.open("rb").read(), default_backend()
+                self.file.open("rb").read(), default_backend()
             )
         except Exception as exc:
             logger.error("Could not load public key", exc_info=exc)
@@ -188,6 +351,11 @@ class Content(FlexidModel):
         # path to raw view
         return reverse("secretgraph:contents", kwargs={"id": self.flexid})
 
+    def delete(self, using=None, keep_parents=False):
+        return Content.objects.using(using or self._state.db).filter(
+            id=self.id
+        ).delete()
+
     def signatures(self, algos=None, references=None):
         q = models.Q()
         q2 = models.Q()
@@ -247,6 +415,7 @@ class Action(models.Model):
         Cluster, on_delete=models.CASCADE, related_name="actions"
     )
     keyHash: str = models.CharField(max_length=255, db_column="key_hash")
+    keyHashIndex: str = HashIndexField("keyHash", db_column="key_hash_index")
     nonce: str = models.CharField(max_length=255)
     # value returns json with required encrypted aes key
     value: bytes = models.BinaryField(null=False, blank=False)
@@ -274,6 +443,18 @@ class Action(models.Model):
                 name="%(class)s_exist",
             ),
         ]
+        indexes = [
+            models.Index(
+                fields=["cluster", "keyHashIndex", "start", "stop"],
+                name="action_cluster_keyhash",
+            ),
+            # actions without expiration date
+            models.Index(
+                fields=["cluster", "keyHashIndex", "start"],
+                condition=models.Q(stop__isnull=True),
+                name="action_cluster_keyhash_open",
+            ),
+        ]
 
 
 class ContentTag(models.Model):
@@ -331,6 +512,14 @@ class ContentReference(models.Model):
                 fields=["source", "target", "group"], name="%(class)s_unique"
             ),
         ]
+        indexes = [
+            models.Index(
+                fields=["target", "group"], name="contentreference_target_grp"
+            ),
+            models.Index(
+                fields=["source", "group"], name="contentreference_source_grp"
+            ),
+        ]
 
     def __repr__(self):
         return '<ContentReference: (%r:"%s":%r)>' % (
@@ -338,3 +527,192 @@ class ContentReference(models.Model):
             self.group,
             self.target,
         )
+
+
+class PendingFileDeletion(models.Model):
+    """ Storage files which are deleted after the transaction committed """
+
+    id: int = models.BigAutoField(primary_key=True, editable=False)
+    # name of file in storage
+    name: str = models.TextField(blank=False, null=False)
+    created: dt = models.DateTimeField(auto_now_add=True, editable=False)
+
+    def __repr__(self):
+        return "<PendingFileDeletion: %s>" % self.name
+
+
+class PackedBlob(models.Model):
+    """ Index of small files stored in segments of PackfileStorage """
+
+    id: int = models.BigAutoField(primary_key=True, editable=False)
+    # name of file in storage
+    name: str = models.CharField(max_length=255, unique=True)
+    # name of segment file in storage
+    segment: str = models.CharField(max_length=255)
+    offset: int = models.BigIntegerField()
+    length: int = models.PositiveIntegerField()
+    # tombstone, space is reclaimed by compaction
+    deleted: dt = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["segment", "offset"], name="packedblob_segment"
+            )
+        ]
+
+    def __repr__(self):
+        return "<PackedBlob: %s (%s:%d)>" % (
+            self.name,
+            self.segment,
+            self.offset,
+        )
+
+
+class SharedBlob(models.Model):
+    """ Reference count of content-addressed files of DedupStorage """
+
+    id: int = models.BigAutoField(primary_key=True, editable=False)
+    # name of file in storage
+    name: str = models.CharField(max_length=255, unique=True)
+    refcount: int = models.PositiveIntegerField(default=0)
+
+    def __repr__(self):
+        return "<SharedBlob: %s (%d)>" % (self.name, self.refcount)
+
+
+class UploadSession(models.Model):
+    """
+    Resumable upload, the staged file is committed by a Content mutation
+    """
+
+    id: int = models.BigAutoField(primary_key=True, editable=False)
+    # random, acts as capability for appending chunks
+    flexid: str = models.CharField(
+        max_length=64, default=_file_token, unique=True, editable=False
+    )
+    # cluster of new content (create) or cluster of content (update)
+    cluster: Cluster = models.ForeignKey(
+        Cluster, on_delete=models.CASCADE, related_name="uploadSessions"
+    )
+    # set for updates of existing content
+    content: Content = models.ForeignKey(
+        Content,
+        on_delete=models.CASCADE,
+        related_name="uploadSessions",
+        null=True,
+        blank=True,
+    )
+    # declared size of the upload
+    length: int = models.BigIntegerField()
+    # received bytes
+    offset: int = models.BigIntegerField(default=0)
+    created: dt = models.DateTimeField(auto_now_add=True, editable=False)
+    updated: dt = models.DateTimeField(auto_now=True, editable=False)
+
+    @property
+    def complete(self):
+        return self.offset >= self.length
+
+    @property
+    def link(self):
+        return reverse("secretgraph:uploads", kwargs={"id": self.flexid})
+
+    def __repr__(self):
+        return "<UploadSession: %s (%d/%d)>" % (
+            self.flexid,
+            self.offset,
+            self.length,
+        )
+
+
+class Change(models.Model):
+    """
+    Append-only log of content and cluster changes, written in the
+    transaction of the change, the sequence is assigned after the commit
+    and is the cursor of the change feed
+    """
+
+    id: int = models.BigAutoField(primary_key=True, editable=False)
+    # commit order, null until sequenced
+    sequence: int = models.BigIntegerField(
+        null=True, blank=True, unique=True, editable=False
+    )
+    # no foreign keys, tombstones outlive the objects
+    clusterId: int = models.BigIntegerField(db_column="cluster_id")
+    # null for changes of the cluster itself
+    contentId: int = models.BigIntegerField(
+        null=True, blank=True, db_column="content_id"
+    )
+    flexid: UUID = models.UUIDField()
+    updateId: UUID = models.UUIDField(
+        null=True, blank=True, db_column="update_id"
+    )
+    operation: str = models.CharField(max_length=10)
+    created: dt = models.DateTimeField(auto_now_add=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # feed of the clusters of an authset
+            models.Index(
+                fields=["clusterId", "sequence"], name="change_cluster"
+            ),
+        ]
+
+    def __repr__(self):
+        return "<Change: %s %s (%d)>" % (
+            self.operation,
+            self.flexid,
+            self.id,
+        )
+
+
+class ChangeSequence(models.Model):
+    """
+    Last assigned sequence of the change feed, its row lock serializes
+    the sequencing
+    """
+
+    id: int = models.BigAutoField(primary_key=True, editable=False)
+    last: int = models.BigIntegerField(default=0)
+
+    def __repr__(self):
+        return "<ChangeSequence: %d>" % self.last
+
+
+class DigestBucket(models.Model):
+    """
+    Cached hash over (flexid, updateId) of the contents of a cluster with
+    the flexid prefix bucket, writes bump version, reads rehash buckets
+    with hashedVersion != version
+    """
+
+    id: int = models.BigAutoField(primary_key=True, editable=False)
+    cluster: Cluster = models.ForeignKey(
+        Cluster, on_delete=models.CASCADE, related_name="digestBuckets"
+    )
+    # first hex digits of flexid
+    bucket: str = models.CharField(max_length=2)
+    version: int = models.BigIntegerField(default=0)
+    hashedVersion: int = models.BigIntegerField(
+        null=True, blank=True, db_column="hashed_version"
+    )
+    digest: str = models.CharField(max_length=64, blank=True, default="")
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["cluster", "bucket"], name="unique_digest_bucket"
+            )
+        ]
+
+    @property
+    def stale(self):
+        return self.hashedVersion != self.version
+
+    def __repr__(self):
+        return "<DigestBucket: %s %s (%d)>" % (
+            self.cluster_id,
+            self.bucket,
+            self.version,
+        )
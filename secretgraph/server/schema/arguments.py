@@ -56,6 +56,10 @@ class ReferenceInput(graphene.InputObjectType):
 
 class ContentValueInput(graphene.InputObjectType):
     value = Upload(required=False)
+    upload = graphene.String(
+        required=False,
+        description="Id of completed resumable upload, replaces value",
+    )
     nonce = graphene.String(required=False)
     tags = graphene.List(graphene.String, required=False)
 
@@ -69,6 +73,13 @@ class ContentInput(graphene.InputObjectType):
     actions = graphene.List(ActionInput, required=False)
 
 
+class BulkContentInput(graphene.InputObjectType):
+    value = ContentValueInput(required=True)
+    references = graphene.List(ReferenceInput, required=False)
+    contentHash = graphene.String(required=False)
+    actions = graphene.List(ActionInput, required=False)
+
+
 class PushContentInput(graphene.InputObjectType):
     parent = graphene.ID(required=True)
     value = ContentValueInput(required=True)
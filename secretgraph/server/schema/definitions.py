@@ -5,10 +5,13 @@ from django.shortcuts import resolve_url
 from graphene import ObjectType, relay
 from graphene.types.generic import GenericScalar
 from graphene_django import DjangoConnectionField, DjangoObjectType
-from graphql_relay import from_global_id
+from graphql_relay import from_global_id, to_global_id
 from django.utils.translation import gettext_lazy as _
 
+from ...constants import ChangeOperation
 from ..utils.auth import initializeCachedResult, fetch_by_id
+from ..utils.changes import fetch_changes
+from ..utils.digest import fetch_digest
 from ..actions.view import fetch_clusters, fetch_contents
 from ..models import Cluster, Content, ContentReference
 
@@ -223,6 +226,8 @@ class ContentNode(ActionMixin, FlexidMixin, DjangoObjectType):
         fields = ["nonce", "updated", "contentHash", "updateId"]
 
     cluster = graphene.Field(lambda: ClusterNode)
+    # Int is limited to 32 bit
+    size = graphene.Float(description="Size of the encrypted file in bytes")
     references = ContentReferenceConnectionField()
     referencedBy = ContentReferenceConnectionField()
     tags = graphene.Field(
@@ -524,6 +529,98 @@ class ClusterConnectionField(DjangoConnectionField):
         )
 
 
+class BulkContentResult(graphene.ObjectType):
+    content = graphene.Field(ContentNode)
+    contentKey = graphene.String(required=False)
+    error = graphene.String(required=False)
+
+
+class ChangeEntry(graphene.ObjectType):
+    id = graphene.ID(description="Id of the changed content or cluster")
+    operation = graphene.Enum.from_enum(ChangeOperation)()
+    updateId = graphene.UUID(required=False)
+    created = graphene.DateTime()
+
+    def resolve_id(self, info):
+        return to_global_id(
+            "Content" if self.contentId else "Cluster", self.flexid
+        )
+
+
+class ChangeFeed(graphene.ObjectType):
+    changes = graphene.List(ChangeEntry)
+    cursor = graphene.String(
+        required=False, description="Pass as cursor to get newer changes"
+    )
+    hasMore = graphene.Boolean()
+    resync = graphene.Boolean(
+        description="Changes were pruned, all objects must be fetched again"
+    )
+
+    @classmethod
+    def resolve_feed(cls, info, cursor=None, clusters=None, limit=100):
+        try:
+            cursor = int(cursor) if cursor else None
+        except ValueError:
+            raise ValueError("Invalid cursor")
+        if clusters:
+            clusters = fetch_by_id(
+                Cluster.objects.all(), clusters, limit_ids=10
+            ).values_list("id", flat=True)
+        result = fetch_changes(
+            info.context,
+            cursor=cursor,
+            clusters=clusters,
+            limit=max(1, min(limit, 1000)),
+        )
+        result["cursor"] = (
+            str(result["cursor"]) if result["cursor"] is not None else None
+        )
+        return cls(**result)
+
+
+class DigestChild(graphene.ObjectType):
+    prefix = graphene.String()
+    hash = graphene.String()
+
+
+class DigestEntry(graphene.ObjectType):
+    id = graphene.ID(description="Id of the content")
+    updateId = graphene.UUID()
+
+
+class ClusterDigest(graphene.ObjectType):
+    prefix = graphene.String(description="Flexid prefix of the node")
+    hash = graphene.String()
+    children = graphene.List(
+        DigestChild, description="Nodes of the next flexid digit"
+    )
+    entries = graphene.List(
+        DigestEntry,
+        required=False,
+        description="Contents, only for buckets (leaf nodes)",
+    )
+
+    @classmethod
+    def resolve_digest(cls, info, cluster, prefix=""):
+        cluster = fetch_by_id(Cluster.objects.all(), cluster).first()
+        if not cluster:
+            return None
+        node = fetch_digest(info.context, cluster, prefix=prefix)
+        if not node:
+            return None
+        node["children"] = [DigestChild(**x) for x in node["children"]]
+        if node["entries"] is not None:
+            node["entries"] = [
+                DigestEntry(
+                    id=to_global_id("Content", x["flexid"]),
+                    updateId=x["updateId"],
+                )
+                for x in node["entries"]
+            ]
+        return cls(**node)
+
+
 class FlexidType(graphene.Union):
     class Meta:
         types = (ClusterNode, ContentNode)
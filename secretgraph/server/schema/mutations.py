@@ -1,7 +1,6 @@
 import base64
 import logging
 import os
-import re
 from datetime import timedelta as td
 from itertools import chain
 
@@ -14,6 +13,8 @@ from graphene import relay
 
 from ...constants import MetadataOperations, TransferResult
 from ..actions.update import (
+    bulk_create_contents_fn,
+    bulk_update_metadata_fn,
     create_cluster_fn,
     create_content_fn,
     transfer_value,
@@ -21,6 +22,7 @@ from ..actions.update import (
     update_content_fn,
     update_metadata_fn,
 )
+from ..actions.view import filter_contents
 from ..models import Cluster, Content
 from ..signals import generateFlexid
 from ..utils.auth import (
@@ -29,14 +31,21 @@ from ..utils.auth import (
     initializeCachedResult,
     retrieve_allowed_objects,
 )
+from ..utils.upload import claim_upload
 from .arguments import (
     AuthList,
+    BulkContentInput,
     ClusterInput,
     ContentInput,
     PushContentInput,
     ReferenceInput,
 )
-from .definitions import ClusterNode, ContentNode, FlexidType
+from .definitions import (
+    BulkContentResult,
+    ClusterNode,
+    ContentNode,
+    FlexidType,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -119,6 +128,91 @@ class DeleteContentOrClusterMutation(relay.ClientIDMutation):
         return ret
 
 
+def _bulk_contents_query(
+    request,
+    scope,
+    authorization=None,
+    ids=None,
+    clusters=None,
+    includeTags=None,
+    excludeTags=None,
+    minUpdated=None,
+    maxUpdated=None,
+):
+    """
+    Authorizes once and returns the result with the selected contents
+    as "objects", either by ids or by filters (like contents)
+    """
+    if not any(
+        (ids, clusters, includeTags, excludeTags, minUpdated, maxUpdated)
+    ):
+        raise ValueError("ids or filters required")
+    result = retrieve_allowed_objects(
+        request, scope, Content.objects.all(), authset=authorization
+    )
+    # only contents granted by actions, not public contents
+    query = result["objects"].filter(
+        Q(cluster_id__in=result["required_keys_clusters"].keys())
+        | Q(id__in=result["required_keys_contents"].keys())
+    )
+    if ids:
+        query = fetch_by_id(
+            query,
+            ids,
+            check_content_hash=True,
+            limit_ids=getattr(settings, "SECRETGRAPH_BULK_LIMIT", 500),
+        )
+    if clusters:
+        query = fetch_by_id(
+            query,
+            clusters,
+            prefix="cluster__",
+            type_name="Cluster",
+            limit_ids=10,
+        )
+    result["objects"] = Content.objects.filter(
+        id__in=filter_contents(
+            query,
+            includeTags=includeTags,
+            excludeTags=excludeTags,
+            minUpdated=minUpdated,
+            maxUpdated=maxUpdated,
+        ).values("id")
+    )
+    return result
+
+
+class BulkDeleteContentsMutation(relay.ClientIDMutation):
+    class Input:
+        ids = graphene.List(graphene.ID, required=False)
+        clusters = graphene.List(graphene.ID, required=False)
+        includeTags = graphene.List(graphene.String, required=False)
+        excludeTags = graphene.List(graphene.String, required=False)
+        minUpdated = graphene.DateTime(required=False)
+        maxUpdated = graphene.DateTime(required=False)
+        authorization = AuthList()
+
+    count = graphene.Int()
+
+    @classmethod
+    def mutate_and_get_payload(cls, root, info, authorization=None, **kwargs):
+        now_plus_x = timezone.now() + td(minutes=20)
+        kwargs.pop("client_mutation_id", None)
+        result = _bulk_contents_query(
+            info.context, "delete", authorization=authorization, **kwargs
+        )
+        count = (
+            result["objects"]
+            .filter(
+                Q(markForDestruction__isnull=True)
+                | Q(markForDestruction__gt=now_plus_x)
+            )
+            .update(markForDestruction=now_plus_x)
+        )
+        initializeCachedResult(info.context, authset=authorization)
+        return cls(count=count)
+
+
 class ResetDeletionContentOrClusterMutation(relay.ClientIDMutation):
     class Input:
         id = graphene.ID(required=True)
@@ -269,39 +363,34 @@ class ContentMutation(relay.ClientIDMutation):
                     required_keys.values_list("contentHash", flat=True)
                 )
             try:
-                form = next(iter(result["forms"].values()))
+                policy = next(iter(result["policies"].values()))
                 # None should be possible here for not updating
                 if content.get("tags") is not None:
-                    allowed = form.get("allowedTags", None)
-                    if allowed is not None:
-                        matcher = re.compile(
-                            "^(?:%s)(?:(?<==)|$)"
-                            % "|".join(map(re.escape, allowed))
-                        )
-                        content["tags"] = filter(
-                            lambda x: matcher.fullmatch(x), content["tags"]
-                        )
-                    content["tags"] = chain(
-                        form.get("injectedTags", []), content["tags"]
-                    )
+                    content["tags"] = policy.filter_tags(content["tags"])
                 # None should be possible here for not updating
                 if content.get("references") is not None:
-                    content["references"] = chain(
-                        form.get("injectReferences", []), content["references"]
+                    content["references"] = policy.filter_references(
+                        content["references"]
                     )
-                required_keys.extend(form.get("requiredKeys", []))
+                required_keys.extend(policy.form.get("requiredKeys", []))
             except StopIteration:
                 pass
-            returnval = cls(
-                **update_content_fn(
-                    info.context,
-                    content_obj,
-                    content,
-                    updateId=updateId,
-                    required_keys=required_keys,
-                    authset=authorization,
-                )(transaction.atomic)
-            )
+            # a failed save keeps the claimed upload
+            with transaction.atomic():
+                if content.value and content.value.get("upload"):
+                    content.value["value"] = claim_upload(
+                        content.value.pop("upload"), content=content_obj
+                    )
+                returnval = cls(
+                    **update_content_fn(
+                        info.context,
+                        content_obj,
+                        content,
+                        updateId=updateId,
+                        required_keys=required_keys,
+                        authset=authorization,
+                    )(transaction.atomic)
+                )
         else:
             result = id_to_result(
                 info.context,
@@ -323,29 +412,95 @@ class ContentMutation(relay.ClientIDMutation):
                 )
 
             try:
-                form = next(iter(result["forms"].values()))
+                policy = next(iter(result["policies"].values()))
                 content["tags"] = chain(
-                    form.get("tags", []), content.get("tags") or []
+                    policy.form.get("tags", []), content.get("tags") or []
                 )
-                content["references"] = chain(
-                    form.get("injectReferences", []),
-                    content.get("references") or [],
+                content["references"] = policy.filter_references(
+                    content.get("references")
                 )
-                required_keys.extend(form.get("requiredKeys", []))
+                required_keys.extend(policy.form.get("requiredKeys", []))
             except StopIteration:
                 pass
-            returnval = cls(
-                **create_content_fn(
-                    info.context,
-                    content,
-                    required_keys=required_keys,
-                    authset=authorization,
-                )(transaction.atomic)
-            )
+            # a failed save keeps the claimed upload
+            with transaction.atomic():
+                if content.value and content.value.get("upload"):
+                    content.value["value"] = claim_upload(
+                        content.value.pop("upload"), cluster=cluster_obj
+                    )
+                returnval = cls(
+                    **create_content_fn(
+                        info.context,
+                        content,
+                        required_keys=required_keys,
+                        authset=authorization,
+                    )(transaction.atomic)
+                )
         initializeCachedResult(info.context, authset=authorization)
         return returnval
 
 
+class BulkCreateContentsMutation(relay.ClientIDMutation):
+    class Input:
+        cluster = graphene.ID(required=True)
+        contents = graphene.List(
+            graphene.NonNull(BulkContentInput), required=True
+        )
+        authorization = AuthList()
+
+    results = graphene.List(BulkContentResult)
+    writeok = graphene.Boolean()
+
+    @classmethod
+    def mutate_and_get_payload(
+        cls, root, info, cluster, contents, authorization=None
+    ):
+        if any(map(lambda x: x.value.get("upload"), contents)):
+            raise ValueError("Resumable uploads are not supported for bulk")
+        # authorize once for all contents
+        result = id_to_result(
+            info.context, cluster, Cluster, "create", authset=authorization
+        )
+        # only clusters granted by actions, not public clusters
+        cluster_obj = (
+            result["objects"]
+            .filter(id__in=result["required_keys_clusters"].keys())
+            .first()
+        )
+        if not cluster_obj:
+            raise ValueError("Cluster for Content not found")
+        required_keys = list(
+            Content.objects.injected_keys(
+                group=cluster_obj.group
+            ).values_list("contentHash", flat=True)
+        )
+        policy = next(iter(result["policies"].values()), None)
+        if policy:
+            required_keys.extend(policy.form.get("requiredKeys", []))
+            for content in contents:
+                content.value["tags"] = list(
+                    chain(
+                        policy.form.get("tags", []),
+                        content.value.get("tags") or [],
+                    )
+                )
+                content["references"] = policy.filter_references(
+                    content.get("references")
+                )
+        returnval = bulk_create_contents_fn(
+            info.context,
+            cluster_obj,
+            contents,
+            required_keys=required_keys,
+            authset=authorization,
+        )(transaction.atomic)
+        initializeCachedResult(info.context, authset=authorization)
+        return cls(
+            results=[BulkContentResult(**x) for x in returnval["results"]],
+            writeok=returnval["writeok"],
+        )
+
+
 class PushContentMutation(relay.ClientIDMutation):
     class Input:
         content = graphene.Field(PushContentInput, required=True)
@@ -357,6 +512,8 @@ class PushContentMutation(relay.ClientIDMutation):
 
     @classmethod
     def mutate_and_get_payload(cls, root, info, content, authorization=None):
+        if content.value.get("upload"):
+            raise ValueError("Resumable uploads are not supported for push")
         parent_id = content.pop("parent")
         result = id_to_result(
             info.context, parent_id, Content, "push", authset=authorization
@@ -364,27 +521,12 @@ class PushContentMutation(relay.ClientIDMutation):
         source = result["objects"].first()
         if not source:
             raise ValueError("Content not found")
-        form = result["forms"][source.actions.get(group="push").id]
-        if content.get("tags") is not None:
-            allowed = form.get("allowedTags", None)
-            if allowed is not None:
-                matcher = re.compile(
-                    "^(?:%s)(?:(?<==)|$)" % "|".join(map(re.escape, allowed))
-                )
-                content["tags"] = filter(
-                    lambda x: matcher.fullmatch(x), content["tags"]
-                )
-            content["tags"] = chain(
-                form.get("injectedTags", []), content["tags"]
-            )
-        else:
-            content["tags"] = form.get("injectedTags") or []
-        if content.get("references") is not None:
-            content["references"] = chain(
-                form.get("injectReferences", []), content["references"]
-            )
-        else:
-            content["references"] = form.get("injectReferences") or []
+        policy = result["policies"][source.actions.get(group="push").id]
+        form = policy.form
+        content["tags"] = policy.filter_tags(content.get("tags"))
+        content["references"] = policy.filter_references(
+            content.get("references")
+        )
         required_keys = list(
             Content.objects.injected_keys(group=source.group).values_list(
                 "contentHash", flat=True
@@ -392,8 +534,13 @@ class PushContentMutation(relay.ClientIDMutation):
         )
         required_keys.extend(form.get("requiredKeys", []))
         action_key = None
-        if form.pop("updateable", False):
-            freeze = form.pop("freeze", False)
+        if form.get("updateable", False):
+            freeze = form.get("freeze", False)
+            # policy is shared, create a modified copy
+            form = {
+                k: v for k, v in form.items()
+                if k not in {"updateable", "freeze"}
+            }
             action_key = os.urandom(32)
             content["actions"] = [
                 {
@@ -469,6 +616,61 @@ class TransferMutation(relay.ClientIDMutation):
         return cls(content=None)
 
 
+class BulkMetadataUpdateMutation(relay.ClientIDMutation):
+    class Input:
+        ids = graphene.List(graphene.ID, required=False)
+        clusters = graphene.List(graphene.ID, required=False)
+        includeTags = graphene.List(graphene.String, required=False)
+        excludeTags = graphene.List(graphene.String, required=False)
+        minUpdated = graphene.DateTime(required=False)
+        maxUpdated = graphene.DateTime(required=False)
+        authorization = AuthList()
+        tags = graphene.List(graphene.String, required=True)
+        operation = graphene.Enum.from_enum(MetadataOperations)(
+            required=False
+        )
+
+    count = graphene.Int()
+
+    @classmethod
+    def mutate_and_get_payload(
+        cls, root, info, tags, operation=None, authorization=None, **kwargs
+    ):
+        kwargs.pop("client_mutation_id", None)
+        if operation:
+            # graphene passes the value
+            operation = MetadataOperations(operation)
+        result = _bulk_contents_query(
+            info.context, "update", authorization=authorization, **kwargs
+        )
+        # the policies of a cluster apply only to its contents
+        clusters_by_tags = {}
+        for cluster_id in (
+            result["objects"].values_list("cluster_id", flat=True).distinct()
+        ):
+            cluster_tags = tags
+            for policy in (
+                result["cluster_policies"].get(cluster_id, {}).values()
+            ):
+                cluster_tags = policy.filter_tags(cluster_tags)
+            clusters_by_tags.setdefault(tuple(cluster_tags), []).append(
+                cluster_id
+            )
+        # validate all before writing
+        save_fns = [
+            bulk_update_metadata_fn(
+                result["objects"].filter(cluster_id__in=cluster_ids),
+                tags=cluster_tags,
+                operation=operation,
+            )
+            for cluster_tags, cluster_ids in clusters_by_tags.items()
+        ]
+        with transaction.atomic():
+            count = sum(map(lambda x: x(), save_fns))
+        initializeCachedResult(info.context, authset=authorization)
+        return cls(count=count)
+
+
 class MetadataUpdateMutation(relay.ClientIDMutation):
     class Input:
         id = graphene.ID(required=True)
@@ -1,14 +1,17 @@
-from graphene import Field, List, ID, ObjectType, relay
+from graphene import Field, Int, List, ID, ObjectType, String, relay
 from django.utils.translation import gettext_lazy as _
 
 from .arguments import AuthList
-from ..utils.auth import initializeCachedResult
+from ..utils.auth import initializeCachedResult, set_request_authset
 from .definitions import (
-    ClusterConnectionField, ContentConnectionField, SecretgraphConfig
+    ChangeFeed, ClusterConnectionField, ClusterDigest,
+    ContentConnectionField, SecretgraphConfig
 )
 from .mutations import (
-    ClusterMutation, ContentMutation, DeleteContentOrClusterMutation,
-    MetadataUpdateMutation, PushContentMutation, RegenerateFlexidMutation,
+    BulkCreateContentsMutation, BulkDeleteContentsMutation,
+    BulkMetadataUpdateMutation, ClusterMutation, ContentMutation,
+    DeleteContentOrClusterMutation, MetadataUpdateMutation,
+    PushContentMutation, RegenerateFlexidMutation,
     ResetDeletionContentOrClusterMutation
 )
 
@@ -23,9 +26,32 @@ class SecretgraphObject(ObjectType):
         )
     )
 
+    changes = Field(
+        ChangeFeed,
+        cursor=String(required=False),
+        clusters=List(ID, required=False),
+        limit=Int(required=False, default_value=100),
+        description=_("Changes of contents and clusters after cursor")
+    )
+    digest = Field(
+        ClusterDigest,
+        cluster=ID(required=True),
+        prefix=String(required=False, default_value=""),
+        description=_(
+            "Node of the hash tree over the contents of a cluster, "
+            "compare with a replica from the root down"
+        )
+    )
+
     def resolve_config(self, info, **kwargs):
         return SecretgraphConfig()
 
+    def resolve_changes(self, info, **kwargs):
+        return ChangeFeed.resolve_feed(info, **kwargs)
+
+    def resolve_digest(self, info, **kwargs):
+        return ClusterDigest.resolve_digest(info, **kwargs)
+
 
 class Query():
     secretgraph = Field(
@@ -35,9 +61,9 @@ class Query():
     def resolve_secretgraph(
         self, info, authorization=None, **kwargs
     ):
-        initializeCachedResult(
-            info.context, authset=authorization
-        )
+        # nested fields without authorization use this authset
+        set_request_authset(info.context, authorization)
+        initializeCachedResult(info.context)
         return SecretgraphObject()
 
 
@@ -49,14 +75,32 @@ class Mutation():
             "  content (value): a content encrypted by public key"
         )
     )
+    bulkCreateContents = BulkCreateContentsMutation.Field(
+        description=_(
+            "Create many contents in one cluster with one authorization "
+            "and one transaction"
+        )
+    )
     updateOrCreateCluster = ClusterMutation.Field(
         description=_(
             "Create a cluster, optionally initialize with a key-(pair)"
         )
     )
     updateMetadata = MetadataUpdateMutation.Field()
+    bulkUpdateMetadata = BulkMetadataUpdateMutation.Field(
+        description=_(
+            "Change tags of contents selected by ids or filters, "
+            "returns the amount of changed contents"
+        )
+    )
     pushContent = PushContentMutation.Field()
     regenerateFlexid = RegenerateFlexidMutation.Field()
     deleteContentOrCluster = DeleteContentOrClusterMutation.Field()
+    bulkDeleteContents = BulkDeleteContentsMutation.Field(
+        description=_(
+            "Mark contents selected by ids or filters for deletion, "
+            "returns the amount of marked contents"
+        )
+    )
     resetDeletionContentOrCluster = \
         ResetDeletionContentOrClusterMutation.Field()
@@ -0,0 +1,517 @@
+import atexit
+import hashlib
+import logging
+import mmap
+import os
+import posixpath
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import timedelta
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.core.files.utils import validate_file_name
+from django.db import models, transaction
+from django.utils import timezone
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+def fanout_path(dirname, filename):
+    """
+    Spreads files over 2 levels of 256 directories
+    prefixes are derived from a hash of filename, so they also work for
+    case-insensitive file systems and existing file names
+    """
+    digest = hashlib.sha256(filename.encode("utf8")).hexdigest()
+    return posixpath.join(dirname, digest[:2], digest[2:4], filename)
+
+
+def is_fanout_path(name):
+    dirname, filename = posixpath.split(name)
+    root = posixpath.dirname(posixpath.dirname(dirname))
+    return fanout_path(root, filename) == name
+
+
+class ShardedFileSystemStorage(FileSystemStorage):
+    """
+    FileSystemStorage without existence checks before writing
+
+    File names are random, collisions are detected by the exclusive
+    create (O_EXCL) of FileSystemStorage._save, which only then falls back
+    to get_available_name
+    """
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        if max_length is not None and len(name) > max_length:
+            name = self.get_available_name(name, max_length=max_length)
+        name = self._save(name, content)
+        validate_file_name(name, allow_relative_path=True)
+        return name
+
+    def migrate_name(self, name):
+        """
+        Links a file of the flat layout into the fanout layout
+        Returns the new name, the old name has to be deleted by the caller
+        """
+        if is_fanout_path(name):
+            return name
+        dirname, filename = posixpath.split(name)
+        new_name = fanout_path(dirname, filename)
+        new_path = self.path(new_name)
+        os.makedirs(os.path.dirname(new_path), exist_ok=True)
+        try:
+            os.link(self.path(name), new_path)
+        except FileExistsError:
+            # migrated concurrently
+            pass
+        return new_name
+
+
+# suffix of names stored in segments
+PACKED_SUFFIX = ".packed"
+SEGMENT_SUFFIX = ".segment"
+# marker of segments which are never appended again
+SEALED_SUFFIX = ".sealed"
+
+
+class PackfileStorage(ShardedFileSystemStorage):
+    """
+    Appends small files to large segment files, an offset index is kept
+    in PackedBlob
+
+    Every process appends to its own segment and holds a lock on it.
+    Reads use mmap, deletes only set a tombstone, the space is reclaimed
+    by the compact_packs command.
+    Full segments are sealed, only sealed segments are compacted.
+    Segments of dead processes are sealed by the compaction.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._writer_lock = threading.Lock()
+        # pid, segment name, file descriptor, size
+        self._writer = None
+        self._maps_lock = threading.Lock()
+        self._maps = OrderedDict()
+        atexit.register(self.close_writer)
+
+    @property
+    def pack_dir(self):
+        return getattr(settings, "SECRETGRAPH_PACK_DIR", "packs")
+
+    @property
+    def max_blob_size(self):
+        return getattr(settings, "SECRETGRAPH_PACK_MAX_SIZE", 4096)
+
+    @property
+    def segment_size(self):
+        return getattr(
+            settings, "SECRETGRAPH_PACK_SEGMENT_SIZE", 64 * 1024 * 1024
+        )
+
+    def is_packed(self, name):
+        return name.endswith(PACKED_SUFFIX)
+
+    def _get_blob(self, name):
+        from .models import PackedBlob
+
+        blob = PackedBlob.objects.filter(name=name, deleted__isnull=True)
+        blob = blob.only("segment", "offset", "length").first()
+        if not blob:
+            raise FileNotFoundError(name)
+        return blob
+
+    def _seal_path(self, segment):
+        return self.path("%s%s" % (segment, SEALED_SUFFIX))
+
+    def is_sealed(self, segment):
+        return os.path.exists(self._seal_path(segment))
+
+    def seal(self, segment):
+        """ marks segment as complete, it is never appended again """
+        try:
+            os.close(os.open(self._seal_path(segment), os.O_CREAT, 0o666))
+        except FileNotFoundError:
+            # segment was deleted
+            pass
+
+    def _open_segment(self):
+        while True:
+            segment = posixpath.join(
+                self.pack_dir,
+                "%s%s" % (secrets.token_hex(16), SEGMENT_SUFFIX),
+            )
+            path = self.path(segment)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd = os.open(
+                path,
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_APPEND,
+                0o666,
+            )
+            if fcntl:
+                # held until the segment is sealed, released if the
+                # process dies
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            # the compaction could have sealed it before it was locked
+            if not self.is_sealed(segment):
+                return [os.getpid(), segment, fd, 0]
+            os.close(fd)
+
+    def close_writer(self):
+        """ seals and closes the segment of this process """
+        with self._writer_lock:
+            writer = self._writer
+            self._writer = None
+            # forked processes must not seal the segment of the parent
+            if writer and writer[0] == os.getpid():
+                self.seal(writer[1])
+                os.close(writer[2])
+
+    def _seal_if_abandoned(self, segment):
+        """ seals segment if no process writes it, returns True if sealed """
+        if not fcntl:
+            return False
+        try:
+            fd = os.open(self.path(segment), os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            self.seal(segment)
+            return True
+        finally:
+            os.close(fd)
+
+    def append(self, data):
+        """
+        Appends data to the segment of this process
+        Returns segment name and offset
+        """
+        with self._writer_lock:
+            writer = self._writer
+            # forked processes must not share the segment of the parent
+            if (
+                not writer
+                or writer[0] != os.getpid()
+                or writer[3] + len(data) > self.segment_size
+                or self.is_sealed(writer[1])
+            ):
+                if writer and writer[0] == os.getpid():
+                    self.seal(writer[1])
+                    os.close(writer[2])
+                writer = self._writer = self._open_segment()
+            offset = writer[3]
+            view = memoryview(data)
+            while view:
+                view = view[os.write(writer[2], view):]
+            getattr(os, "fdatasync", os.fsync)(writer[2])
+            writer[3] += len(data)
+            return writer[1], offset
+
+    def read_blob(self, segment, offset, length):
+        end = offset + length
+        with self._maps_lock:
+            mapped = self._maps.get(segment)
+            if mapped is None or len(mapped) < end:
+                with open(self.path(segment), "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[segment] = mapped
+            self._maps.move_to_end(segment)
+            while len(self._maps) > 64:
+                # mappings in use stay valid until they are garbage collected
+                self._maps.popitem(last=False)
+            if len(mapped) < end:
+                raise IOError("segment %s is truncated" % segment)
+            return mapped[offset:end]
+
+    def _save(self, name, content):
+        from .models import PackedBlob
+
+        if content.size is None or content.size > self.max_blob_size:
+            return super()._save(name, content)
+        data = b"".join(content.chunks())
+        if len(data) > self.max_blob_size:
+            return super()._save(name, content)
+        segment, offset = self.append(data)
+        name = "%s%s" % (name, PACKED_SUFFIX)
+        PackedBlob.objects.create(
+            name=name, segment=segment, offset=offset, length=len(data)
+        )
+        return name
+
+    def _open(self, name, mode="rb"):
+        if not self.is_packed(name):
+            return super()._open(name, mode)
+        if "w" in mode or "a" in mode or "+" in mode:
+            raise ValueError("packed files are read-only")
+        blob = self._get_blob(name)
+        return File(
+            BytesIO(self.read_blob(blob.segment, blob.offset, blob.length)),
+            name,
+        )
+
+    def delete(self, name):
+        from .models import PackedBlob
+
+        if not self.is_packed(name):
+            return super().delete(name)
+        PackedBlob.objects.filter(name=name, deleted__isnull=True).update(
+            deleted=timezone.now()
+        )
+
+    def exists(self, name):
+        if not self.is_packed(name):
+            return super().exists(name)
+        try:
+            self._get_blob(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def size(self, name):
+        if not self.is_packed(name):
+            return super().size(name)
+        return self._get_blob(name).length
+
+    def path(self, name):
+        if self.is_packed(name):
+            raise NotImplementedError("packed files have no own path")
+        return super().path(name)
+
+    def migrate_name(self, name):
+        if self.is_packed(name):
+            return name
+        return super().migrate_name(name)
+
+    def compact(self, min_dead_ratio=0.5, min_age=3600, batch_size=500):
+        """
+        Drops old tombstones and moves live blobs out of sealed segments
+        with at least min_dead_ratio dead bytes
+
+        Segments are compacted min_age seconds after sealing, so blobs
+        appended before can be committed. Segments without entries are
+        deleted in the next run, so readers of the old location have time
+        to finish
+        Returns amount of compacted and deleted segments
+        """
+        from .models import PackedBlob
+
+        threshold = timezone.now() - timedelta(seconds=min_age)
+        PackedBlob.objects.filter(deleted__lt=threshold).delete()
+        try:
+            files = super().listdir(self.pack_dir)[1]
+        except FileNotFoundError:
+            return 0, 0
+        own = self._writer and self._writer[1]
+        compacted = 0
+        deleted = 0
+        for filename in files:
+            if not filename.endswith(SEGMENT_SUFFIX):
+                continue
+            segment = posixpath.join(self.pack_dir, filename)
+            if segment == own:
+                continue
+            try:
+                sealed = self._datetime_from_timestamp(
+                    os.path.getmtime(self._seal_path(segment))
+                )
+            except FileNotFoundError:
+                # in use or the writer died, then it is compacted later
+                self._seal_if_abandoned(segment)
+                continue
+            if sealed > threshold:
+                continue
+            try:
+                total = super().size(segment)
+            except FileNotFoundError:
+                continue
+            blobs = PackedBlob.objects.filter(segment=segment)
+            if not blobs.exists():
+                super().delete(segment)
+                super().delete("%s%s" % (segment, SEALED_SUFFIX))
+                deleted += 1
+                continue
+            live = blobs.filter(deleted__isnull=True).order_by("offset")
+            live_bytes = sum(live.values_list("length", flat=True))
+            if total and (total - live_bytes) / total < min_dead_ratio:
+                continue
+            while True:
+                batch = list(live.only("id", "offset", "length")[:batch_size])
+                if not batch:
+                    break
+                for blob in batch:
+                    data = self.read_blob(segment, blob.offset, blob.length)
+                    new_segment, new_offset = self.append(data)
+                    # blob could have been deleted meanwhile
+                    PackedBlob.objects.filter(
+                        id=blob.id, segment=segment, offset=blob.offset
+                    ).update(segment=new_segment, offset=new_offset)
+            blobs.filter(deleted__isnull=False).delete()
+            compacted += 1
+        return compacted, deleted
+
+
+class DedupStorage(ShardedFileSystemStorage):
+    """
+    Stores every unique file once under its sha256, contents with the
+    same bytes share the file, SharedBlob counts the references
+
+    Shared files are never modified: path() is not available for them,
+    so updates write a new file (copy-on-write) and delete() only
+    decrements the reference count
+    """
+
+    @property
+    def blob_dir(self):
+        return getattr(settings, "SECRETGRAPH_BLOB_DIR", "blobs")
+
+    def is_shared(self, name):
+        return name.startswith("%s/" % self.blob_dir) and name.endswith(
+            ".blob"
+        )
+
+    def _save(self, name, content):
+        from .models import SharedBlob
+
+        tmp_path = None
+        if hasattr(content, "temporary_file_path") and hasattr(
+            content, "sha256"
+        ):
+            # staged upload, already hashed while streaming
+            digest = content.sha256
+            source_path = content.temporary_file_path()
+        else:
+            tmp_name = posixpath.join(
+                self.blob_dir, "tmp", "%s.tmp" % secrets.token_hex(16)
+            )
+            tmp_path = source_path = super().path(tmp_name)
+            os.makedirs(os.path.dirname(tmp_path), exist_ok=True)
+            # hash while streaming into a temporary file on the same
+            # filesystem
+            hasher = hashlib.sha256()
+            with open(tmp_path, "xb") as f:
+                for chunk in content.chunks():
+                    hasher.update(chunk)
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            digest = hasher.hexdigest()
+        try:
+            name = fanout_path(self.blob_dir, "%s.blob" % digest)
+            path = super().path(name)
+            with transaction.atomic():
+                # the update locks the row until the file is linked,
+                # get_or_create uses a savepoint for concurrent creates
+                blobs = SharedBlob.objects.filter(name=name)
+                while not blobs.update(refcount=models.F("refcount") + 1):
+                    SharedBlob.objects.get_or_create(name=name)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                try:
+                    os.link(source_path, path)
+                except FileExistsError:
+                    # blob exists already
+                    pass
+                except OSError:
+                    # staged file on another filesystem
+                    file_move_safe(source_path, path)
+        finally:
+            if tmp_path:
+                os.unlink(tmp_path)
+        return name
+
+    def delete(self, name):
+        from .models import SharedBlob
+
+        if not self.is_shared(name):
+            return super().delete(name)
+        with transaction.atomic():
+            blob = (
+                SharedBlob.objects.select_for_update()
+                .filter(name=name)
+                .first()
+            )
+            if blob and blob.refcount > 1:
+                SharedBlob.objects.filter(id=blob.id).update(
+                    refcount=models.F("refcount") - 1
+                )
+                return
+            if blob:
+                blob.delete()
+            # last reference or a file without reference count
+            try:
+                os.remove(super().path(name))
+            except FileNotFoundError:
+                pass
+
+    def path(self, name):
+        if self.is_shared(name):
+            raise NotImplementedError("shared files cannot be modified")
+        return super().path(name)
+
+    def _open(self, name, mode="rb"):
+        if self.is_shared(name) and mode not in ("r", "rb"):
+            raise ValueError("shared files are read-only")
+        return File(open(super().path(name), mode))
+
+    def exists(self, name):
+        return os.path.lexists(super().path(name))
+
+    def size(self, name):
+        return os.path.getsize(super().path(name))
+
+    def get_modified_time(self, name):
+        return self._datetime_from_timestamp(
+            os.path.getmtime(super().path(name))
+        )
+
+
+def migrate_file_path(instance, field_name):
+    """
+    Lazily moves the file of instance into the fanout layout
+    Returns True if the file was moved
+    """
+    from .utils.delete import enqueue_file_deletions
+
+    fieldfile = getattr(instance, field_name)
+    old_name = fieldfile.name
+    if not old_name or not hasattr(fieldfile.storage, "migrate_name"):
+        return False
+    if is_fanout_path(old_name):
+        return False
+    try:
+        new_name = fieldfile.storage.migrate_name(old_name)
+    except OSError as exc:
+        logger.warning("Could not migrate file: %s", old_name, exc_info=exc)
+        return False
+    if new_name == old_name:
+        return False
+    query = type(instance).objects.filter(id=instance.id)
+    with transaction.atomic():
+        updated = query.filter(**{field_name: old_name}).update(
+            **{field_name: new_name}
+        )
+        if updated:
+            enqueue_file_deletions([old_name])
+        elif not query.filter(**{field_name: new_name}).exists():
+            # file was replaced concurrently, remove the orphaned link
+            enqueue_file_deletions([new_name])
+    if updated:
+        fieldfile.name = new_name
+    return bool(updated)
@@ -1,5 +1,8 @@
 from django.urls import path
-from .views import ContentView, ClusterView
+from django.views.decorators.csrf import csrf_exempt
+from .views import (
+    ChangeStreamView, ClusterDigestView, ContentView, ClusterView, UploadView
+)
 
 app_name = "secretgraph"
 
@@ -9,6 +12,11 @@ urlpatterns = [
         ClusterView.as_view(),
         name="clusters"
     ),
+    path(
+        "clusters/<slug:id>/digest/",
+        ClusterDigestView.as_view(),
+        name="clusters-digest"
+    ),
     path(
         "contents/",
         ContentView.as_view(),
@@ -29,4 +37,19 @@ urlpatterns = [
         ContentView.as_view(action="update"),
         name="contents-update"
     ),
+    path(
+        "changes/",
+        ChangeStreamView.as_view(),
+        name="changes"
+    ),
+    path(
+        "uploads/",
+        csrf_exempt(UploadView.as_view()),
+        name="uploads"
+    ),
+    path(
+        "uploads/<slug:id>/",
+        csrf_exempt(UploadView.as_view()),
+        name="uploads"
+    ),
 ]
@@ -1,17 +1,16 @@
 import base64
-import json
 import logging
 from uuid import UUID
 
-from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from django.apps import apps
 from django.db import models
 from django.utils import timezone
 from graphql_relay import from_global_id
 
 from ..actions.handler import ActionHandler
+from ..actions.policy import get_action_policy
 from ..models import Action, Cluster, Content
-from .misc import calculate_hashes
+from .misc import calculate_hashes, hash_index, hash_index_filter
 
 logger = logging.getLogger(__name__)
 
@@ -30,11 +29,7 @@ class LazyViewResult(object):
         for r in viewResults:
             self._result_dict[r["objects"].model.__name__] = r
         if self.authset is None:
-            self.authset = (
-                request.headers.get("Authorization", "")
-                .replace(" ", "")
-                .split(",")
-            )
+            self.authset = get_request_authset(request)
 
     def __getitem__(self, item):
         if item in _cached_classes:
@@ -46,8 +41,10 @@ class LazyViewResult(object):
                     authset=self.authset,
                 )
             return self._result_dict[item]
-        if item in {"authset", "scope"}:
+        if item == "authset":
             return self.authset
+        if item == "scope":
+            return self.scope
         raise KeyError()
 
     def get(self, item, default=None):
@@ -57,18 +54,72 @@ class LazyViewResult(object):
             return default
 
 
+def get_request_authset(request):
+    """
+    Returns the own authset of request: the tokens set with
+    set_request_authset or the tokens of the Authorization header
+    """
+    authset = getattr(request, "secretgraphAuthset", None)
+    if authset is None:
+        authset = (
+            request.headers.get("Authorization", "")
+            .replace(" ", "")
+            .split(",")
+        )
+    return authset
+
+
+def set_request_authset(request, authset):
+    """ Sets the authset used by calls without explicit authset """
+    if authset is not None:
+        request.secretgraphAuthset = list(authset)
+
+
+def resetCachedResults(request):
+    """ Drops the cached results, long running requests recheck with it """
+    request.secretgraphResults = {}
+    if hasattr(request, "secretgraphResult"):
+        del request.secretgraphResult
+
+
 def initializeCachedResult(
-    request, *viewResults, authset=None, scope="view", name="secretgraphResult"
+    request, *viewResults, authset=None, scope="view", name=None
 ):
-    if not getattr(request, name, None):
-        setattr(
+    """
+    Returns the cached result of scope and authset for request
+    Without authset the result of the own authset of the request is
+    returned
+    """
+    if name:
+        if not getattr(request, name, None):
+            setattr(
+                request,
+                name,
+                LazyViewResult(
+                    request, *viewResults, scope=scope, authset=authset
+                ),
+            )
+        return getattr(request, name)
+    results = getattr(request, "secretgraphResults", None)
+    if results is None:
+        results = request.secretgraphResults = {}
+    default_key = (scope, frozenset(get_request_authset(request)))
+    if authset is None:
+        key = default_key
+    else:
+        key = (scope, frozenset(authset))
+    if key not in results:
+        results[key] = LazyViewResult(
             request,
-            name,
-            LazyViewResult(
-                request, *viewResults, scope=scope, authset=authset
-            ),
+            *viewResults,
+            scope=scope,
+            authset=get_request_authset(request)
+            if authset is None
+            else authset,
         )
-    return getattr(request, name)
+    if scope == "view" and key == default_key:
+        request.secretgraphResult = results[key]
+    return results[key]
 
 
 _allowed_types = {"Cluster"}
@@ -110,6 +161,9 @@ def retrieve_allowed_objects(request, scope, query, authset=None):
         "rejecting_action": None,
         "clusters": {},
         "forms": {},
+        "policies": {},
+        # policies per cluster id, for applying them per cluster
+        "cluster_policies": {},
         "actions": Action.objects.none(),
         "action_key_map": {},
         "required_keys_clusters": {},
@@ -139,27 +193,28 @@ def retrieve_allowed_objects(request, scope, query, authset=None):
         finally:
             if not isinstance(action_key, bytes) or len(action_key) != 32:
                 continue
-        aesgcm = AESGCM(action_key)
         keyhashes = calculate_hashes(action_key)
 
         actions = pre_filtered_actions.filter(
-            cluster__flexid=clusterflexid, keyHash__in=keyhashes
+            cluster__flexid=clusterflexid,
+            **hash_index_filter("keyHash", keyhashes),
         )
         if not actions:
             continue
 
         filters = models.Q()
+        policies = {}
+        # all objects of the cluster are accessible
+        unrestricted = False
         # 0 default
         # 1 normal
         # 2 owner
         # 3 special
         accesslevel = 0
         for action in actions:
-            action_dict = json.loads(
-                aesgcm.decrypt(
-                    base64.b64decode(action.nonce), action.value, None
-                )
-            )
+            # keyHash matched, so action_key is the right key
+            policy = get_action_policy(action, action_key)
+            action_dict = policy.action_dict
             result = ActionHandler.handle_action(
                 query.model,
                 action_dict,
@@ -168,6 +223,7 @@ def retrieve_allowed_objects(request, scope, query, authset=None):
                 accesslevel=accesslevel,
                 request=request,
                 authset=authset,
+                policy=policy,
             )
             if result is None:
                 continue
@@ -185,13 +241,20 @@ def retrieve_allowed_objects(request, scope, query, authset=None):
                 ].setdefault(action.cluster_id, {})
 
             foundaccesslevel = result["accesslevel"]
+            # content actions are restricted to their content
+            found_unrestricted = bool(
+                result.get("unrestricted") and not action.contentAction
+            )
 
             if accesslevel < foundaccesslevel:
                 accesslevel = foundaccesslevel
+                unrestricted = found_unrestricted
                 filters = result.get("filters", models.Q())
-                form = result.get("form")
+                form = result.get("form") or {}
                 if form:
                     returnval["forms"] = {action.id: form}
+                    returnval["policies"] = {action.id: policy}
+                    policies = {action.id: policy}
 
                 required_keys_dict[(action_dict["action"], action.keyHash)] = {
                     "id": action.id,
@@ -199,10 +262,13 @@ def retrieve_allowed_objects(request, scope, query, authset=None):
                     "allowedTags": form.get("allowedTags"),
                 }
             elif accesslevel == foundaccesslevel:
+                unrestricted = unrestricted and found_unrestricted
                 filters &= result.get("filters", models.Q())
-                form = result.get("form")
+                form = result.get("form") or {}
                 if form:
                     returnval["forms"].setdefault(action.id, form)
+                    returnval["policies"].setdefault(action.id, policy)
+                    policies.setdefault(action.id, policy)
                 required_keys_dict.setdefault(
                     (action_dict["action"], action.keyHash),
                     {
@@ -213,10 +279,15 @@ def retrieve_allowed_objects(request, scope, query, authset=None):
 
             if action.keyHash != keyhashes[0]:
                 Action.objects.filter(keyHash=action.keyHash).update(
-                    keyHash=keyhashes[0]
+                    keyHash=keyhashes[0], keyHashIndex=hash_index(keyhashes[0])
                 )
+        if policies:
+            returnval["cluster_policies"].setdefault(
+                actions[0].cluster_id, {}
+            ).update(policies)
         returnval["clusters"][clusterflexid] = {
             "filters": filters,
+            "unrestricted": unrestricted,
             "accesslevel": accesslevel,
             "action_key": action_key,
             "actions": actions,
@@ -295,7 +366,7 @@ def fetch_by_id(
         addto.add(f)
     filters = {f"{prefix}flexid__in": flexid_set}
     if chash_set:
-        filters[f"{prefix}contentHash__in"] = chash_set
+        filters.update(hash_index_filter(f"{prefix}contentHash", chash_set))
     return query.filter(**filters)
 
 
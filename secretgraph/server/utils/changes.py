@@ -0,0 +1,335 @@
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import (
+    close_old_connections,
+    connection,
+    router,
+    transaction,
+)
+from django.db.models import Max
+from django.utils import timezone
+
+from ...constants import ChangeOperation
+from ..models import Change, ChangeSequence, Cluster
+from .auth import initializeCachedResult
+from .digest import touch_digests
+
+logger = logging.getLogger(__name__)
+
+
+def log_changes(rows, operation, using=None):
+    """
+    Appends changes in the current transaction and marks the digest
+    buckets of changed contents as stale
+    rows are tuples of (cluster_id, content_id or None, flexid, updateId)
+    """
+    if isinstance(operation, ChangeOperation):
+        operation = operation.value
+    rows = list(rows)
+    using = using or router.db_for_write(Change)
+    Change.objects.using(using).bulk_create(
+        Change(
+            clusterId=cluster_id,
+            contentId=content_id,
+            flexid=flexid,
+            updateId=updateId,
+            operation=operation,
+        )
+        for cluster_id, content_id, flexid, updateId in rows
+    )
+    touch_digests(rows, using=using)
+    transaction.on_commit(lambda: _sequence_after_commit(using), using=using)
+
+
+def sequence_changes(using=None, batch_size=500):
+    """
+    Numbers the committed changes without sequence in one transaction,
+    holding the lock of the counter
+
+    Sequences are assigned after the commit of the changes and are
+    visible together, so a reader which saw a sequence can never miss
+    a smaller one
+    Returns amount of sequenced changes
+    """
+    using = using or router.db_for_write(Change)
+    pending = Change.objects.using(using).filter(sequence__isnull=True)
+    if not pending.exists():
+        return 0
+    ChangeSequence.objects.using(using).get_or_create(id=1)
+    with transaction.atomic(using=using):
+        counter = (
+            ChangeSequence.objects.using(using)
+            .select_for_update()
+            .get(id=1)
+        )
+        # read after the lock, changes sequenced before are excluded
+        changes = list(pending.order_by("id").only("id"))
+        for change in changes:
+            counter.last += 1
+            change.sequence = counter.last
+        Change.objects.using(using).bulk_update(
+            changes, ["sequence"], batch_size=batch_size
+        )
+        counter.save(update_fields=["last"])
+    return len(changes)
+
+
+def _sequence_after_commit(using):
+    try:
+        sequence_changes(using=using)
+    except Exception as exc:
+        # the data is committed, the next run sequences the changes
+        logger.warning("Sequencing changes failed", exc_info=exc)
+
+
+def _sequence_stale_changes(using=None):
+    """ sequences changes which were left by dead processes """
+    using = using or router.db_for_write(Change)
+    if (
+        Change.objects.using(using)
+        .filter(
+            sequence__isnull=True,
+            created__lt=timezone.now() - get_changes_delay(),
+        )
+        .exists()
+    ):
+        sequence_changes(using=using)
+
+
+def log_content_changes(contents, operation, using=None):
+    log_changes(
+        map(lambda x: (x.cluster_id, x.id, x.flexid, x.updateId), contents),
+        operation,
+        using=using,
+    )
+
+
+def log_cluster_changes(clusters, operation, using=None):
+    log_changes(
+        map(lambda x: (x.id, None, x.flexid, x.updateId), clusters),
+        operation,
+        using=using,
+    )
+
+
+def get_changes_delay():
+    """ changes without sequence for this time are sequenced by readers """
+    return timedelta(
+        seconds=getattr(settings, "SECRETGRAPH_CHANGES_DELAY", 2)
+    )
+
+
+def get_visible_cluster_ids(request, authset=None):
+    """ clusters of the actions of authset, the scope of change feeds """
+    result = initializeCachedResult(request, authset=authset)
+    cluster_ids = set(
+        result["Content"]["actions"].values_list("cluster_id", flat=True)
+    )
+    cluster_ids.update(
+        result["Cluster"]["actions"].values_list("cluster_id", flat=True)
+    )
+    return cluster_ids
+
+
+def get_full_view_cluster_ids(request, authset=None):
+    """
+    clusters in which authset can view every content (manage or view
+    without tag filters)
+    """
+    result = initializeCachedResult(request, authset=authset)
+    flexids = [
+        flexid
+        for flexid, entry in result["Content"]["clusters"].items()
+        if entry["unrestricted"]
+    ]
+    if not flexids:
+        return set()
+    return set(
+        Cluster.objects.filter(flexid__in=flexids).values_list(
+            "id", flat=True
+        )
+    )
+
+
+def fetch_changes(
+    request, cursor=None, clusters=None, limit=100, authset=None
+):
+    """
+    Returns the changes visible to authset after cursor in commit order
+
+    Only the clusters of the actions of authset are scanned, so the cost
+    depends on the amount of changes instead of the amount of objects
+    Deletions of contents are only returned for clusters in full view,
+    otherwise they would reveal flexids of hidden contents
+
+    Returns dict with changes, the new cursor, hasMore and resync
+    (changes after cursor were pruned, the client must fetch everything)
+    """
+    result = initializeCachedResult(request, authset=authset)
+    cluster_ids = get_visible_cluster_ids(request, authset=authset)
+    if clusters is not None:
+        cluster_ids.intersection_update(clusters)
+    _sequence_stale_changes()
+    resync = False
+    if cursor is not None:
+        oldest = (
+            Change.objects.filter(sequence__isnull=False)
+            .order_by("sequence")
+            .values("sequence")
+            .first()
+        )
+        # sequences have no gaps, except by pruning
+        resync = bool(oldest and oldest["sequence"] > cursor + 1)
+    query = Change.objects.filter(
+        clusterId__in=cluster_ids, sequence__isnull=False
+    )
+    if cursor is not None:
+        query = query.filter(sequence__gt=cursor)
+    scanned = list(query.order_by("sequence")[:limit])
+    # changes of objects which are not visible anymore are skipped
+    visible_contents = set(
+        result["Content"]["objects"]
+        .filter(id__in={x.contentId for x in scanned if x.contentId})
+        .values_list("id", flat=True)
+    )
+    visible_clusters = set(
+        result["Cluster"]["objects"]
+        .filter(id__in={x.clusterId for x in scanned if not x.contentId})
+        .values_list("id", flat=True)
+    )
+    full_view = None
+    changes = []
+    for change in scanned:
+        if change.operation != ChangeOperation.delete.value:
+            if change.contentId:
+                if change.contentId not in visible_contents:
+                    continue
+            elif change.clusterId not in visible_clusters:
+                continue
+        elif change.contentId:
+            if full_view is None:
+                full_view = get_full_view_cluster_ids(
+                    request, authset=authset
+                )
+            if change.clusterId not in full_view:
+                continue
+        # tombstones of clusters are visible for all with access to them
+        changes.append(change)
+    if scanned:
+        cursor = scanned[-1].sequence
+    elif resync:
+        # the client fetches everything, continue after the pruned changes
+        cursor = oldest["sequence"] - 1
+    return {
+        "changes": changes,
+        "cursor": cursor,
+        "hasMore": len(scanned) == limit,
+        "resync": resync,
+    }
+
+
+def prune_changes(max_age, using=None):
+    """
+    Deletes changes older than max_age (timedelta)
+    Returns amount of deleted changes
+    """
+    using = using or router.db_for_write(Change)
+    newest = (
+        Change.objects.using(using)
+        .aggregate(newest=Max("sequence"))["newest"]
+    )
+    if newest is None:
+        return 0
+    # the newest change is kept, fetch_changes detects pruned cursors by it
+    return (
+        Change.objects.using(using)
+        .filter(
+            created__lt=timezone.now() - max_age,
+            sequence__lt=newest,
+        )
+        .delete()[0]
+    )
+
+
+class ChangeBroker(object):
+    """
+    Polls the change log once for all streams of the process and wakes
+    the streams subscribed to changed clusters, runs only while streams
+    are subscribed
+    """
+
+    def __init__(self, interval=1.0):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.subscribers = {}
+        self.thread = None
+        self.last_sequence = None
+
+    def subscribe(self, cluster_ids):
+        """ Returns an event which is set on changes in cluster_ids """
+        event = threading.Event()
+        with self.lock:
+            self.subscribers[event] = frozenset(cluster_ids)
+            if not self.thread:
+                self.thread = threading.Thread(
+                    target=self.run, name="ChangeBroker", daemon=True
+                )
+                self.thread.start()
+        return event
+
+    def unsubscribe(self, event):
+        with self.lock:
+            self.subscribers.pop(event, None)
+
+    def poll(self):
+        """ Returns clusters with changes since the last poll """
+        _sequence_stale_changes()
+        query = Change.objects.filter(sequence__isnull=False)
+        if self.last_sequence is None:
+            self.last_sequence = (
+                query.aggregate(last=Max("sequence"))["last"] or 0
+            )
+            return set()
+        rows = list(
+            query.filter(sequence__gt=self.last_sequence)
+            .order_by("sequence")
+            .values_list("sequence", "clusterId")[:1000]
+        )
+        if rows:
+            self.last_sequence = rows[-1][0]
+        return set(map(lambda x: x[1], rows))
+
+    def run(self):
+        try:
+            while True:
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        return
+                close_old_connections()
+                try:
+                    changed = self.poll()
+                except Exception as exc:
+                    logger.warning("Polling changes failed", exc_info=exc)
+                    changed = set()
+                if changed:
+                    with self.lock:
+                        for event, cluster_ids in self.subscribers.items():
+                            if not cluster_ids.isdisjoint(changed):
+                                event.set()
+                time.sleep(self.interval)
+        except BaseException:
+            with self.lock:
+                self.thread = None
+            raise
+        finally:
+            connection.close()
+
+
+change_broker = ChangeBroker(
+    getattr(settings, "SECRETGRAPH_STREAM_POLL_INTERVAL", 1.0)
+)
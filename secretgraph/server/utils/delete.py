@@ -0,0 +1,263 @@
+import logging
+import threading
+from contextlib import contextmanager
+from itertools import islice
+
+from django.db import connections, router, transaction
+from django.db.models import QuerySet
+
+from ...constants import ChangeOperation, DeleteRecursive
+from ..models import Content, ContentReference, PendingFileDeletion
+from .changes import log_changes
+from .quota import account_deletions, storage_size
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+@contextmanager
+def set_based_deletion():
+    """
+    Marks deletions of the Collector as handled by the set-based path,
+    the pre_delete callbacks skip them
+    """
+    _local.depth = getattr(_local, "depth", 0) + 1
+    try:
+        yield
+    finally:
+        _local.depth -= 1
+
+
+def in_set_based_deletion():
+    return getattr(_local, "depth", 0) > 0
+
+
+def _batched(iterable, batch_size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def _recursive_sources_cte(frontier, using):
+    """
+    transitive closure over DeleteRecursive.TRUE references in one query
+    """
+    connection = connections[using]
+    table = connection.ops.quote_name(ContentReference._meta.db_table)
+    source = connection.ops.quote_name(
+        ContentReference._meta.get_field("source").column
+    )
+    target = connection.ops.quote_name(
+        ContentReference._meta.get_field("target").column
+    )
+    delete_recursive = connection.ops.quote_name(
+        ContentReference._meta.get_field("deleteRecursive").column
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"""
+            WITH RECURSIVE closure(id) AS (
+                SELECT unnest(%s::bigint[])
+                UNION
+                SELECT r.{source} FROM {table} r
+                INNER JOIN closure c ON r.{target} = c.id
+                WHERE r.{delete_recursive} = true
+            ) SELECT id FROM closure
+            """,
+            [list(frontier)],
+        )
+        return set(map(lambda x: x[0], cursor.fetchall()))
+
+
+def _recursive_sources(frontier, using, batch_size):
+    """
+    one level of DeleteRecursive.TRUE references
+    """
+    result = set()
+    for batch in _batched(frontier, batch_size):
+        result.update(
+            ContentReference.objects.using(using)
+            .filter(
+                target_id__in=batch,
+                deleteRecursive=DeleteRecursive.TRUE.value,
+            )
+            .values_list("source_id", flat=True)
+        )
+    return result
+
+
+def _no_group_sources(frontier, deleted, using, batch_size):
+    """
+    sources which lose the last reference of a group with
+    DeleteRecursive.NO_GROUP references
+    """
+    candidates = set()
+    for batch in _batched(frontier, batch_size):
+        candidates.update(
+            ContentReference.objects.using(using)
+            .filter(
+                target_id__in=batch,
+                deleteRecursive=DeleteRecursive.NO_GROUP.value,
+            )
+            .values_list("source_id", "group")
+        )
+    candidates = set(filter(lambda x: x[0] not in deleted, candidates))
+    if not candidates:
+        return set()
+    # groups which keep at least one reference to a surviving target
+    surviving = set()
+    for batch in _batched({x[0] for x in candidates}, batch_size):
+        for source_id, group, target_id in (
+            ContentReference.objects.using(using)
+            .filter(source_id__in=batch)
+            .values_list("source_id", "group", "target_id")
+        ):
+            if target_id not in deleted:
+                surviving.add((source_id, group))
+    return {x[0] for x in candidates.difference(surviving)}
+
+
+def collect_deletion_closure(content_ids, using=None, batch_size=500):
+    """
+    Computes all contents which have to be deleted with content_ids
+    (DeleteRecursive TRUE and NO_GROUP rules)
+    """
+    using = using or router.db_for_write(Content)
+    deleted = set(content_ids)
+    frontier = set(deleted)
+    use_cte = connections[using].vendor == "postgresql"
+    while frontier:
+        if use_cte:
+            new = _recursive_sources_cte(frontier, using)
+        else:
+            new = _recursive_sources(frontier, using, batch_size)
+        new.difference_update(deleted)
+        deleted.update(new)
+        no_group = _no_group_sources(
+            frontier.union(new), deleted, using, batch_size
+        )
+        no_group.difference_update(deleted)
+        deleted.update(no_group)
+        if use_cte:
+            # TRUE references of new are already resolved by the cte
+            frontier = no_group
+        else:
+            frontier = new.union(no_group)
+    return deleted
+
+
+def delete_contents(content_ids, using=None, batch_size=500):
+    """
+    Deletes contents with all contents depending on them in batches
+    Returns the same result as QuerySet.delete
+    """
+    using = using or router.db_for_write(Content)
+    storage = Content._meta.get_field("file").storage
+    closure = collect_deletion_closure(
+        content_ids, using=using, batch_size=batch_size
+    )
+    total = 0
+    per_model = {}
+    for batch in _batched(sorted(closure), batch_size):
+        with transaction.atomic(using=using):
+            rows = list(
+                Content.objects.using(using)
+                .filter(id__in=batch)
+                .values_list("cluster_id", "file", "size", "id", "flexid")
+            )
+            account_deletions(
+                map(
+                    lambda x: (
+                        x[0],
+                        storage_size(storage, x[1]) if x[2] is None else x[2],
+                    ),
+                    rows,
+                ),
+                using=using,
+            )
+            enqueue_file_deletions(map(lambda x: x[1], rows), using=using)
+            log_changes(
+                map(lambda x: (x[0], x[3], x[4], None), rows),
+                ChangeOperation.delete,
+                using=using,
+            )
+            # bypass ContentQuerySet.delete, the closure is already computed
+            with set_based_deletion():
+                deleted, _per_model = QuerySet.delete(
+                    Content.objects.using(using).filter(id__in=batch)
+                )
+        total += deleted
+        for key, val in _per_model.items():
+            per_model[key] = per_model.get(key, 0) + val
+    if closure:
+        logger.debug("deleted %d contents", len(closure))
+    return total, per_model
+
+
+def enqueue_file_deletions(names, using=None):
+    """
+    Records storage files for deletion in the current transaction
+    They are deleted after commit
+    """
+    using = using or router.db_for_write(PendingFileDeletion)
+    names = [name for name in names if name]
+    if not names:
+        return
+    PendingFileDeletion.objects.using(using).bulk_create(
+        map(lambda x: PendingFileDeletion(name=x), names)
+    )
+    transaction.on_commit(
+        lambda: process_file_deletions(names, using=using), using=using
+    )
+
+
+def process_file_deletions(names=None, using=None, batch_size=500):
+    """
+    Deletes queued storage files in batches, all if names is None
+    Returns amount of processed queue entries
+    """
+    using = using or router.db_for_write(PendingFileDeletion)
+    storage = Content._meta.get_field("file").storage
+    query = PendingFileDeletion.objects.using(using).order_by("id")
+    processed = 0
+    if names is None:
+        batches = iter(
+            lambda: list(query.values_list("id", "name")[:batch_size]), []
+        )
+    else:
+        batches = map(
+            lambda batch: list(
+                query.filter(name__in=batch).values_list("id", "name")
+            ),
+            _batched(names, batch_size),
+        )
+    for batch in batches:
+        failed = False
+        for _id, name in batch:
+            # claim the entry, so concurrent runs delete every entry once
+            # (DedupStorage decrements reference counts)
+            if (
+                not PendingFileDeletion.objects.using(using)
+                .filter(id=_id)
+                .delete()[0]
+            ):
+                continue
+            try:
+                storage.delete(name)
+            except Exception as exc:
+                logger.warning(
+                    "Could not delete file: %s", name, exc_info=exc
+                )
+                # requeue for the next run
+                PendingFileDeletion.objects.using(using).create(name=name)
+                failed = True
+                break
+            processed += 1
+        if failed:
+            # stop instead of retrying failing files endlessly
+            break
+    return processed
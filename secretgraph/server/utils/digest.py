@@ -0,0 +1,172 @@
+import hashlib
+from uuid import UUID
+
+from django.db import router
+from django.db.models import F, Q
+
+from ..models import Content, DigestBucket
+
+HEX_DIGITS = "0123456789abcdef"
+# two hex digits of the flexid, 256 buckets per cluster
+BUCKET_LENGTH = 2
+BUCKETS = tuple(a + b for a in HEX_DIGITS for b in HEX_DIGITS)
+
+
+def bucket_of(flexid):
+    return str(flexid)[:BUCKET_LENGTH]
+
+
+def _bucket_range(bucket):
+    return (UUID(bucket.ljust(32, "0")), UUID(bucket.ljust(32, "f")))
+
+
+def hash_entries(entries):
+    """ entries are tuples of (flexid, updateId) sorted by flexid """
+    h = hashlib.sha256()
+    for flexid, updateId in entries:
+        h.update(("%s:%s\n" % (flexid, updateId)).encode("ascii"))
+    return h.hexdigest()
+
+
+def hash_children(digests):
+    return hashlib.sha256("".join(digests).encode("ascii")).hexdigest()
+
+
+def touch_digests(rows, using=None):
+    """
+    Marks the buckets of changed contents as stale, must run in the
+    transaction of the change
+    rows are tuples of (cluster_id, content_id or None, flexid, updateId)
+    """
+    per_cluster = {}
+    for cluster_id, content_id, flexid, _updateId in rows:
+        if content_id:
+            per_cluster.setdefault(cluster_id, set()).add(bucket_of(flexid))
+    if not per_cluster:
+        return
+    using = using or router.db_for_write(DigestBucket)
+    # the rows must exist, otherwise a reader of a concurrent transaction
+    # could insert a hash without the change
+    DigestBucket.objects.using(using).bulk_create(
+        (
+            DigestBucket(cluster_id=cluster_id, bucket=bucket)
+            for cluster_id, buckets in per_cluster.items()
+            for bucket in buckets
+        ),
+        ignore_conflicts=True,
+    )
+    for cluster_id, buckets in per_cluster.items():
+        DigestBucket.objects.using(using).filter(
+            cluster_id=cluster_id, bucket__in=buckets
+        ).update(version=F("version") + 1)
+
+
+def fetch_entries(cluster_id, buckets, using=None):
+    """ Returns dict of bucket: sorted (flexid, updateId) tuples """
+    using = using or router.db_for_write(Content)
+    query = Content.objects.using(using).filter(cluster_id=cluster_id)
+    if len(buckets) < len(BUCKETS) // 16:
+        q = Q()
+        for bucket in buckets:
+            q |= Q(flexid__range=_bucket_range(bucket))
+        query = query.filter(q)
+    entries = {bucket: [] for bucket in buckets}
+    for flexid, updateId in query.order_by("flexid").values_list(
+        "flexid", "updateId"
+    ):
+        bucket = bucket_of(flexid)
+        if bucket in entries:
+            entries[bucket].append((flexid, updateId))
+    return entries
+
+
+def bucket_digests(cluster_id, prefix="", using=None):
+    """
+    Returns dict of bucket: digest for the buckets starting with prefix,
+    only stale buckets are rehashed
+    """
+    using = using or router.db_for_write(DigestBucket)
+    buckets = [x for x in BUCKETS if x.startswith(prefix)]
+    cached = {
+        x.bucket: x
+        for x in DigestBucket.objects.using(using).filter(
+            cluster_id=cluster_id, bucket__in=buckets
+        )
+    }
+    stale = [x for x in buckets if x not in cached or cached[x].stale]
+    digests = {x: cached[x].digest for x in buckets if x not in stale}
+    if not stale:
+        return digests
+    entries = fetch_entries(cluster_id, stale, using=using)
+    missing = []
+    for bucket in stale:
+        digests[bucket] = hash_entries(entries[bucket])
+        row = cached.get(bucket)
+        if not row:
+            missing.append(
+                DigestBucket(
+                    cluster_id=cluster_id,
+                    bucket=bucket,
+                    hashedVersion=0,
+                    digest=digests[bucket],
+                )
+            )
+            continue
+        # a write after reading the version keeps the bucket stale
+        DigestBucket.objects.using(using).filter(
+            id=row.id, version=row.version
+        ).update(hashedVersion=row.version, digest=digests[bucket])
+    if missing:
+        DigestBucket.objects.using(using).bulk_create(
+            missing, ignore_conflicts=True
+        )
+    return digests
+
+
+def node_digest(prefix, digests):
+    if len(prefix) >= BUCKET_LENGTH:
+        return digests[prefix]
+    return hash_children(
+        node_digest(prefix + x, digests) for x in HEX_DIGITS
+    )
+
+
+def fetch_digest(request, cluster, prefix="", authset=None):
+    """
+    Returns node of the digest tree of cluster: prefix, hash, children
+    (prefix, hash) and for buckets the entries (flexid, updateId)
+    The hashes cover all contents, so only authsets which can view all
+    contents of the cluster get the digest
+    Returns None if the cluster is not completely visible
+    """
+    from .changes import get_full_view_cluster_ids
+
+    prefix = prefix.lower()
+    if len(prefix) > BUCKET_LENGTH or any(
+        x not in HEX_DIGITS for x in prefix
+    ):
+        raise ValueError("Invalid prefix")
+    if cluster.id not in get_full_view_cluster_ids(request, authset=authset):
+        return None
+    node = {
+        "prefix": prefix,
+        "hash": None,
+        "children": [],
+        "entries": None,
+    }
+    if len(prefix) < BUCKET_LENGTH:
+        digests = bucket_digests(cluster.id, prefix)
+        node["hash"] = node_digest(prefix, digests)
+        node["children"] = [
+            {"prefix": prefix + x, "hash": node_digest(prefix + x, digests)}
+            for x in HEX_DIGITS
+        ]
+    else:
+        entries = fetch_entries(cluster.id, [prefix])[prefix]
+        # hash of the returned entries, the cache may be already newer
+        node["hash"] = hash_entries(entries)
+        node["entries"] = [
+            {"flexid": flexid, "updateId": updateId}
+            for flexid, updateId in entries
+        ]
+    return node
@@ -1,7 +1,6 @@
 import base64
 import logging
 import os
-import tempfile
 from io import BytesIO
 from typing import Iterable
 
@@ -11,7 +10,7 @@ from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.serialization import load_der_private_key
-from django.conf import settings
+from django.core.files.base import File
 from django.db.models import Exists, OuterRef, Q, Subquery
 from graphql_relay import from_global_id
 from rdflib import Graph
@@ -19,10 +18,13 @@ from rdflib import Graph
 from ...constants import TransferResult
 from ..models import Content, ContentReference
 from .misc import get_secrets, hash_object
+from .upload import StagedFile
 
 logger = logging.getLogger(__name__)
 
 
+_chunk_size = 64 * 1024
+
 default_padding = padding.OAEP(
     mgf=padding.MGF1(algorithm=hashes.SHA256()),
     algorithm=hashes.SHA256(),
@@ -36,9 +38,8 @@ def encrypt_into_file(infile, key=None, nonce=None, outfile=None):
     elif isinstance(infile, str):
         infile = BytesIO(base64.b64decode(infile))
     if not outfile:
-        outfile = tempfile.NamedTemporaryFile(
-            suffix=".encrypt", dir=settings.FILE_UPLOAD_TEMP_DIR
-        )
+        # saving a staged file moves it instead of copying it
+        outfile = StagedFile(suffix=".encrypt")
     nonce = os.urandom(13)
     if not key:
         key = os.urandom(32)
@@ -46,13 +47,23 @@ def encrypt_into_file(infile, key=None, nonce=None, outfile=None):
         algorithms.AES(key), modes.GCM(nonce), backend=default_backend()
     ).encryptor()
 
-    chunk = infile.read(512)
+    size = 0
+    chunk = infile.read(_chunk_size)
     while chunk:
         assert isinstance(chunk, bytes)
-        outfile.write(encryptor.update(chunk))
-        chunk = infile.read(512)
-    outfile.write(encryptor.finalize())
-    outfile.write(encryptor.tag)
+        size += outfile.write(encryptor.update(chunk))
+        chunk = infile.read(_chunk_size)
+    size += outfile.write(encryptor.finalize())
+    size += outfile.write(encryptor.tag)
+    outfile.flush()
+    if hasattr(outfile, "temporary_file_path"):
+        # the storage moves the file instead of reading it
+        os.fsync(outfile.fileno())
+    outfile.seek(0)
+    if not isinstance(outfile, File):
+        outfile = File(outfile)
+        # known size, no stat required
+        outfile.size = size
     return outfile, nonce, key
 
 
@@ -1,11 +1,26 @@
 
 import hashlib
 import base64
+import threading
+from collections import OrderedDict
 
 from django.conf import settings
 from cryptography.hazmat.primitives import serialization
 from ...constants import CLUSTER
 
+# length of the truncated hash index columns
+HASH_INDEX_LENGTH = 16
+
+# memoized hashes of small inputs (keys, tokens)
+_HASH_CACHE_SIZE = getattr(settings, "SECRETGRAPH_HASH_CACHE_SIZE", 4096)
+_HASH_CACHE_MAX_INPUT = 8192
+_hash_cache = OrderedDict()
+_hash_cache_lock = threading.Lock()
+# DER serialization of key objects
+_DER_CACHE_SIZE = 256
+_der_cache = OrderedDict()
+_der_cache_lock = threading.Lock()
+
 
 def refresh_fields(inp, *fields):
     for i in inp:
@@ -14,59 +29,121 @@ def refresh_fields(inp, *fields):
         yield i
 
 
-def hash_object(inp, algo=None):
-    if not algo:
-        algo = settings.SECRETGRAPH_HASH_ALGORITHMS[0]
+def _to_hashable_bytes(inp):
+    if isinstance(inp, str):
+        try:
+            return base64.b64decode(inp)
+        except Exception:
+            return inp.encode("utf8")
+    if isinstance(inp, (bytes, bytearray, memoryview)):
+        return bytes(inp)
+    # key objects: cache DER serialization per object
+    cache_key = id(inp)
+    with _der_cache_lock:
+        entry = _der_cache.get(cache_key)
+        # check identity, id can be reused after garbage collection
+        if entry is not None and entry[0] is inp:
+            _der_cache.move_to_end(cache_key)
+            return entry[1]
+    key = inp
+    if hasattr(key, "public_key"):
+        key = key.public_key()
+    der = key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    with _der_cache_lock:
+        # keep a strong reference, so the id stays valid
+        _der_cache[cache_key] = (inp, der)
+        while len(_der_cache) > _DER_CACHE_SIZE:
+            _der_cache.popitem(last=False)
+    return der
+
+
+def _digest(inp, algo):
     if isinstance(algo, str):
         algo = hashlib.new(algo)
     elif callable(algo):
         algo = algo()
     else:
         algo = algo.copy()
-    if isinstance(inp, str):
-        try:
-            inp = base64.b64decode(inp)
-        except Exception:
-            inp = inp.encode("utf8")
-    if hasattr(inp, "public_key"):
-        inp = inp.public_key()
-    if hasattr(inp, "public_bytes"):
-        inp = inp.public_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
     algo.update(inp)
     return base64.b64encode(algo.digest()).decode("ascii")
 
 
+def hash_digests(inp, algos=None):
+    """
+    Returns the hashes of inp for all algos (default: configured ones)
+    in one pass, small inputs are memoized
+    """
+    if algos is None:
+        algos = settings.SECRETGRAPH_HASH_ALGORITHMS
+    algos = tuple(algos)
+    assert len(algos) > 0, "no hash algorithms specified"
+    inp = _to_hashable_bytes(inp)
+    if len(inp) > _HASH_CACHE_MAX_INPUT:
+        return [_digest(inp, algo) for algo in algos]
+    cache_key = (inp, algos)
+    with _hash_cache_lock:
+        hashes = _hash_cache.get(cache_key)
+        if hashes is not None:
+            _hash_cache.move_to_end(cache_key)
+            return list(hashes)
+    hashes = tuple(_digest(inp, algo) for algo in algos)
+    with _hash_cache_lock:
+        _hash_cache[cache_key] = hashes
+        while len(_hash_cache) > _HASH_CACHE_SIZE:
+            _hash_cache.popitem(last=False)
+    return list(hashes)
+
+
+def hash_object(inp, algo=None):
+    if not algo:
+        algo = settings.SECRETGRAPH_HASH_ALGORITHMS[0]
+    return hash_digests(inp, (algo,))[0]
+
+
 def calculate_hashes(inp):
-    assert len(settings.SECRETGRAPH_HASH_ALGORITHMS) > 0, \
-           "no hash algorithms specified"
-    if isinstance(inp, str):
-        try:
-            inp = base64.b64decode(inp)
-        except Exception:
-            inp = inp.encode("utf8")
-    if hasattr(inp, "public_key"):
-        inp = inp.public_key()
-    if hasattr(inp, "public_bytes"):
-        inp = inp.public_bytes(
-            encoding=serialization.Encoding.DER,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo
-        )
-    hashes = []
-    for algo in settings.SECRETGRAPH_HASH_ALGORITHMS:
-        if isinstance(algo, str):
-            algo = hashlib.new(algo)
-        elif callable(algo):
-            algo = algo()
-        else:
-            algo = algo.copy()
-        algo.update(inp)
-        hashes.append(
-            base64.b64encode(algo.digest()).decode("ascii")
-        )
-    return hashes
+    return hash_digests(inp)
+
+
+def default_hash_length():
+    """ length of hashes of the default algorithm (base64 form) """
+    return len(hash_object(b""))
+
+
+def hash_to_bytes(inp):
+    """ base64 hash (API form) into raw digest bytes """
+    return base64.b64decode(inp)
+
+
+def bytes_to_hash(inp):
+    """ raw digest bytes into base64 hash (API form) """
+    return base64.b64encode(inp).decode("ascii")
+
+
+def hash_index(inp):
+    """
+    Truncated fixed-length form of a base64 hash for compact indexes,
+    matches have to be verified with the full hash
+    """
+    if not inp:
+        return inp
+    if isinstance(inp, bytes):
+        inp = bytes_to_hash(inp)
+    return inp[:HASH_INDEX_LENGTH]
+
+
+def hash_index_filter(field, hashes):
+    """
+    Filter arguments for field__in which can use the index column of
+    the hash field (<field>Index)
+    """
+    hashes = set(hashes)
+    return {
+        f"{field}__in": hashes,
+        f"{field}Index__in": set(map(hash_index, hashes)),
+    }
 
 
 def get_secrets(graph):
@@ -85,3 +162,25 @@ def get_secrets(graph):
     ):
         public_secrets.append(i.secret)
     return public_secrets
+
+
+def swap_update_id(instance, old_update_id, fields):
+    """
+    Compare-and-swap write of instance: writes fields, the already set new
+    updateId and auto_now fields in one UPDATE if the stored updateId is
+    still old_update_id
+    Returns True if the write succeeded
+    """
+    fields = set(fields)
+    fields.add("updateId")
+    fields = [
+        f for f in instance._meta.concrete_fields
+        if f.name in fields or getattr(f, "auto_now", False)
+    ]
+    # pre_save sets auto_now fields and commits uncommitted files
+    values = {f.attname: f.pre_save(instance, False) for f in fields}
+    return bool(
+        type(instance)._base_manager.filter(
+            pk=instance.pk, updateId=old_update_id
+        ).update(**values)
+    )
@@ -0,0 +1,183 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.db import router, transaction
+from django.db.models import F, Q, Subquery, Sum
+
+from ..models import Cluster, Content
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(ValueError):
+    pass
+
+
+def get_quota_user_model():
+    """
+    Returns the user model if it keeps usage counters, otherwise None
+    """
+    if not any(f.name == "user" for f in Cluster._meta.get_fields()):
+        return None
+    from ...user.abstract_models import QuotaUserBase
+
+    user_model = get_user_model()
+    if not issubclass(user_model, QuotaUserBase):
+        return None
+    return user_model
+
+
+def storage_size(storage, name):
+    """ size of a stored file, 0 if missing """
+    if not name:
+        return 0
+    try:
+        return storage.size(name)
+    except (FileNotFoundError, OSError):
+        return 0
+
+
+def content_size(content):
+    """ stored size of content, stats only not backfilled contents """
+    if content.size is not None:
+        return content.size
+    if not content.file:
+        return 0
+    return storage_size(content.file.storage, content.file.name)
+
+
+def check_quota(cluster, size, using=None):
+    """
+    Raises QuotaExceeded if size additional bytes exceed the quota of the
+    user owning cluster, call before writing files
+    """
+    user_model = get_quota_user_model()
+    if not user_model or size <= 0 or not getattr(cluster, "user_id", None):
+        return
+    row = (
+        user_model.objects.using(using)
+        .filter(id=cluster.user_id)
+        .values("quota_local", "used_local")
+        .first()
+    )
+    if (
+        row
+        and row["quota_local"] is not None
+        and row["used_local"] + size > row["quota_local"]
+    ):
+        raise QuotaExceeded("Quota exceeded")
+
+
+def account_usage(cluster_id, size, count=0, enforce=False, using=None):
+    """
+    Adds size bytes and count contents to the counters of cluster and
+    its user, must run in the transaction of the content change
+    with enforce the user quota is checked in the same statement
+    """
+    if not size and not count:
+        return
+    using = using or router.db_for_write(Cluster)
+    Cluster.objects.using(using).filter(id=cluster_id).update(
+        usedBytes=F("usedBytes") + size, contentCount=F("contentCount") + count
+    )
+    user_model = get_quota_user_model()
+    if not user_model:
+        return
+    users = user_model.objects.using(using).filter(
+        id__in=Subquery(
+            Cluster.objects.using(using)
+            .filter(id=cluster_id, user__isnull=False)
+            .values("user_id")
+        )
+    )
+    if enforce and size > 0:
+        updated = users.filter(
+            Q(quota_local__isnull=True)
+            | Q(used_local__lte=F("quota_local") - size)
+        ).update(
+            used_local=F("used_local") + size,
+            content_count=F("content_count") + count,
+        )
+        if not updated and users.exists():
+            raise QuotaExceeded("Quota exceeded")
+    else:
+        users.update(
+            used_local=F("used_local") + size,
+            content_count=F("content_count") + count,
+        )
+
+
+def account_deletions(rows, using=None):
+    """
+    Subtracts deleted contents from the counters
+    rows are tuples of (cluster_id, size)
+    """
+    per_cluster = {}
+    for cluster_id, size in rows:
+        entry = per_cluster.setdefault(cluster_id, [0, 0])
+        entry[0] += size
+        entry[1] += 1
+    for cluster_id, (size, count) in per_cluster.items():
+        account_usage(cluster_id, -size, -count, using=using)
+
+
+def reconcile_usage(workers=4, batch_size=500, using=None):
+    """
+    Recomputes all usage counters from the stored sizes,
+    changes while running can be lost, so run it in quiet periods
+    Returns amount of updated clusters
+    """
+    using = using or router.db_for_write(Cluster)
+    storage = Content._meta.get_field("file").storage
+
+    def stat(name):
+        return storage_size(storage, name)
+
+    usage = {}
+    last_id = 0
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        while True:
+            batch = list(
+                Content.objects.using(using)
+                .filter(id__gt=last_id)
+                .order_by("id")
+                .values_list("id", "cluster_id", "file", "size")[
+                    :batch_size
+                ]
+            )
+            if not batch:
+                break
+            last_id = batch[-1][0]
+            sizes = executor.map(
+                lambda x: stat(x[2]) if x[3] is None else x[3], batch
+            )
+            for (_id, cluster_id, _name, _size), size in zip(batch, sizes):
+                entry = usage.setdefault(cluster_id, [0, 0])
+                entry[0] += size
+                entry[1] += 1
+    clusters = list(Cluster.objects.using(using).only("id"))
+    for cluster in clusters:
+        cluster.usedBytes, cluster.contentCount = usage.get(cluster.id, (0, 0))
+    with transaction.atomic(using=using):
+        Cluster.objects.using(using).bulk_update(
+            clusters, ["usedBytes", "contentCount"], batch_size=batch_size
+        )
+        user_model = get_quota_user_model()
+        if user_model:
+            user_model.objects.using(using).update(
+                used_local=0, content_count=0
+            )
+            per_user = (
+                Cluster.objects.using(using)
+                .filter(user__isnull=False)
+                .values("user_id")
+                .annotate(
+                    _bytes=Sum("usedBytes"), _count=Sum("contentCount")
+                )
+            )
+            for row in per_user:
+                user_model.objects.using(using).filter(
+                    id=row["user_id"]
+                ).update(used_local=row["_bytes"], content_count=row["_count"])
+    return len(clusters)
@@ -0,0 +1,100 @@
+import logging
+
+from django.db import transaction
+
+from ..models import Content, ContentTag
+from .misc import calculate_hashes, default_hash_length, hash_index
+
+logger = logging.getLogger(__name__)
+
+
+def _public_keys(start_after, force):
+    contents = Content.objects.filter(
+        tags__tag="type=PublicKey", id__gt=start_after
+    )
+    # calculate only for old hashes
+    if not force:
+        contents = contents.exclude(
+            contentHash__regex="^.{%d}$" % default_hash_length()
+        )
+    return contents.order_by("id")
+
+
+def count_stale_keys(start_after=0, force=False):
+    return _public_keys(start_after, force).count()
+
+
+def rehash_key_batch(start_after=0, batch_size=500, force=False):
+    """
+    Recalculates key hashes of the next batch of public keys after
+    start_after (id) in one transaction
+    Returns (last processed id or None if finished, amount of keys, updated)
+    """
+    batch = list(
+        _public_keys(start_after, force).only("id", "file", "contentHash")[
+            :batch_size
+        ]
+    )
+    if not batch:
+        return None, 0, 0
+    changed_contents = []
+    # old key_hash tag: new key_hash tags
+    tag_map = {}
+    # identical keys can share one file (DedupStorage)
+    hashes_by_file = {}
+    for content in batch:
+        chashes = hashes_by_file.get(content.file.name)
+        if chashes is None:
+            pubkey = content.load_pubkey()
+            if not pubkey:
+                continue
+            chashes = calculate_hashes(pubkey)
+            hashes_by_file[content.file.name] = chashes
+        if content.contentHash == chashes[0]:
+            continue
+        tags = list(map(lambda x: "key_hash=%s" % x, chashes))
+        for old in set(tags[1:]).union(
+            {"key_hash=%s" % content.contentHash}
+        ):
+            tag_map[old] = tags
+        content.contentHash = chashes[0]
+        content.contentHashIndex = hash_index(chashes[0])
+        changed_contents.append(content)
+
+    with transaction.atomic():
+        if tag_map:
+            # all contents (keys and contents encrypted with the keys)
+            # get the new hashes as key_hash tags
+            new_tags = (
+                ContentTag(content_id=content_id, tag=tag)
+                for content_id, old in ContentTag.objects.filter(
+                    tag__in=tag_map.keys()
+                ).values_list("content_id", "tag")
+                for tag in tag_map[old]
+            )
+            # ignore duplicate key_hash entries
+            ContentTag.objects.bulk_create(
+                new_tags, batch_size=batch_size, ignore_conflicts=True
+            )
+        if changed_contents:
+            Content.objects.bulk_update(
+                changed_contents,
+                ["contentHash", "contentHashIndex"],
+                batch_size=batch_size,
+            )
+    return batch[-1].id, len(batch), len(changed_contents)
+
+
+def rehash_keys(start_after=0, batch_size=500, force=False):
+    """
+    Recalculates key hashes of all public keys batchwise
+    Yields after every batch (last processed id, amount of keys, updated)
+    """
+    while True:
+        last_id, processed, changed = rehash_key_batch(
+            start_after, batch_size=batch_size, force=force
+        )
+        if last_id is None:
+            break
+        start_after = last_id
+        yield last_id, processed, changed
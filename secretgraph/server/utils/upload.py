@@ -0,0 +1,272 @@
+import base64
+import hashlib
+import os
+import tempfile
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import locks
+from django.core.files.base import File
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import (
+    FileUploadHandler,
+    MemoryFileUploadHandler,
+)
+from django.db import transaction
+from django.http import UnreadablePostError
+from django.utils import timezone
+
+from ..models import UploadSession
+
+
+def get_staging_dir():
+    """
+    Directory for uploads in progress, on the filesystem of the storage
+    if possible, so saving them is a rename instead of a copy
+    """
+    try:
+        path = default_storage.path(
+            getattr(settings, "SECRETGRAPH_UPLOAD_DIR", "uploads")
+        )
+    except NotImplementedError:
+        return settings.FILE_UPLOAD_TEMP_DIR or tempfile.gettempdir()
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class StagedFile(File):
+    """
+    Temporary file in the staging dir, storages move it via
+    temporary_file_path (like TemporaryUploadedFile)
+
+    A moved file is owned by the storage, close() removes only the
+    staged file itself
+    """
+
+    def __init__(self, name=None, suffix=".upload"):
+        super().__init__(
+            tempfile.NamedTemporaryFile(
+                suffix=suffix, dir=get_staging_dir(), delete=False
+            ),
+            name,
+        )
+        stat = os.fstat(self.file.fileno())
+        self._staged = (stat.st_dev, stat.st_ino)
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._hashers = [
+            hashlib.new(algo) for algo in settings.SECRETGRAPH_HASH_ALGORITHMS
+        ]
+
+    def write(self, data):
+        self._sha256.update(data)
+        for hasher in self._hashers:
+            hasher.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    @property
+    def sha256(self):
+        """ hex digest, used by DedupStorage """
+        return self._sha256.hexdigest()
+
+    @property
+    def hashes(self):
+        """ hashes of the configured algorithms in API form """
+        return [
+            base64.b64encode(hasher.digest()).decode("ascii")
+            for hasher in self._hashers
+        ]
+
+    def temporary_file_path(self):
+        return self.file.name
+
+    def close(self):
+        self.file.close()
+        path = self.file.name
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # moved by storage
+            return
+        # the name can be reused after moving
+        if (stat.st_dev, stat.st_ino) == self._staged:
+            os.remove(path)
+
+
+class StagedUploadedFile(StagedFile, UploadedFile):
+    def __init__(
+        self, name, content_type, size, charset, content_type_extra=None
+    ):
+        StagedFile.__init__(self, name)
+        self.content_type = content_type
+        self.charset = charset
+        self.content_type_extra = content_type_extra
+
+
+class StagedFileUploadHandler(FileUploadHandler):
+    """
+    Streams uploads into the staging dir and computes hashes and size,
+    saving the file moves it without another copy
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = StagedUploadedFile(
+            self.file_name,
+            self.content_type,
+            0,
+            self.charset,
+            self.content_type_extra,
+        )
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, "file"):
+            self.file.close()
+
+
+def set_upload_handlers(request):
+    """ call before request.POST or request.FILES are accessed """
+    if hasattr(request, "_files"):
+        # already parsed, e.g. by the csrf middleware
+        return
+    request.upload_handlers = [
+        MemoryFileUploadHandler(request),
+        StagedFileUploadHandler(request),
+    ]
+
+
+def get_upload_expiry():
+    """ upload sessions without progress for this time are removed """
+    return timedelta(
+        seconds=getattr(settings, "SECRETGRAPH_UPLOAD_EXPIRY", 86400)
+    )
+
+
+def active_upload_sessions():
+    return UploadSession.objects.filter(
+        updated__gte=timezone.now() - get_upload_expiry()
+    )
+
+
+def upload_session_path(session):
+    return os.path.join(get_staging_dir(), "%s.resumable" % session.flexid)
+
+
+def append_to_upload(session, stream, chunk_size=65536):
+    """
+    Writes stream at the offset of session, concurrent writers of a
+    session are excluded by a file lock, so no row lock is held while
+    streaming
+    bytes received before a disconnect are kept for resuming
+    Returns the new offset, None if the offset of session is outdated
+    """
+    remaining = session.length - session.offset
+    written = 0
+    fd = os.open(upload_session_path(session), os.O_WRONLY | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "wb") as f:
+        if not locks.lock(f, locks.LOCK_EX | locks.LOCK_NB):
+            # another request appends
+            return None
+        # the offset could be advanced by a request which finished before
+        if not UploadSession.objects.filter(
+            id=session.id, offset=session.offset
+        ).exists():
+            return None
+        # drop bytes of interrupted writes which were not recorded
+        f.truncate(session.offset)
+        f.seek(session.offset)
+        try:
+            while remaining > 0:
+                chunk = stream.read(min(chunk_size, remaining))
+                if not chunk:
+                    break
+                f.write(chunk)
+                written += len(chunk)
+                remaining -= len(chunk)
+        except (OSError, UnreadablePostError):
+            # client disconnected
+            pass
+        f.flush()
+        os.fsync(f.fileno())
+        session.offset += written
+        # still locked, no other request could change the offset
+        UploadSession.objects.filter(id=session.id).update(
+            offset=session.offset, updated=timezone.now()
+        )
+    return session.offset
+
+
+def discard_upload(session):
+    """
+    remove session and its staged file after the transaction
+    Returns False if the session was removed before
+    """
+    path = upload_session_path(session)
+    if not UploadSession.objects.filter(id=session.id).delete()[0]:
+        return False
+
+    def _remove():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # moved by storage
+            pass
+
+    transaction.on_commit(_remove)
+    return True
+
+
+class ResumedFile(File):
+    """
+    Staged file of a completed upload session, storages move it like
+    StagedFile
+    """
+
+    def __init__(self, session):
+        super().__init__(open(upload_session_path(session), "rb"))
+        self.size = session.length
+
+    def temporary_file_path(self):
+        return self.file.name
+
+    def close(self):
+        try:
+            return self.file.close()
+        except FileNotFoundError:
+            # moved by storage
+            pass
+
+
+def claim_upload(flexid, cluster=None, content=None):
+    """
+    Returns the file of a completed upload and removes its session, call
+    it in the transaction which saves the file
+    the session must be created for content (update) or for cluster
+    (create)
+    """
+    # concurrent claims wait for the first one, which removes the session
+    session = (
+        active_upload_sessions()
+        .select_for_update()
+        .filter(flexid=flexid)
+        .first()
+    )
+    if not session or not session.complete:
+        raise ValueError("Upload not found or incomplete")
+    if content is not None:
+        if session.content_id != content.id:
+            raise ValueError("Upload not created for this content")
+    elif session.content_id is not None or session.cluster_id != cluster.id:
+        raise ValueError("Upload not created for this cluster")
+    if not discard_upload(session):
+        raise ValueError("Upload not found or incomplete")
+    return ResumedFile(session)
@@ -2,10 +2,12 @@ import base64
 import json
 import logging
 import pprint
+import time
 
 from django.conf import settings
 from django.core.paginator import Paginator
-from django.db.models import OuterRef, Q, Subquery
+from django.db import transaction
+from django.db.models import Max, OuterRef, Q, Subquery
 from django.http import (
     FileResponse,
     Http404,
@@ -16,20 +18,38 @@ from django.http import (
 )
 from django.shortcuts import resolve_url
 from django.urls import reverse
+from django.views.generic.base import View
 from django.views.generic.edit import FormView
 from graphene_file_upload.django import FileUploadGraphQLView
+from graphql_relay import to_global_id
 from rdflib import RDF, XSD, Graph, Literal
 
 from ..constants import CLUSTER
 from .actions.view import ContentFetchQueryset, fetch_contents
 from .forms import PreKeyForm, PushForm, UpdateForm
-from .models import Content
+from .models import Change, Cluster, Content, UploadSession
+from .storage import migrate_file_path
 from .utils.auth import (
     fetch_by_id,
     initializeCachedResult,
+    resetCachedResults,
     retrieve_allowed_objects,
+    set_request_authset,
 )
+from .utils.changes import (
+    change_broker,
+    fetch_changes,
+    get_visible_cluster_ids,
+)
+from .utils.digest import fetch_digest
 from .utils.encryption import iter_decrypt_contents
+from .utils.quota import QuotaExceeded, check_quota
+from .utils.upload import (
+    active_upload_sessions,
+    append_to_upload,
+    discard_upload,
+    set_upload_handlers,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -66,6 +86,7 @@ class ClusterView(AllowCORSMixin, FormView):
         ).first()
         if not cluster:
             raise Http404()
+        migrate_file_path(cluster, "publicInfo")
         g = Graph()
         with cluster.publicInfo.open("rb") as rb:
             g.parse(file=rb, format="turtle")
@@ -93,11 +114,51 @@ class ClusterView(AllowCORSMixin, FormView):
         )
 
 
+class ClusterDigestView(AllowCORSMixin, View):
+    """
+    Node of the digest tree of a cluster, select nodes with ?prefix=
+    """
+
+    http_method_names = ["get", "options"]
+
+    def get(self, request, *args, **kwargs):
+        authset = set(
+            request.headers.get("Authorization", "")
+            .replace(" ", "")
+            .split(",")
+        )
+        authset.update(request.GET.getlist("token"))
+        set_request_authset(request, authset)
+        try:
+            cluster = fetch_by_id(
+                Cluster.objects.all(), kwargs["id"], type_name="Cluster"
+            ).first()
+        except ValueError:
+            return HttpResponse("Malformed id", status=400)
+        if not cluster:
+            raise Http404()
+        try:
+            node = fetch_digest(
+                request, cluster, prefix=request.GET.get("prefix", "")
+            )
+        except ValueError:
+            return HttpResponse("Invalid prefix", status=400)
+        if not node:
+            raise Http404()
+        if node["entries"] is not None:
+            node["entries"] = [
+                {"id": str(x["flexid"]), "updateId": str(x["updateId"])}
+                for x in node["entries"]
+            ]
+        return JsonResponse(node)
+
+
 class ContentView(AllowCORSMixin, FormView):
     template_name = "secretgraph/content_form.html"
     action = "view"
 
     def dispatch(self, request, *args, **kwargs):
+        set_upload_handlers(request)
         response = super().dispatch(request, *args, **kwargs)
         response["X-ITERATIONS"] = ",".join(
             map(str, settings.SECRETGRAPH_ITERATIONS)
@@ -326,7 +387,15 @@ class ContentView(AllowCORSMixin, FormView):
             response = JsonResponse(response)
             response["X-IS-VERIFIED"] = "false"
         else:
-            response = FileResponse(content.file.open("rb"))
+            # files of the flat layout are moved on access
+            migrate_file_path(content, "file")
+            response = self.handle_range(request, content)
+            if not response:
+                response = FileResponse(content.file.open("rb"))
+                if content.size is not None:
+                    response["Content-Length"] = str(content.size)
+            response["ETag"] = '"%s"' % content.updateId
+            response["Accept-Ranges"] = "bytes"
             _type = content.tags.filter(tag__startswith="type=").first()
             response["X-TYPE"] = _type.tag.split("=", 1)[1] if _type else ""
             verifiers = content.references.filter(group="signature")
@@ -334,9 +403,311 @@ class ContentView(AllowCORSMixin, FormView):
         response["X-NONCE"] = content.nonce
         return response
 
+    def handle_range(self, request, content):
+        """
+        Serve a single "bytes=start-[end]" range, used for resuming transfers
+        Returns None if the full content should be sent
+        """
+        byte_range = request.headers.get("Range", "")
+        if_range = request.headers.get("If-Range")
+        if not byte_range.startswith("bytes=") or "," in byte_range:
+            return None
+        if if_range and if_range != '"%s"' % content.updateId:
+            return None
+        try:
+            start, end = byte_range[6:].split("-", 1)
+            start = int(start)
+            end = int(end) if end else None
+        except ValueError:
+            return None
+        size = content.size
+        if size is None:
+            # not backfilled yet
+            size = content.file.size
+        if end is None or end >= size:
+            end = size - 1
+        if start > end:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */%d" % size
+            return response
+
+        def gen():
+            remaining = end - start + 1
+            with content.file.open("rb") as fileob:
+                fileob.seek(start)
+                while remaining > 0:
+                    chunk = fileob.read(min(remaining, 8192))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+                    yield chunk
+
+        response = StreamingHttpResponse(gen(), status=206)
+        response["Content-Range"] = "bytes %d-%d/%d" % (start, end, size)
+        response["Content-Length"] = str(end - start + 1)
+        return response
+
+
+class UploadView(AllowCORSMixin, View):
+    """
+    Resumable uploads in the style of tus (core, creation, termination)
+
+    POST with Upload-Length and ?cluster=<id> (create) or ?content=<id>
+    (update) creates a session, PATCH appends chunks at Upload-Offset,
+    HEAD returns the offset for resuming
+    The completed upload is committed with contentValue.upload
+    """
+
+    http_method_names = ["post", "head", "patch", "delete", "options"]
+    tus_version = "1.0.0"
+
+    def dispatch(self, request, *args, **kwargs):
+        response = super().dispatch(request, *args, **kwargs)
+        response["Tus-Resumable"] = self.tus_version
+        response["Cache-Control"] = "no-store"
+        response["Access-Control-Allow-Headers"] = (
+            "Authorization, Content-Type, Upload-Length, Upload-Offset, "
+            "Tus-Resumable"
+        )
+        response["Access-Control-Expose-Headers"] = (
+            "Location, Upload-Length, Upload-Offset, Tus-Resumable, "
+            "Tus-Version, Tus-Extension, Tus-Max-Size"
+        )
+        return response
+
+    def options(self, request, *args, **kwargs):
+        response = super().options(request, *args, **kwargs)
+        response["Tus-Version"] = self.tus_version
+        response["Tus-Extension"] = "creation,termination"
+        max_size = getattr(settings, "SECRETGRAPH_UPLOAD_MAX_SIZE", None)
+        if max_size:
+            response["Tus-Max-Size"] = str(max_size)
+        return response
+
+    def get_session(self, **kwargs):
+        if not kwargs.get("id"):
+            raise Http404()
+        session = (
+            active_upload_sessions().filter(flexid=kwargs["id"]).first()
+        )
+        if not session:
+            raise Http404()
+        return session
+
+    def post(self, request, *args, **kwargs):
+        if kwargs.get("id"):
+            return HttpResponse(status=405)
+        try:
+            length = int(request.headers["Upload-Length"])
+            if length < 0:
+                raise ValueError()
+        except (KeyError, ValueError):
+            return HttpResponse("Invalid Upload-Length", status=400)
+        max_size = getattr(settings, "SECRETGRAPH_UPLOAD_MAX_SIZE", None)
+        if max_size and length > max_size:
+            return HttpResponse(status=413)
+        authset = set(
+            request.headers.get("Authorization", "")
+            .replace(" ", "")
+            .split(",")
+        )
+        authset.update(request.GET.getlist("token"))
+        content = None
+        try:
+            if request.GET.get("content"):
+                content = (
+                    retrieve_allowed_objects(
+                        request,
+                        "update",
+                        fetch_by_id(
+                            Content.objects.all(), request.GET["content"]
+                        ),
+                        authset=authset,
+                    )["objects"]
+                    .select_related("cluster")
+                    .first()
+                )
+                cluster = content and content.cluster
+            elif request.GET.get("cluster"):
+                cluster = retrieve_allowed_objects(
+                    request,
+                    "create",
+                    fetch_by_id(
+                        Cluster.objects.all(), request.GET["cluster"]
+                    ),
+                    authset=authset,
+                )["objects"].first()
+            else:
+                return HttpResponse("cluster or content required", status=400)
+        except ValueError:
+            return HttpResponse("Malformed id", status=400)
+        if not cluster:
+            raise Http404()
+        try:
+            check_quota(cluster, length)
+        except QuotaExceeded:
+            return HttpResponse("Quota exceeded", status=413)
+        session = UploadSession.objects.create(
+            cluster=cluster, content=content, length=length
+        )
+        response = HttpResponse(status=201)
+        response["Location"] = session.link
+        return response
+
+    def head(self, request, *args, **kwargs):
+        session = self.get_session(**kwargs)
+        response = HttpResponse(status=200)
+        response["Upload-Offset"] = str(session.offset)
+        response["Upload-Length"] = str(session.length)
+        return response
+
+    def patch(self, request, *args, **kwargs):
+        if request.content_type != "application/offset+octet-stream":
+            return HttpResponse(status=415)
+        try:
+            offset = int(request.headers["Upload-Offset"])
+            size = int(request.headers.get("Content-Length") or 0)
+        except (KeyError, ValueError):
+            return HttpResponse("Invalid Upload-Offset", status=400)
+        session = self.get_session(**kwargs)
+        if offset != session.offset:
+            response = HttpResponse(status=409)
+            response["Upload-Offset"] = str(session.offset)
+            return response
+        if size > session.length - session.offset:
+            return HttpResponse(status=413)
+        # streams the body in chunks, request.body is never loaded
+        if append_to_upload(session, request) is None:
+            # a concurrent PATCH won
+            response = HttpResponse(status=409)
+            response["Upload-Offset"] = str(self.get_session(**kwargs).offset)
+            return response
+        response = HttpResponse(status=204)
+        response["Upload-Offset"] = str(session.offset)
+        return response
+
+    def delete(self, request, *args, **kwargs):
+        with transaction.atomic():
+            discard_upload(self.get_session(**kwargs))
+        return HttpResponse(status=204)
+
+
+class ChangeStreamView(AllowCORSMixin, View):
+    """
+    Server-sent events of the change feed for the clusters of the
+    authorization tokens, resumable with Last-Event-ID
+    The stream ends after SECRETGRAPH_STREAM_TIMEOUT seconds,
+    EventSource reconnects automatically
+    """
+
+    http_method_names = ["get", "options"]
+
+    def get(self, request, *args, **kwargs):
+        authset = set(
+            request.headers.get("Authorization", "")
+            .replace(" ", "")
+            .split(",")
+        )
+        authset.update(request.GET.getlist("token"))
+        # authorization is rechecked on every wake-up of the stream
+        set_request_authset(request, authset)
+        cluster_ids = get_visible_cluster_ids(request)
+        clusters = request.GET.getlist("cluster")
+        if clusters:
+            try:
+                cluster_ids.intersection_update(
+                    fetch_by_id(
+                        Cluster.objects.all(), clusters, limit_ids=10
+                    ).values_list("id", flat=True)
+                )
+            except ValueError:
+                return HttpResponse("Malformed id", status=400)
+        if not cluster_ids:
+            raise Http404()
+        cursor = request.headers.get("Last-Event-ID") or request.GET.get(
+            "cursor"
+        )
+        try:
+            cursor = int(cursor) if cursor else None
+        except ValueError:
+            return HttpResponse("Invalid cursor", status=400)
+        if cursor is None:
+            # only new changes
+            cursor = (
+                Change.objects.aggregate(last=Max("sequence"))["last"]
+                or 0
+            )
+        response = StreamingHttpResponse(
+            self.stream(request, cursor, cluster_ids),
+            content_type="text/event-stream",
+        )
+        response["Cache-Control"] = "no-cache"
+        # disable buffering of nginx
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+    def stream(self, request, cursor, cluster_ids):
+        heartbeat = getattr(settings, "SECRETGRAPH_STREAM_HEARTBEAT", 15)
+        end = time.monotonic() + getattr(
+            settings, "SECRETGRAPH_STREAM_TIMEOUT", 300
+        )
+        event = change_broker.subscribe(cluster_ids)
+        try:
+            yield "retry: %d\n\n" % (heartbeat * 1000)
+            while True:
+                # also on timeouts: changes of late commits are not
+                # announced by the broker
+                event.clear()
+                # actions could be revoked or expired meanwhile
+                resetCachedResults(request)
+                visible_ids = cluster_ids.intersection(
+                    get_visible_cluster_ids(request)
+                )
+                if not visible_ids:
+                    break
+                while True:
+                    result = fetch_changes(
+                        request, cursor=cursor, clusters=visible_ids
+                    )
+                    if result["resync"]:
+                        yield "event: resync\ndata: {}\n\n"
+                    for change in result["changes"]:
+                        yield "id: %d\nevent: change\ndata: %s\n\n" % (
+                            change.sequence,
+                            json.dumps(
+                                {
+                                    "id": to_global_id(
+                                        "Content"
+                                        if change.contentId
+                                        else "Cluster",
+                                        change.flexid,
+                                    ),
+                                    "operation": change.operation,
+                                    "updateId": change.updateId
+                                    and str(change.updateId),
+                                }
+                            ),
+                        )
+                    if result["cursor"] != cursor:
+                        cursor = result["cursor"]
+                        if not result["changes"]:
+                            # skipped invisible changes
+                            yield "id: %d\n\n" % cursor
+                    if not result["hasMore"]:
+                        break
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                if not event.wait(min(heartbeat, remaining)):
+                    yield ": keepalive\n\n"
+        finally:
+            change_broker.unsubscribe(event)
+
 
 class CORSFileUploadGraphQLView(AllowCORSMixin, FileUploadGraphQLView):
     def dispatch(self, request, *args, **kwargs):
+        # stream uploads next to the final storage location
+        set_upload_handlers(request)
         if settings.DEBUG and "operations" in request.POST:
             operations = json.loads(request.POST.get("operations", "{}"))
             logger.debug(
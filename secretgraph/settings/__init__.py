@@ -123,6 +123,13 @@ STATIC_URL = "/static/"
 
 MEDIA_ROOT = "media/"
 MEDIA_URL = "/media/"
+# writes files with O_EXCL instead of checking for existing names
+DEFAULT_FILE_STORAGE = "secretgraph.server.storage.ShardedFileSystemStorage"
+# alternative: store small files in segments (requires compact_packs runs)
+# DEFAULT_FILE_STORAGE = "secretgraph.server.storage.PackfileStorage"
+# SECRETGRAPH_PACK_MAX_SIZE = 4096
+# alternative: store identical files once (e.g. keys in many clusters)
+# DEFAULT_FILE_STORAGE = "secretgraph.server.storage.DedupStorage"
 
 
 LOGIN_URL = "auth:login"
@@ -162,8 +169,19 @@ SECRETGRAPH_REQUEST_KWARGS_MAP = {
 SECRETGRAPH_HASH_ALGORITHMS = ["sha512"]
 # specify amount of iterations from most current to most old
 SECRETGRAPH_ITERATIONS = [100000]
-# length of tokens used in file names
-SECRETGRAPH_FILETOKEN_LENGTH = 100
+# length of tokens used in file names (random bytes)
+SECRETGRAPH_FILETOKEN_LENGTH = 32
+# resumable uploads without progress are removed after (seconds)
+SECRETGRAPH_UPLOAD_EXPIRY = 86400
+# SECRETGRAPH_UPLOAD_MAX_SIZE = 2 * 1024 ** 3
+# change feed: changes are numbered after their commit, readers number
+# changes left unnumbered for longer (seconds), e.g. by crashed processes
+SECRETGRAPH_CHANGES_DELAY = 2
+# server-sent events of changes: poll interval of the change log (one
+# poller per process), keepalive interval and maximal stream duration
+SECRETGRAPH_STREAM_POLL_INTERVAL = 1.0
+SECRETGRAPH_STREAM_HEARTBEAT = 15
+SECRETGRAPH_STREAM_TIMEOUT = 300
 SECRETGRAPH_REST_URL = "/secretgraph/"
 SECRETGRAPH_GRAPHQL_URL = "/graphql"
 
@@ -11,7 +11,7 @@ def default_quota_user_remote():
     return getattr(settings, "SECRETGRAPH_USER_QUOTA_REMOTE", None)
 
 
-class QuotaUserBase():
+class QuotaUserBase(models.Model):
     # optional quota
     quota_local = models.PositiveIntegerField(
         null=True, blank=True, default=default_quota_user_local,
@@ -21,3 +21,15 @@ class QuotaUserBase():
         null=True, blank=True, default=default_quota_user_remote,
         help_text=_("Quota in Bytes, null for no limit")
     )
+    # usage counters, updated with every content change
+    used_local = models.BigIntegerField(
+        default=0, editable=False,
+        help_text=_("Used Bytes of contents in own clusters")
+    )
+    content_count = models.BigIntegerField(
+        default=0, editable=False,
+        help_text=_("Amount of contents in own clusters")
+    )
+
+    class Meta:
+        abstract = True
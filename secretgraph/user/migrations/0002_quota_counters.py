@@ -0,0 +1,34 @@
+# Generated by Django 3.2.25 on 2026-10-19 03:15
+
+from django.db import migrations, models
+import secretgraph.user.abstract_models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('secretgraph_user', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='quotauser',
+            name='content_count',
+            field=models.BigIntegerField(default=0, editable=False, help_text='Amount of contents in own clusters'),
+        ),
+        migrations.AddField(
+            model_name='quotauser',
+            name='quota_local',
+            field=models.PositiveIntegerField(blank=True, default=secretgraph.user.abstract_models.default_quota_user_local, help_text='Quota in Bytes, null for no limit', null=True),
+        ),
+        migrations.AddField(
+            model_name='quotauser',
+            name='quota_remote',
+            field=models.PositiveIntegerField(blank=True, default=secretgraph.user.abstract_models.default_quota_user_remote, help_text='Quota in Bytes, null for no limit', null=True),
+        ),
+        migrations.AddField(
+            model_name='quotauser',
+            name='used_local',
+            field=models.BigIntegerField(default=0, editable=False, help_text='Used Bytes of contents in own clusters'),
+        ),
+    ]
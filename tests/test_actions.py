@@ -0,0 +1,68 @@
+from uuid import uuid4
+
+from django.test import TestCase
+
+from secretgraph.server.actions.handler import ActionHandler
+from secretgraph.server.models import Change, Cluster, Content, DigestBucket
+from secretgraph.server.utils.digest import bucket_of
+from secretgraph.server.utils.misc import hash_index_filter, hash_object
+
+
+class StoredUpdateTests(TestCase):
+    def setUp(self):
+        self.cluster = Cluster.objects.create(publicInfo="cluster.info")
+        self.content = Content.objects.create(
+            cluster=self.cluster,
+            nonce="n",
+            file="a.store",
+            contentHash=hash_object(b"old"),
+        )
+        Change.objects.all().delete()
+
+    def stored_update(self, **updates):
+        ActionHandler.do_storedUpdate(
+            {
+                "minExpire": "Thu, 01 Jan 1970 00:00:00 +0000",
+                "delete": {"Cluster": [], "Content": [], "Action": []},
+                "update": {"Cluster": {}, "Content": {}, "Action": {}},
+                **updates,
+            },
+            "view",
+        )
+
+    def test_content_hash_index(self):
+        new_hash = hash_object(b"new")
+        self.stored_update(
+            update={
+                "Cluster": {},
+                "Content": {self.content.id: {"contentHash": new_hash}},
+                "Action": {},
+            }
+        )
+        updated = Content.objects.get(
+            **hash_index_filter("contentHash", [new_hash])
+        )
+        self.assertEqual(updated.id, self.content.id)
+        self.assertNotEqual(updated.updateId, self.content.updateId)
+        change = Change.objects.get()
+        self.assertEqual(change.operation, "update")
+        self.assertEqual(change.updateId, updated.updateId)
+        self.assertTrue(
+            DigestBucket.objects.get(
+                cluster=self.cluster, bucket=bucket_of(updated.flexid)
+            ).stale
+        )
+
+    def test_flexid_replaced(self):
+        flexid = uuid4()
+        self.stored_update(
+            update={
+                "Cluster": {},
+                "Content": {self.content.id: {"flexid": flexid}},
+                "Action": {},
+            }
+        )
+        self.assertEqual(
+            set(Change.objects.values_list("operation", "flexid")),
+            {("delete", self.content.flexid), ("create", flexid)},
+        )
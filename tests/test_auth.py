@@ -0,0 +1,69 @@
+from django.test import TestCase
+
+from secretgraph.server.models import Cluster
+from secretgraph.server.utils.auth import (
+    initializeCachedResult,
+    set_request_authset,
+)
+
+from .utils import create_action, create_request, manage_action
+
+
+class CachedResultTests(TestCase):
+    def setUp(self):
+        self.cluster_a = Cluster.objects.create(publicInfo="a.info")
+        self.cluster_b = Cluster.objects.create(publicInfo="b.info")
+        self.token_a = create_action(self.cluster_a, manage_action())
+        self.token_b = create_action(self.cluster_b, manage_action())
+
+    def clusters(self, result):
+        return set(result["Cluster"]["objects"].values_list("id", flat=True))
+
+    def test_authsets_are_separated(self):
+        request = create_request()
+        result_a = initializeCachedResult(
+            request, authset=[self.token_a], scope="manage"
+        )
+        result_b = initializeCachedResult(
+            request, authset=[self.token_b], scope="manage"
+        )
+        self.assertEqual(self.clusters(result_a), {self.cluster_a.id})
+        self.assertEqual(self.clusters(result_b), {self.cluster_b.id})
+        # cached per authset
+        self.assertIs(
+            initializeCachedResult(
+                request, authset=[self.token_b], scope="manage"
+            ),
+            result_b,
+        )
+        # the default is the result of the own authset of the request
+        default = initializeCachedResult(request, scope="manage")
+        self.assertIsNot(default, result_a)
+        self.assertEqual(self.clusters(default), set())
+        # scopes are separated
+        self.assertIsNot(
+            initializeCachedResult(request, authset=[self.token_a]),
+            result_a,
+        )
+
+    def test_header_authset(self):
+        request = create_request(self.token_b)
+        result = initializeCachedResult(request)
+        self.assertEqual(self.clusters(result), {self.cluster_b.id})
+        self.assertIs(
+            initializeCachedResult(request, authset=[self.token_b]), result
+        )
+        self.assertIs(request.secretgraphResult, result)
+        # explicit authsets do not replace the default
+        initializeCachedResult(request, authset=[self.token_a])
+        self.assertIs(initializeCachedResult(request), result)
+        self.assertIs(request.secretgraphResult, result)
+
+    def test_request_authset(self):
+        request = create_request(self.token_b)
+        set_request_authset(request, [self.token_a])
+        result = initializeCachedResult(request)
+        self.assertEqual(self.clusters(result), {self.cluster_a.id})
+        self.assertIs(
+            initializeCachedResult(request, authset=[self.token_a]), result
+        )
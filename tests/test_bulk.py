@@ -0,0 +1,299 @@
+from django.core.files.base import ContentFile
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from graphql_relay import from_global_id, to_global_id
+
+from secretgraph.server.models import Change, Cluster, Content, ContentTag
+
+from .utils import ContentMutationMixin, create_action, execute, nonce
+
+bulk_create = """
+mutation bulkCreate(
+    $cluster: ID!, $contents: [BulkContentInput!]!, $authorization: [String]
+) {
+    bulkCreateContents(input: {
+        cluster: $cluster, contents: $contents, authorization: $authorization
+    }) {
+        writeok
+        results {
+            error
+            content {
+                id
+            }
+        }
+    }
+}
+"""
+
+
+class BulkCreateTests(ContentMutationMixin, TestCase):
+    def content_input(self, data, tags=None):
+        return {
+            "value": {
+                "value": ContentFile(data),
+                "nonce": nonce(),
+                "tags": tags
+                or [
+                    "type=File",
+                    "state=internal",
+                    "key_hash=%s" % self.key_hash,
+                ],
+            },
+            "references": [
+                {"target": self.key_hash, "group": "key", "extra": "shared"}
+            ],
+        }
+
+    def bulk_create(self, *contents):
+        return execute(
+            bulk_create,
+            self.token,
+            cluster=to_global_id("Cluster", self.cluster.flexid),
+            contents=list(contents),
+            authorization=[self.token],
+        )["bulkCreateContents"]
+
+    def test_create(self):
+        result = self.bulk_create(
+            self.content_input(b"first"),
+            self.content_input(b"invalid", tags=["type=File"]),
+            self.content_input(b"second"),
+        )
+        self.assertTrue(result["writeok"])
+        errors = [x["error"] for x in result["results"]]
+        self.assertIsNone(errors[0])
+        self.assertTrue(errors[1])
+        self.assertIsNone(errors[2])
+        contents = Content.objects.filter(
+            cluster=self.cluster, tags__tag="type=File"
+        )
+        stored = set()
+        for content in contents:
+            with content.file.open("rb") as f:
+                stored.add(f.read())
+            self.assertTrue(
+                content.tags.filter(
+                    tag="id=%s" % to_global_id("Content", content.flexid)
+                ).exists()
+            )
+            self.assertEqual(
+                content.references.get(group="key").extra, "shared"
+            )
+        self.assertEqual(stored, {b"first", b"second"})
+        self.assertEqual(
+            set(
+                Change.objects.filter(operation="create").values_list(
+                    "flexid", flat=True
+                )
+            ),
+            {x.flexid for x in contents},
+        )
+        self.cluster.refresh_from_db()
+        self.assertEqual(self.cluster.contentCount, 2)
+        self.assertEqual(self.cluster.usedBytes, 11)
+
+    def test_constant_queries(self):
+        key = Content.objects.get(contentHash=self.key_hash)
+
+        def content_input(data):
+            content = self.content_input(data)
+            content["references"].append(
+                {"target": to_global_id("Content", key.flexid), "group": "a"}
+            )
+            return content
+
+        with CaptureQueriesContext(connection) as single:
+            self.bulk_create(content_input(b"single"))
+        with self.assertNumQueries(len(single.captured_queries)):
+            result = self.bulk_create(
+                *(content_input(b"content%d" % i) for i in range(10))
+            )
+        self.assertFalse(any(x["error"] for x in result["results"]))
+        self.assertEqual(
+            key.referencedBy.filter(group__in=["key", "a"]).count(), 22
+        )
+
+    @override_settings(SECRETGRAPH_BULK_LIMIT=1)
+    def test_limit(self):
+        with self.assertRaisesMessage(ValueError, "Too many contents"):
+            self.bulk_create(
+                self.content_input(b"first"), self.content_input(b"second")
+            )
+        self.assertFalse(
+            Content.objects.filter(tags__tag="type=File").exists()
+        )
+
+
+bulk_update_metadata = """
+mutation bulkUpdateMetadata(
+    $ids: [ID], $includeTags: [String], $tags: [String]!,
+    $operation: MetadataOperations, $authorization: [String]
+) {
+    bulkUpdateMetadata(input: {
+        ids: $ids, includeTags: $includeTags, tags: $tags,
+        operation: $operation, authorization: $authorization
+    }) {
+        count
+    }
+}
+"""
+
+bulk_delete = """
+mutation bulkDelete(
+    $ids: [ID], $includeTags: [String], $authorization: [String]
+) {
+    bulkDeleteContents(input: {
+        ids: $ids, includeTags: $includeTags, authorization: $authorization
+    }) {
+        count
+    }
+}
+"""
+
+
+class BulkChangeTests(ContentMutationMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.ids = [
+            self.create_content(data)["content"]["id"]
+            for data in (b"first", b"second", b"third")
+        ]
+        self.contents = Content.objects.filter(
+            cluster=self.cluster, tags__tag="type=File"
+        )
+        Change.objects.all().delete()
+
+    def update_metadata(self, tags, operation, **kwargs):
+        kwargs.setdefault("authorization", [self.token])
+        return execute(
+            bulk_update_metadata, tags=tags, operation=operation, **kwargs
+        )["bulkUpdateMetadata"]["count"]
+
+    def test_append_and_remove(self):
+        first = self.contents.get(flexid=from_global_id(self.ids[0])[1])
+        self.assertEqual(
+            self.update_metadata(["label=a"], "append", ids=self.ids[:1]), 1
+        )
+        update_ids = dict(self.contents.values_list("id", "updateId"))
+        # only the tagged content changes
+        self.assertEqual(
+            self.update_metadata(
+                ["label"], "remove", includeTags=["type=File"]
+            ),
+            1,
+        )
+        self.assertFalse(first.tags.filter(tag="label=a").exists())
+        self.assertEqual(
+            [
+                x.id
+                for x in self.contents.all()
+                if x.updateId != update_ids[x.id]
+            ],
+            [first.id],
+        )
+        self.assertEqual(
+            list(
+                Change.objects.filter(operation="metadata").values_list(
+                    "flexid", flat=True
+                )
+            ),
+            [first.flexid, first.flexid],
+        )
+        # nothing left to remove
+        self.assertEqual(
+            self.update_metadata(
+                ["label"], "remove", includeTags=["type=File"]
+            ),
+            0,
+        )
+
+    def test_append_existing(self):
+        self.update_metadata(["label=a"], "append", ids=self.ids[:1])
+        self.assertEqual(
+            self.update_metadata(["label=a"], "append", ids=self.ids), 2
+        )
+
+    def test_denied(self):
+        with self.assertRaisesMessage(ValueError, "cannot be changed"):
+            self.update_metadata(["type=Text"], "replace", ids=self.ids)
+        self.assertEqual(self.contents.count(), 3)
+
+    def test_remove_state(self):
+        for prefix in ("s", "", "stat", "state", "state=internal"):
+            with self.assertRaises(ValueError):
+                self.update_metadata(
+                    [prefix], "remove", includeTags=["type=File"]
+                )
+        self.update_metadata(["label=a"], "append", ids=self.ids)
+        self.assertEqual(
+            self.update_metadata(["label"], "remove", ids=self.ids), 3
+        )
+        self.assertEqual(
+            ContentTag.objects.filter(
+                content__in=self.contents, tag="state=internal"
+            ).count(),
+            3,
+        )
+
+    def test_cluster_policies(self):
+        other = Cluster.objects.create(publicInfo="other.info")
+        other_content = Content.objects.create(
+            cluster=other, nonce="n", file="other.store"
+        )
+        ContentTag.objects.bulk_create(
+            ContentTag(content=other_content, tag=tag)
+            for tag in ("type=File", "state=internal")
+        )
+        other_token = create_action(
+            other,
+            {
+                "action": "update",
+                "ids": [other_content.id],
+                "form": {
+                    "injectedTags": ["injected=b"],
+                    "allowedTags": ["label="],
+                },
+            },
+        )
+        count = self.update_metadata(
+            ["label=a", "other=c"],
+            "append",
+            includeTags=["type=File"],
+            authorization=[self.token, other_token],
+        )
+        self.assertEqual(count, 4)
+        self.assertEqual(
+            set(other_content.tags.values_list("tag", flat=True)),
+            {"type=File", "state=internal", "label=a", "injected=b"},
+        )
+        for content in self.contents:
+            tags = set(content.tags.values_list("tag", flat=True))
+            self.assertIn("label=a", tags)
+            self.assertIn("other=c", tags)
+            self.assertNotIn("injected=b", tags)
+
+    def test_delete(self):
+        other = Cluster.objects.create(publicInfo="other.info")
+        other_content = Content.objects.create(
+            cluster=other, nonce="n", file="other.store"
+        )
+        count = execute(
+            bulk_delete,
+            ids=self.ids[:2]
+            + [to_global_id("Content", other_content.flexid)],
+            authorization=[self.token],
+        )["bulkDeleteContents"]["count"]
+        self.assertEqual(count, 2)
+        self.assertEqual(
+            self.contents.filter(markForDestruction__isnull=False).count(), 2
+        )
+        other_content.refresh_from_db()
+        self.assertIsNone(other_content.markForDestruction)
+        # already marked contents are not counted again
+        count = execute(
+            bulk_delete,
+            includeTags=["type=File"],
+            authorization=[self.token],
+        )["bulkDeleteContents"]["count"]
+        self.assertEqual(count, 1)
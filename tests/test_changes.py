@@ -0,0 +1,250 @@
+import threading
+from datetime import timedelta
+from itertools import islice
+from unittest import mock
+
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+from graphql_relay import to_global_id
+
+from secretgraph.constants import ChangeOperation
+from secretgraph.server.models import (
+    Action,
+    Change,
+    Cluster,
+    Content,
+    ContentTag,
+)
+from secretgraph.server.utils.changes import (
+    change_broker,
+    fetch_changes,
+    log_content_changes,
+    prune_changes,
+    sequence_changes,
+)
+
+from .utils import create_action, create_request, manage_action
+
+
+class ChangeMixin(object):
+    def setUp(self):
+        self.cluster = Cluster.objects.create(publicInfo="cluster.info")
+        self.token = create_action(self.cluster, manage_action())
+
+    def create_content(self, tag="type=Text", cluster=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            content = Content.objects.create(
+                cluster=cluster or self.cluster, nonce="n", file="c.store"
+            )
+            ContentTag.objects.create(content=content, tag=tag)
+            log_content_changes([content], ChangeOperation.create)
+        return content
+
+
+class ChangeFeedTests(ChangeMixin, TestCase):
+    def fetch(self, cursor=None, token=None):
+        return fetch_changes(
+            create_request(token or self.token), cursor=cursor
+        )
+
+    def test_cursor(self):
+        first = self.create_content()
+        result = self.fetch()
+        self.assertEqual(
+            [x.flexid for x in result["changes"]], [first.flexid]
+        )
+        self.assertFalse(result["resync"])
+        second = self.create_content()
+        result = self.fetch(result["cursor"])
+        self.assertEqual(
+            [x.flexid for x in result["changes"]], [second.flexid]
+        )
+        self.assertEqual(self.fetch(result["cursor"])["changes"], [])
+
+    def test_late_commit(self):
+        late = Content.objects.create(
+            cluster=self.cluster, nonce="n", file="late.store"
+        )
+        # the transaction of late got its id first but commits last
+        log_content_changes([late], ChangeOperation.create)
+        late_change = Change.objects.get(contentId=late.id)
+        late_id = late_change.id
+        late_change.delete()
+        early = self.create_content()
+        result = self.fetch()
+        self.assertEqual(
+            [x.flexid for x in result["changes"]], [early.flexid]
+        )
+        late_change.id = late_id
+        late_change.save()
+        sequence_changes()
+        self.assertLess(late_id, result["changes"][0].id)
+        result = self.fetch(result["cursor"])
+        self.assertEqual([x.flexid for x in result["changes"]], [late.flexid])
+        self.assertFalse(result["resync"])
+
+    @override_settings(SECRETGRAPH_CHANGES_DELAY=0)
+    def test_unsequenced(self):
+        content = Content.objects.create(
+            cluster=self.cluster, nonce="n", file="c.store"
+        )
+        # the process died before sequencing
+        log_content_changes([content], ChangeOperation.create)
+        self.assertEqual(
+            [x.flexid for x in self.fetch()["changes"]], [content.flexid]
+        )
+
+    def test_resync(self):
+        for _ in range(3):
+            self.create_content()
+        cursors = [
+            x.sequence for x in Change.objects.order_by("sequence")
+        ]
+        self.assertEqual(prune_changes(timedelta(0)), 2)
+        self.assertTrue(self.fetch(cursors[0])["resync"])
+        result = self.fetch(cursors[1])
+        self.assertFalse(result["resync"])
+        self.assertEqual(len(result["changes"]), 1)
+
+    def test_tombstones(self):
+        visible = self.create_content()
+        hidden = self.create_content("type=Secret")
+        view_token = create_action(
+            self.cluster,
+            {
+                "action": "view",
+                "includeTags": ["type=Text"],
+                "excludeTags": [],
+            },
+        )
+        cursor = self.fetch(token=view_token)["cursor"]
+        with self.captureOnCommitCallbacks(execute=True):
+            visible.delete()
+            hidden.delete()
+        self.assertEqual(
+            [x.flexid for x in self.fetch(cursor, view_token)["changes"]],
+            [],
+        )
+        self.assertEqual(
+            {x.flexid for x in self.fetch(cursor)["changes"]},
+            {visible.flexid, hidden.flexid},
+        )
+        view_all = create_action(
+            self.cluster,
+            {"action": "view", "includeTags": [], "excludeTags": []},
+        )
+        self.assertEqual(len(self.fetch(cursor, view_all)["changes"]), 2)
+
+
+class TimeoutEvent(threading.Event):
+    """ event of the broker which times out immediately """
+
+    def wait(self, timeout=None):
+        return False
+
+
+@override_settings(SECRETGRAPH_STREAM_TIMEOUT=0)
+class ChangeStreamTests(ChangeMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.other_cluster = Cluster.objects.create(publicInfo="other.info")
+        self.other_token = create_action(self.other_cluster, manage_action())
+        self.client = Client()
+        # no poller thread, the stream ends after the first fetch
+        patcher = mock.patch.object(
+            change_broker, "subscribe", return_value=threading.Event()
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def stream(self, *tokens, **params):
+        params.setdefault("cursor", 0)
+        return self.client.get(
+            reverse("secretgraph:changes"),
+            params,
+            HTTP_AUTHORIZATION=",".join(tokens),
+        )
+
+    def read(self, response):
+        self.assertEqual(response.status_code, 200)
+        return b"".join(response.streaming_content).decode("utf8")
+
+    def test_unauthorized(self):
+        self.create_content()
+        self.assertEqual(self.stream().status_code, 404)
+        invalid = self.token.rsplit(":", 1)[0] + ":" + "A" * 44
+        self.assertEqual(self.stream(invalid).status_code, 404)
+        # the cluster parameter cannot extend the clusters of the tokens
+        self.assertEqual(
+            self.stream(
+                self.other_token,
+                cluster=to_global_id("Cluster", self.cluster.flexid),
+            ).status_code,
+            404,
+        )
+
+    def test_clusters(self):
+        own = self.create_content()
+        other = self.create_content(cluster=self.other_cluster)
+        body = self.read(self.stream(self.token))
+        self.assertIn(to_global_id("Content", own.flexid), body)
+        self.assertNotIn(to_global_id("Content", other.flexid), body)
+        body = self.read(self.stream(self.token, self.other_token))
+        self.assertIn(to_global_id("Content", other.flexid), body)
+
+    def test_hidden_contents(self):
+        visible = self.create_content()
+        hidden = self.create_content("type=Secret")
+        view_token = create_action(
+            self.cluster,
+            {
+                "action": "view",
+                "includeTags": ["type=Text"],
+                "excludeTags": [],
+            },
+        )
+        body = self.read(self.stream(view_token))
+        self.assertIn(to_global_id("Content", visible.flexid), body)
+        self.assertNotIn(to_global_id("Content", hidden.flexid), body)
+
+    def wake_ups(self, response, amount):
+        """ reads the stream until the amount of keepalives """
+        self.assertEqual(response.status_code, 200)
+        body = ""
+        for chunk in response.streaming_content:
+            body += chunk.decode("utf8")
+            if body.count(": keepalive") >= amount:
+                break
+        return body
+
+    @override_settings(SECRETGRAPH_STREAM_TIMEOUT=300)
+    def test_revoked(self):
+        own = self.create_content()
+        with mock.patch.object(
+            change_broker, "subscribe", return_value=TimeoutEvent()
+        ):
+            response = self.stream(self.token)
+            body = self.wake_ups(response, 1)
+            self.assertIn(to_global_id("Content", own.flexid), body)
+            Action.objects.filter(cluster=self.cluster).delete()
+            later = self.create_content()
+            rest = list(islice(response.streaming_content, 10))
+        # the stream ends as nothing is visible anymore
+        self.assertLess(len(rest), 10)
+        body = b"".join(rest).decode("utf8")
+        self.assertNotIn(to_global_id("Content", later.flexid), body)
+
+    @override_settings(SECRETGRAPH_STREAM_TIMEOUT=300)
+    def test_resync_once(self):
+        self.create_content()
+        self.create_content()
+        # the only remaining change is not visible
+        self.create_content(cluster=self.other_cluster)
+        prune_changes(timedelta(0))
+        with mock.patch.object(
+            change_broker, "subscribe", return_value=TimeoutEvent()
+        ):
+            response = self.stream(self.token)
+            body = self.wake_ups(response, 3)
+            response.close()
+        self.assertEqual(body.count("event: resync"), 1)
@@ -0,0 +1,123 @@
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from secretgraph.constants import DeleteRecursive
+from secretgraph.server.models import (
+    Change,
+    Cluster,
+    Content,
+    ContentReference,
+    PendingFileDeletion,
+)
+from secretgraph.server.utils.delete import process_file_deletions
+
+
+class CascadeDeletionTests(TestCase):
+    """
+    Deletions of the Collector (cascades) must follow the same rules as
+    the set-based deletion
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username="owner")
+        self.cluster = Cluster.objects.create(
+            publicInfo="owned.info", user=self.user
+        )
+        self.other_cluster = Cluster.objects.create(publicInfo="other.info")
+        self.content = self.create_content(self.cluster, "owned.store")
+
+    def create_content(self, cluster, name):
+        return Content.objects.create(cluster=cluster, nonce="n", file=name)
+
+    def reference(self, source, deleteRecursive):
+        ContentReference.objects.create(
+            source=source,
+            target=self.content,
+            group="",
+            deleteRecursive=deleteRecursive.value,
+        )
+
+    def test_user_cascade(self):
+        recursive = self.create_content(self.other_cluster, "rec.store")
+        self.reference(recursive, DeleteRecursive.TRUE)
+        kept = self.create_content(self.other_cluster, "kept.store")
+        self.reference(kept, DeleteRecursive.FALSE)
+        no_group = self.create_content(self.other_cluster, "nogroup.store")
+        self.reference(no_group, DeleteRecursive.NO_GROUP)
+
+        self.user.delete()
+
+        self.assertFalse(Cluster.objects.filter(id=self.cluster.id).exists())
+        self.assertEqual(
+            set(
+                Content.objects.filter(
+                    cluster=self.other_cluster
+                ).values_list("id", flat=True)
+            ),
+            {kept.id},
+        )
+        self.assertTrue(
+            set(
+                PendingFileDeletion.objects.values_list("name", flat=True)
+            ).issuperset(
+                {"owned.info", "owned.store", "rec.store", "nogroup.store"}
+            )
+        )
+        self.assertEqual(
+            set(
+                Change.objects.filter(operation="delete").values_list(
+                    "flexid", flat=True
+                )
+            ),
+            {
+                self.cluster.flexid,
+                self.content.flexid,
+                recursive.flexid,
+                no_group.flexid,
+            },
+        )
+
+    def test_single_delete(self):
+        recursive = self.create_content(self.cluster, "rec.store")
+        self.reference(recursive, DeleteRecursive.TRUE)
+        self.content.delete()
+        self.assertFalse(Content.objects.filter(id=recursive.id).exists())
+        self.assertEqual(
+            set(PendingFileDeletion.objects.values_list("name", flat=True)),
+            {"owned.store", "rec.store"},
+        )
+
+
+class FileDeletionTests(TestCase):
+    def setUp(self):
+        PendingFileDeletion.objects.bulk_create(
+            PendingFileDeletion(name="file%d.store" % i) for i in range(4)
+        )
+        self.storage = Content._meta.get_field("file").storage
+
+    def test_concurrent_runs(self):
+        deleted = []
+
+        def delete(name):
+            if not deleted:
+                # a concurrent run starts after the first read its batch
+                deleted.append(name)
+                process_file_deletions()
+            else:
+                deleted.append(name)
+
+        with mock.patch.object(self.storage, "delete", side_effect=delete):
+            process_file_deletions()
+        self.assertEqual(
+            sorted(deleted), ["file%d.store" % i for i in range(4)]
+        )
+        self.assertFalse(PendingFileDeletion.objects.exists())
+
+    def test_failure_requeues(self):
+        with mock.patch.object(
+            self.storage, "delete", side_effect=OSError
+        ), self.assertLogs("secretgraph.server.utils.delete", "WARNING"):
+            self.assertEqual(process_file_deletions(), 0)
+        self.assertEqual(PendingFileDeletion.objects.count(), 4)
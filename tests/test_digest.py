@@ -0,0 +1,117 @@
+from unittest import mock
+from uuid import UUID, uuid4
+
+from django.test import TestCase
+
+from secretgraph.constants import ChangeOperation
+from secretgraph.server.models import Cluster, Content, DigestBucket
+from secretgraph.server.utils import digest
+from secretgraph.server.utils.changes import log_content_changes
+
+from .utils import create_action, create_request, manage_action
+
+
+class DigestTests(TestCase):
+    def setUp(self):
+        self.cluster = Cluster.objects.create(publicInfo="cluster.info")
+        self.token = create_action(self.cluster, manage_action())
+        self.contents = [
+            self.create_content(flexid)
+            for flexid in (
+                "ab000000-0000-0000-0000-000000000001",
+                "ab000000-0000-0000-0000-000000000002",
+                "a1000000-0000-0000-0000-000000000000",
+                "f0000000-0000-0000-0000-000000000000",
+            )
+        ]
+
+    def create_content(self, flexid):
+        content = Content.objects.create(
+            cluster=self.cluster,
+            flexid=UUID(flexid),
+            nonce="n",
+            file="c.store",
+        )
+        log_content_changes([content], ChangeOperation.create)
+        return content
+
+    def fetch(self, prefix="", token=None):
+        return digest.fetch_digest(
+            create_request(token or self.token), self.cluster, prefix=prefix
+        )
+
+    def test_tree(self):
+        root = self.fetch()
+        self.assertEqual(
+            root["hash"],
+            digest.hash_children(x["hash"] for x in root["children"]),
+        )
+        node = self.fetch("a")
+        self.assertEqual(root["children"][10]["hash"], node["hash"])
+        self.assertEqual(
+            node["hash"],
+            digest.hash_children(x["hash"] for x in node["children"]),
+        )
+        bucket = self.fetch("ab")
+        self.assertEqual(node["children"][11]["hash"], bucket["hash"])
+        self.assertEqual(
+            bucket["entries"],
+            [
+                {"flexid": x.flexid, "updateId": x.updateId}
+                for x in self.contents[:2]
+            ],
+        )
+        self.assertEqual(
+            bucket["hash"],
+            digest.hash_entries(
+                (x["flexid"], x["updateId"]) for x in bucket["entries"]
+            ),
+        )
+        self.assertEqual(self.fetch("0b")["entries"], [])
+        with self.assertRaises(ValueError):
+            self.fetch("abc")
+
+    def test_invalidation(self):
+        root = self.fetch()
+        self.assertFalse(any(x.stale for x in DigestBucket.objects.all()))
+        content = self.contents[3]
+        content.updateId = uuid4()
+        content.save(update_fields=["updateId"])
+        log_content_changes([content], ChangeOperation.update)
+        self.assertEqual(
+            [x.bucket for x in DigestBucket.objects.all() if x.stale], ["f0"]
+        )
+        with mock.patch.object(
+            digest, "fetch_entries", wraps=digest.fetch_entries
+        ) as fetch_entries:
+            changed = self.fetch()
+        # only the stale bucket is rehashed
+        self.assertEqual(fetch_entries.call_args[0][1], ["f0"])
+        self.assertNotEqual(changed["hash"], root["hash"])
+        self.assertEqual(
+            [
+                x["prefix"]
+                for x in changed["children"]
+                if x not in root["children"]
+            ],
+            ["f"],
+        )
+        self.assertFalse(any(x.stale for x in DigestBucket.objects.all()))
+
+    def test_partial_view(self):
+        restricted = create_action(
+            self.cluster,
+            {
+                "action": "view",
+                "includeTags": ["type=Text"],
+                "excludeTags": [],
+            },
+        )
+        self.assertIsNone(self.fetch(token=restricted))
+        unrestricted = create_action(
+            self.cluster,
+            {"action": "view", "includeTags": [], "excludeTags": []},
+        )
+        self.assertEqual(
+            self.fetch(token=unrestricted)["hash"], self.fetch()["hash"]
+        )
@@ -0,0 +1,39 @@
+import os
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.core.files.storage import FileSystemStorage
+from django.test import TestCase
+
+from secretgraph.server.utils.encryption import encrypt_into_file
+from secretgraph.server.utils.upload import StagedFile, get_staging_dir
+
+from .utils import TemporaryMediaMixin
+
+
+class EncryptIntoFileTests(TemporaryMediaMixin, TestCase):
+    def test_saved_file(self):
+        data = os.urandom(100000)
+        outfile, nonce, key = encrypt_into_file(data)
+        self.assertEqual(outfile.size, len(data) + 16)
+        storage = FileSystemStorage()
+        name = storage.save("encrypted", outfile)
+        # complete before the staged file is closed
+        self.assertEqual(storage.size(name), len(data) + 16)
+        with storage.open(name) as f:
+            self.assertEqual(AESGCM(key).decrypt(nonce, f.read(), None), data)
+        outfile.close()
+        self.assertEqual(os.listdir(get_staging_dir()), [])
+
+    def test_close_after_move(self):
+        staged = StagedFile()
+        staged.write(b"staged")
+        path = staged.temporary_file_path()
+        os.rename(path, "%s.moved" % path)
+        # the name is reused by another file
+        with open(path, "wb") as f:
+            f.write(b"other")
+        staged.close()
+        self.assertTrue(os.path.exists(path))
+        staged = StagedFile()
+        staged.close()
+        self.assertFalse(os.path.exists(staged.temporary_file_path()))
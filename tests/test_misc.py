@@ -0,0 +1,34 @@
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from django.test import SimpleTestCase
+
+from secretgraph.server.utils.misc import hash_object
+
+
+class CountingKey(object):
+    """ public key which counts its serializations """
+
+    def __init__(self, key):
+        self.key = key
+        self.calls = 0
+
+    def public_bytes(self, *args, **kwargs):
+        self.calls += 1
+        return self.key.public_bytes(*args, **kwargs)
+
+
+class HashObjectTests(SimpleTestCase):
+    def test_key_serialized_once(self):
+        private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048
+        )
+        key = CountingKey(private_key.public_key())
+        der = private_key.public_key().public_bytes(
+            encoding=serialization.Encoding.DER,
+            format=serialization.PublicFormat.SubjectPublicKeyInfo,
+        )
+        self.assertEqual(hash_object(key), hash_object(der))
+        self.assertEqual(hash_object(key), hash_object(der))
+        self.assertEqual(key.calls, 1)
+        # private keys are hashed by their public key
+        self.assertEqual(hash_object(private_key), hash_object(der))
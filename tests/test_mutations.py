@@ -0,0 +1,53 @@
+import os
+
+from django.conf import settings
+from django.test import TestCase
+
+from secretgraph.server.models import Content
+
+from .utils import ContentMutationMixin
+
+
+class ContentMutationTests(ContentMutationMixin, TestCase):
+    def test_manage_create_and_update(self):
+        result = self.create_content(b"first")
+        self.assertTrue(result["writeok"])
+        content = Content.objects.get(
+            cluster=self.cluster, tags__tag="type=File"
+        )
+        result = self.save_content(
+            b"second",
+            id=result["content"]["id"],
+            updateId=result["content"]["updateId"],
+        )
+        self.assertTrue(result["writeok"])
+        content.refresh_from_db()
+        with content.file.open("rb") as f:
+            self.assertEqual(f.read(), b"second")
+
+    def test_stale_update_id(self):
+        result = self.create_content(b"first")
+        content_id = result["content"]["id"]
+        stale_update_id = result["content"]["updateId"]
+        result = self.save_content(
+            b"second", id=content_id, updateId=stale_update_id
+        )
+        self.assertTrue(result["writeok"])
+        # a concurrent writer with the old updateId loses
+        result = self.save_content(
+            b"third", id=content_id, updateId=stale_update_id
+        )
+        self.assertFalse(result["writeok"])
+        content = Content.objects.get(
+            cluster=self.cluster, tags__tag="type=File"
+        )
+        with content.file.open("rb") as f:
+            self.assertEqual(f.read(), b"second")
+        self.assertEqual(str(content.updateId), result["content"]["updateId"])
+        # the file of the losing write is removed
+        stored = []
+        for root, _dirs, files in os.walk(settings.MEDIA_ROOT):
+            for name in files:
+                with open(os.path.join(root, name), "rb") as f:
+                    stored.append(f.read())
+        self.assertNotIn(b"third", stored)
@@ -0,0 +1,144 @@
+import os
+from datetime import timedelta as td
+
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase
+from django.utils import timezone
+
+from secretgraph.server.models import (
+    Action,
+    Cluster,
+    Content,
+    ContentAction,
+    ContentReference,
+)
+from secretgraph.server.utils.misc import hash_index_filter
+
+
+class QueryPlanTests(TestCase):
+    """
+    Checks that the hot queries of authorization and fetching use the
+    indexes of the models instead of table scans
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        now = timezone.now()
+        # not every backend returns primary keys in bulk_create
+        Cluster.objects.bulk_create(
+            Cluster(publicInfo="cluster_%d.info" % i) for i in range(20)
+        )
+        clusters = list(Cluster.objects.order_by("id"))
+        Content.objects.bulk_create(
+            Content(
+                cluster=clusters[i % 20],
+                nonce="nonce",
+                file="content_%d.store" % i,
+                markForDestruction=now if i % 50 == 0 else None,
+            )
+            for i in range(1000)
+        )
+        contents = list(Content.objects.order_by("id"))
+        ContentReference.objects.bulk_create(
+            ContentReference(
+                source=contents[i],
+                target=contents[(i + 1) % 1000],
+                group=("key", "signature", "")[i % 3],
+                deleteRecursive=None if i % 3 < 2 else True,
+            )
+            for i in range(1000)
+        )
+        ContentAction.objects.bulk_create(
+            ContentAction(content=contents[i], group="push")
+            for i in range(0, 1000, 2)
+        )
+        content_actions = list(ContentAction.objects.order_by("id"))
+        Action.objects.bulk_create(
+            Action(
+                cluster=clusters[i % 20],
+                contentAction=(
+                    content_actions[i] if i < len(content_actions) else None
+                ),
+                keyHash="hash%d" % i,
+                nonce="nonce",
+                value=os.urandom(20),
+                start=now - td(days=1),
+                stop=None if i % 2 else now + td(days=1),
+            )
+            for i in range(1000)
+        )
+        cls.cluster = clusters[3]
+        cls.content = contents[4]
+        with connection.cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def setUp(self):
+        if connection.vendor == "postgresql":
+            # the test data is small, force the planner to show if
+            # an index is usable
+            with connection.cursor() as cursor:
+                cursor.execute("SET enable_seqscan = off")
+        elif connection.vendor != "sqlite":
+            self.skipTest("query plans are only checked for sqlite/postgres")
+
+    def assertUsesIndex(self, queryset, *names):
+        plan = queryset.explain()
+        self.assertTrue(
+            any(name in plan for name in names),
+            "none of %s used:\n%s" % (names, plan),
+        )
+
+    def test_action_by_cluster_keyhash(self):
+        now = timezone.now()
+        self.assertUsesIndex(
+            Action.objects.filter(
+                Q(stop__isnull=True) | Q(stop__gte=now),
+                cluster_id=self.cluster.id,
+                start__lte=now,
+                **hash_index_filter("keyHash", ["hash3", "hash23"]),
+            ),
+            "action_cluster_keyhash",
+            "action_cluster_keyhash_open",
+        )
+
+    def test_content_cleanup(self):
+        self.assertUsesIndex(
+            Content.objects.filter(markForDestruction__lte=timezone.now()),
+            "content_destruction",
+        )
+
+    def test_content_by_cluster(self):
+        self.assertUsesIndex(
+            Content.objects.filter(
+                cluster_id=self.cluster.id, markForDestruction=None
+            ).order_by("-updated"),
+            "content_cluster_destr_upd",
+        )
+
+    def test_references_by_target_group(self):
+        self.assertUsesIndex(
+            ContentReference.objects.filter(
+                target_id=self.content.id, group="key"
+            ),
+            "contentreference_target_grp",
+        )
+
+    def test_references_by_source_group(self):
+        self.assertUsesIndex(
+            ContentReference.objects.filter(
+                source_id=self.content.id, group="signature"
+            ),
+            "contentreference_source_grp",
+            "contentreference_unique",
+        )
+
+    def test_contentaction_by_content_group(self):
+        self.assertUsesIndex(
+            ContentAction.objects.filter(
+                content_id=self.content.id, group="push", used=False
+            ),
+            # the unique constraint over content and group is the index
+            "contentaction_unique",
+            "sqlite_autoindex_secretgraph_contentaction",
+        )
@@ -0,0 +1,61 @@
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from secretgraph.server.models import Content
+from secretgraph.server.utils.delete import delete_contents
+from secretgraph.server.utils.quota import QuotaExceeded
+
+from .utils import ContentMutationMixin
+
+
+class QuotaTests(ContentMutationMixin, TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create(
+            username="owner", quota_local=15
+        )
+        super().setUp()
+
+    def assertUsage(self, size, count):
+        self.user.refresh_from_db()
+        self.cluster.refresh_from_db()
+        self.assertEqual(
+            (self.user.used_local, self.user.content_count), (size, count)
+        )
+        self.assertEqual(
+            (self.cluster.usedBytes, self.cluster.contentCount), (size, count)
+        )
+
+    def test_counters(self):
+        result = self.create_content(b"a" * 10)
+        self.assertUsage(10, 1)
+        # only the size difference counts against the quota
+        result = self.save_content(
+            b"b" * 14,
+            id=result["content"]["id"],
+            updateId=result["content"]["updateId"],
+        )
+        self.assertTrue(result["writeok"])
+        self.assertUsage(14, 1)
+        delete_contents(
+            Content.objects.filter(
+                cluster=self.cluster, tags__tag="type=File"
+            ).values_list("id", flat=True)
+        )
+        self.assertUsage(0, 0)
+
+    def test_exceeded(self):
+        result = self.create_content(b"a" * 10)
+        with self.assertRaises(QuotaExceeded):
+            self.save_content(
+                b"b" * 16,
+                id=result["content"]["id"],
+                updateId=result["content"]["updateId"],
+            )
+        with self.assertRaises(QuotaExceeded):
+            self.create_content(b"c" * 6)
+        self.assertUsage(10, 1)
+        content = Content.objects.get(
+            cluster=self.cluster, tags__tag="type=File"
+        )
+        with content.file.open("rb") as f:
+            self.assertEqual(f.read(), b"a" * 10)
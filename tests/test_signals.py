@@ -0,0 +1,67 @@
+from unittest import mock
+
+from django.db.models import QuerySet
+from django.db.utils import IntegrityError
+from django.test import TestCase
+
+from secretgraph.server.models import Change, Cluster, Content
+from secretgraph.server.signals import fillEmptyFlexidsCb
+
+
+class FillEmptyFlexidsTests(TestCase):
+    def test_collision_fallback(self):
+        cluster = Cluster.objects.create(publicInfo="cluster.info")
+        Content.objects.create(cluster=cluster, nonce="n", file="a.store")
+        Cluster.objects.update(flexid=None)
+        Content.objects.update(flexid=None)
+        with mock.patch.object(
+            QuerySet, "bulk_update", side_effect=IntegrityError
+        ):
+            fillEmptyFlexidsCb(None)
+        self.assertFalse(Cluster.objects.filter(flexid=None).exists())
+        self.assertFalse(Content.objects.filter(flexid=None).exists())
+        # the objects never existed under another flexid
+        self.assertFalse(Change.objects.exists())
+
+
+class FlexidCollisionTests(TestCase):
+    def setUp(self):
+        self.cluster = Cluster.objects.create(publicInfo="cluster.info")
+        self.content = Content.objects.create(
+            cluster=self.cluster, nonce="n", file="a.store"
+        )
+
+    def test_save(self):
+        cluster = Cluster.objects.create(
+            publicInfo="other.info", flexid=self.cluster.flexid
+        )
+        self.assertNotEqual(cluster.flexid, self.cluster.flexid)
+        content = Content.objects.create(
+            cluster=self.cluster,
+            nonce="n",
+            file="b.store",
+            flexid=self.content.flexid,
+        )
+        self.assertNotEqual(content.flexid, self.content.flexid)
+        self.assertEqual(Content.objects.count(), 2)
+
+    def test_bulk_create(self):
+        contents = Content.objects.bulk_create(
+            [
+                Content(cluster=self.cluster, nonce="n", file="b.store"),
+                Content(
+                    cluster=self.cluster,
+                    nonce="n",
+                    file="c.store",
+                    flexid=self.content.flexid,
+                ),
+            ]
+        )
+        self.assertNotEqual(contents[1].flexid, self.content.flexid)
+        self.assertEqual(Content.objects.count(), 3)
+
+    def test_other_errors(self):
+        with self.assertRaises(IntegrityError):
+            Content.objects.create(
+                cluster=self.cluster, nonce=None, file="b.store"
+            )
@@ -0,0 +1,115 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+from django.core.files.base import ContentFile
+from django.db.models import QuerySet
+from django.test import TestCase
+
+from secretgraph.server.models import PackedBlob, SharedBlob
+from secretgraph.server.storage import DedupStorage, PackfileStorage
+
+
+class PackfileCompactionTests(TestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        # writer and compaction run in different processes
+        self.writer = PackfileStorage(location=location)
+        self.addCleanup(self.writer.close_writer)
+        self.compactor = PackfileStorage(location=location)
+        self.addCleanup(self.compactor.close_writer)
+
+    def save(self, data):
+        return self.writer.save(data.decode("ascii"), ContentFile(data))
+
+    def read(self, name):
+        with self.writer.open(name) as f:
+            return f.read()
+
+    def compact(self):
+        return self.compactor.compact(min_dead_ratio=0, min_age=0)
+
+    def test_active_segment_untouched(self):
+        dead = self.save(b"dead")
+        live = self.save(b"live")
+        self.writer.delete(dead)
+        segment = self.writer._writer[1]
+        self.assertEqual(self.compact(), (0, 0))
+        self.assertFalse(self.writer.is_sealed(segment))
+        self.assertEqual(self.read(live), b"live")
+        later = self.save(b"later")
+        self.assertEqual(PackedBlob.objects.get(name=later).segment, segment)
+
+    def test_sealed_segment(self):
+        live = self.save(b"live")
+        segment = self.writer._writer[1]
+        self.writer.close_writer()
+        self.assertTrue(self.writer.is_sealed(segment))
+        self.assertEqual(self.compact(), (1, 0))
+        self.assertNotEqual(PackedBlob.objects.get(name=live).segment, segment)
+        self.assertEqual(self.read(live), b"live")
+        # empty segment is deleted in the next run
+        self.assertEqual(self.compact(), (0, 1))
+        self.assertFalse(self.writer.exists(segment))
+        self.assertEqual(self.read(live), b"live")
+
+    def test_rotate_sealed(self):
+        first = self.save(b"first")
+        segment = self.writer._writer[1]
+        # e.g. sealed by a compaction after a failed lock
+        self.compactor.seal(segment)
+        second = self.save(b"second")
+        self.assertEqual(PackedBlob.objects.get(name=first).segment, segment)
+        self.assertNotEqual(
+            PackedBlob.objects.get(name=second).segment, segment
+        )
+
+    def test_abandoned_segment(self):
+        live = self.save(b"live")
+        segment = self.writer._writer[1]
+        # the writer dies, its lock is released
+        os.close(self.writer._writer[2])
+        self.writer._writer = None
+        self.assertEqual(self.compact(), (0, 0))
+        self.assertTrue(self.writer.is_sealed(segment))
+        self.assertEqual(self.compact(), (1, 0))
+        self.assertEqual(self.read(live), b"live")
+
+
+class DedupStorageTests(TestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        self.storage = DedupStorage(location=location)
+
+    def test_refcount(self):
+        first = self.storage.save("first", ContentFile(b"same"))
+        second = self.storage.save("second", ContentFile(b"same"))
+        self.assertEqual(first, second)
+        self.assertEqual(SharedBlob.objects.get(name=first).refcount, 2)
+        self.storage.delete(first)
+        self.assertEqual(SharedBlob.objects.get(name=first).refcount, 1)
+        self.assertTrue(self.storage.exists(first))
+        self.storage.delete(second)
+        self.assertFalse(SharedBlob.objects.exists())
+        self.assertFalse(self.storage.exists(first))
+
+    def test_concurrent_create(self):
+        get = QuerySet.get
+        created = []
+
+        def concurrent_get(queryset, *args, **kwargs):
+            if queryset.model is SharedBlob and not created:
+                # another process creates the row after the lookup
+                created.append(
+                    SharedBlob.objects.create(refcount=1, **kwargs)
+                )
+                raise SharedBlob.DoesNotExist()
+            return get(queryset, *args, **kwargs)
+
+        with mock.patch.object(QuerySet, "get", concurrent_get):
+            name = self.storage.save("first", ContentFile(b"same"))
+        self.assertTrue(created)
+        self.assertEqual(SharedBlob.objects.get(name=name).refcount, 2)
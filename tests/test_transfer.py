@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+from unittest import mock
+
+import requests
+from django.core.files.base import ContentFile
+from django.test import TestCase, override_settings
+
+from secretgraph.constants import TransferResult
+from secretgraph.server.actions.update import _transfer
+from secretgraph.server.models import Cluster, Content
+
+
+class FakeResponse(object):
+    def __init__(self, status_code, headers, chunks, fail=False):
+        self.status_code = status_code
+        self.headers = headers
+        self.chunks = chunks
+        self.fail = fail
+
+    def iter_content(self, chunk_size):
+        yield from self.chunks
+        if self.fail:
+            raise requests.ConnectionError("connection lost")
+
+
+class FakeSession(object):
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        return self.responses.pop(0)
+
+
+@override_settings(
+    SECRETGRAPH_REQUEST_KWARGS_MAP={".test": {}},
+)
+class TransferTests(TestCase):
+    url = "http://remote.test/content"
+    data = os.urandom(2000)
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings_override = override_settings(
+            MEDIA_ROOT=self.media_root
+        )
+        self.settings_override.enable()
+        self.cluster = Cluster.objects.create(publicInfo="cluster.info")
+        self.content = Content(cluster=self.cluster, nonce="old")
+        self.content.file.save("", ContentFile(b"old"), save=False)
+        self.content.save()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        shutil.rmtree(self.media_root)
+
+    def transfer(self, session):
+        return _transfer.transfer_value(
+            self.content, url=self.url, transfer=False, session=session
+        )
+
+    def test_resume(self):
+        session = FakeSession(
+            FakeResponse(
+                200, {"ETag": '"v1"'}, [self.data[:1000]], fail=True
+            ),
+            FakeResponse(
+                206,
+                {"ETag": '"v1"', "Content-Range": "bytes 1000-1999/2000"},
+                [self.data[1000:]],
+            ),
+        )
+        old_name = self.content.file.name
+        with self.assertLogs(_transfer.logger, "ERROR"):
+            self.assertEqual(self.transfer(session), TransferResult.ERROR)
+        partial_path = _transfer._get_partial_path(self.content)
+        self.assertEqual(os.path.getsize(partial_path), 1000)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(self.transfer(session), TransferResult.SUCCESS)
+        self.assertEqual(session.requests[1]["Range"], "bytes=1000-")
+        self.assertEqual(session.requests[1]["If-Range"], '"v1"')
+        self.content.refresh_from_db()
+        self.assertNotEqual(self.content.file.name, old_name)
+        with self.content.file.open("rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertEqual(self.content.size, 2000)
+        self.assertFalse(os.path.exists(partial_path))
+        self.assertFalse(self.content.file.storage.exists(old_name))
+
+    def test_resume_last_modified(self):
+        modified = "Wed, 21 Oct 2015 07:28:00 GMT"
+        session = FakeSession(
+            FakeResponse(
+                200, {"Last-Modified": modified}, [self.data[:10]], fail=True
+            ),
+            FakeResponse(200, {"Last-Modified": modified}, [self.data]),
+        )
+        with self.assertLogs(_transfer.logger, "ERROR"):
+            self.assertEqual(self.transfer(session), TransferResult.ERROR)
+        # server ignored the range, the download restarts
+        self.assertEqual(self.transfer(session), TransferResult.SUCCESS)
+        self.assertEqual(session.requests[1]["If-Range"], modified)
+        self.content.refresh_from_db()
+        with self.content.file.open("rb") as f:
+            self.assertEqual(f.read(), self.data)
+
+    def test_rollback_keeps_file(self):
+        session = FakeSession(FakeResponse(200, {}, [self.data]))
+        old_name = self.content.file.name
+        with mock.patch.object(
+            _transfer, "log_content_changes", side_effect=ValueError
+        ), self.assertLogs(_transfer.logger, "ERROR"):
+            self.assertEqual(self.transfer(session), TransferResult.ERROR)
+        self.content.refresh_from_db()
+        self.assertEqual(self.content.file.name, old_name)
+        self.assertEqual(self.content.nonce, "old")
+        with self.content.file.open("rb") as f:
+            self.assertEqual(f.read(), b"old")
@@ -0,0 +1,98 @@
+from django.core.files import locks
+from django.db import transaction
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+from graphql_relay import to_global_id
+
+from secretgraph.server.models import Content, UploadSession
+from secretgraph.server.utils.upload import claim_upload, upload_session_path
+
+from .utils import ContentMutationMixin
+
+
+@override_settings(SECRETGRAPH_REQUEST_KWARGS_MAP={".test": {}})
+class UploadTests(ContentMutationMixin, TestCase):
+    data = b"0123456789"
+
+    def setUp(self):
+        super().setUp()
+        self.client = Client()
+        response = self.client.post(
+            "%s?cluster=%s"
+            % (
+                reverse("secretgraph:uploads"),
+                to_global_id("Cluster", self.cluster.flexid),
+            ),
+            HTTP_AUTHORIZATION=self.token,
+            HTTP_UPLOAD_LENGTH=str(len(self.data)),
+        )
+        self.assertEqual(response.status_code, 201)
+        self.location = response["Location"]
+        self.session = UploadSession.objects.get()
+
+    def patch(self, offset, data):
+        return self.client.patch(
+            self.location,
+            data,
+            content_type="application/offset+octet-stream",
+            HTTP_UPLOAD_OFFSET=str(offset),
+        )
+
+    def commit(self):
+        return self.create_content(None, upload=self.session.flexid)
+
+    def test_resume(self):
+        response = self.patch(0, self.data[:4])
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(response["Upload-Offset"], "4")
+        response = self.client.head(self.location)
+        self.assertEqual(response["Upload-Offset"], "4")
+        with self.assertRaisesMessage(ValueError, "incomplete"):
+            self.commit()
+        response = self.patch(4, self.data[4:])
+        self.assertEqual(response["Upload-Offset"], "10")
+        self.assertTrue(self.commit()["writeok"])
+        content = Content.objects.get(
+            cluster=self.cluster, tags__tag="type=File"
+        )
+        with content.file.open("rb") as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(UploadSession.objects.exists())
+
+    def test_offset_mismatch(self):
+        self.patch(0, self.data[:4])
+        response = self.patch(2, self.data[2:])
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response["Upload-Offset"], "4")
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.offset, 4)
+
+    def test_concurrent_patch(self):
+        with open(upload_session_path(self.session), "wb") as f:
+            # another request streams into the session
+            locks.lock(f, locks.LOCK_EX)
+            response = self.patch(0, self.data)
+        self.assertEqual(response.status_code, 409)
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.offset, 0)
+
+    def test_double_claim(self):
+        self.patch(0, self.data)
+        self.assertTrue(self.commit()["writeok"])
+        with self.assertRaisesMessage(ValueError, "not found"):
+            self.commit()
+        self.assertEqual(
+            Content.objects.filter(
+                cluster=self.cluster, tags__tag="type=File"
+            ).count(),
+            1,
+        )
+
+    def test_claim_before_save(self):
+        self.patch(0, self.data)
+        with transaction.atomic():
+            claimed = claim_upload(self.session.flexid, cluster=self.cluster)
+            # a concurrent commit before the first one saved the file
+            with self.assertRaisesMessage(ValueError, "not found"):
+                claim_upload(self.session.flexid, cluster=self.cluster)
+            claimed.close()
@@ -0,0 +1,159 @@
+import base64
+import json
+import os
+import shutil
+import tempfile
+
+import graphene
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.core.files.base import ContentFile
+from django.test import RequestFactory, override_settings
+from django.utils import timezone
+from graphql_relay import to_global_id
+
+from secretgraph.server.models import Action, Cluster, Content, ContentTag
+from secretgraph.schema import Mutation, Query
+from secretgraph.server.utils.misc import hash_index, hash_object
+
+
+def create_action(cluster, action_dict, key=None):
+    """
+    Creates an action for cluster
+    Returns the authorization token of the action
+    """
+    key = key or os.urandom(32)
+    nonce = os.urandom(13)
+    key_hash = hash_object(key)
+    Action.objects.create(
+        cluster=cluster,
+        keyHash=key_hash,
+        keyHashIndex=hash_index(key_hash),
+        nonce=base64.b64encode(nonce).decode("ascii"),
+        value=AESGCM(key).encrypt(
+            nonce, json.dumps(action_dict).encode("utf8"), None
+        ),
+        start=timezone.now(),
+    )
+    return "%s:%s" % (
+        to_global_id("Cluster", cluster.flexid),
+        base64.b64encode(key).decode("ascii"),
+    )
+
+
+def create_key(cluster):
+    """ Creates a public key content, returns its hash """
+    key_hash = hash_object(os.urandom(32))
+    key = Content.objects.create(
+        cluster=cluster, nonce="", file="key.store", contentHash=key_hash
+    )
+    ContentTag.objects.bulk_create(
+        ContentTag(content=key, tag=tag)
+        for tag in ("type=PublicKey", "state=public", "key_hash=%s" % key_hash)
+    )
+    return key_hash
+
+
+def manage_action():
+    return {
+        "action": "manage",
+        "exclude": {"Cluster": [], "Content": [], "Action": []},
+    }
+
+
+def create_request(*tokens):
+    return RequestFactory().get("/", HTTP_AUTHORIZATION=",".join(tokens))
+
+
+# without the query protector of secretgraph.schema
+schema = graphene.Schema(query=Query, mutation=Mutation)
+
+
+def execute(query, *tokens, **variables):
+    """ Returns data of query, raises the first error """
+    result = schema.execute(
+        query, context=create_request(*tokens), variables=variables
+    )
+    if result.errors:
+        error = result.errors[0]
+        raise getattr(error, "original_error", None) or error
+    return result.data
+
+
+class TemporaryMediaMixin(object):
+    """ files of the test are stored in a temporary MEDIA_ROOT """
+
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        override = override_settings(MEDIA_ROOT=media_root)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+update_content = """
+mutation updateContent(
+    $id: ID, $updateId: ID, $cluster: ID, $value: Upload, $upload: String,
+    $nonce: String!, $tags: [String], $references: [ReferenceInput],
+    $authorization: [String]
+) {
+    updateOrCreateContent(input: {
+        id: $id, updateId: $updateId, authorization: $authorization,
+        content: {
+            cluster: $cluster, references: $references,
+            value: {
+                value: $value, upload: $upload, nonce: $nonce, tags: $tags
+            }
+        }
+    }) {
+        writeok
+        content {
+            id
+            updateId
+        }
+    }
+}
+"""
+
+
+def nonce():
+    return base64.b64encode(os.urandom(13)).decode("ascii")
+
+
+class ContentMutationMixin(TemporaryMediaMixin):
+    """ cluster with manage token and key, contents are saved via graphql """
+
+    user = None
+
+    def setUp(self):
+        super().setUp()
+        self.cluster = Cluster.objects.create(
+            publicInfo="cluster.info", user=self.user
+        )
+        self.token = create_action(self.cluster, manage_action())
+        self.key_hash = create_key(self.cluster)
+
+    def save_content(self, data, **kwargs):
+        """ data is None for committing an upload """
+        return execute(
+            update_content,
+            value=None if data is None else ContentFile(data),
+            nonce=nonce(),
+            tags=[
+                "type=File",
+                "state=internal",
+                "key_hash=%s" % self.key_hash,
+            ],
+            authorization=[self.token],
+            **kwargs
+        )["updateOrCreateContent"]
+
+    def create_content(self, data, **kwargs):
+        return self.save_content(
+            data,
+            **kwargs,
+            cluster=to_global_id("Cluster", self.cluster.flexid),
+            references=[
+                {"target": self.key_hash, "group": "key", "extra": "shared"}
+            ],
+        )